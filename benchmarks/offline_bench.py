@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+'''
+End-to-end benchmark of the transaction server that runs on a laptop: the real
+Flask app and commands blueprint are driven in-process through Flask's test
+client, with mongomock in place of MongoDB, fakeredis in place of Redis and
+the stand-in quote server in place of the legacy one.
+
+Usage:
+    pip3 install -r benchmarks/requirements.txt
+    python3 benchmarks/offline_bench.py workloads/10userWorkLoad.txt --latency 5 --output report.json
+
+Commands are replayed in file order on a single thread, and the wall-clock
+latency and process CPU time of each command are reported per command type.
+CPU time includes the transaction server's background threads (log writer,
+trigger engine), which is part of what each command costs. Since the stand-ins
+answer in microseconds, latencies are dominated by Python-side handler cost
+and regressions in it show up directly.
+'''
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+from quoteserver_standin import QuoteServerStandIn
+
+# The workload parser is shared with the workload driver.
+_spec = importlib.util.spec_from_file_location('driver', os.path.join(REPO_DIR, 'driver.py'))
+driver = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(driver)
+
+
+def create_app(quote_server_address):
+    '''
+    Imports the transaction server with its Mongo and Redis clients replaced
+    by in-memory stand-ins, and returns its Flask app. Must be called before
+    anything else imports transaction_server.
+    '''
+    import fakeredis
+    import mongomock
+    import pymongo
+    import redis
+
+    os.environ.setdefault('DB_HOST', 'localhost')
+    os.environ['QUOTE_SERVER_HOST'], os.environ['QUOTE_SERVER_PORT'] = quote_server_address[0], str(quote_server_address[1])
+    pymongo.MongoClient = mongomock.MongoClient
+    redis.StrictRedis = fakeredis.FakeStrictRedis
+
+    from transaction_server import app
+    return app
+
+
+def replay(app, lines):
+    '''
+    Replays the workload lines through the app's test client, administrator
+    DUMPLOG commands last, and returns the latency and CPU time of each
+    command as (command, seconds, cpu_seconds, failed) tuples.
+    '''
+    client = app.test_client()
+    samples = []
+    deferred = []
+
+    def execute(command, route, params):
+        start, cpu_start = time.perf_counter(), time.process_time()
+        response = client.get('/commands/{}'.format(route), query_string=params)
+        samples.append((command, time.perf_counter() - start, time.process_time() - cpu_start, response.get_json().get('status') != 'success'))
+
+    for line in lines:
+        parsed = driver.parse_line(line)
+        if parsed is None:
+            continue
+        if 'userid' not in parsed[2]:
+            deferred.append(parsed)
+            continue
+        execute(*parsed)
+
+    for parsed in deferred:
+        execute(*parsed)
+    return samples
+
+
+def summarize(samples, elapsed, cpu):
+    per_command = {}
+    for command in sorted(set(sample[0] for sample in samples)):
+        latencies = sorted(sample[1] for sample in samples if sample[0] == command)
+        cpu_times = [sample[2] for sample in samples if sample[0] == command]
+        per_command[command] = {
+            'count': len(latencies),
+            'failures': sum(sample[3] for sample in samples if sample[0] == command),
+            'p50_ms': driver.percentile(latencies, 0.50) * 1000,
+            'p95_ms': driver.percentile(latencies, 0.95) * 1000,
+            'p99_ms': driver.percentile(latencies, 0.99) * 1000,
+            'max_ms': latencies[-1] * 1000,
+            'cpu_ms_per_command': sum(cpu_times) / len(cpu_times) * 1000,
+        }
+
+    return {
+        'commands': len(samples),
+        'elapsed_s': elapsed,
+        'throughput_per_s': len(samples) / elapsed if elapsed else 0.0,
+        'cpu_s': cpu,
+        'cpu_ms_per_command': cpu / len(samples) * 1000 if samples else 0.0,
+        'per_command': per_command,
+    }
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Replay workloads against the transaction server with in-memory stand-ins.')
+    parser.add_argument('workloads', nargs='+', help='Workload files, replayed one after another')
+    parser.add_argument('--latency', type=float, default=0.0, help='Stand-in quote server latency in milliseconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Additional random quote server latency, up to this many milliseconds')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='Fraction of quote server responses delayed by --slow-latency')
+    parser.add_argument('--slow-latency', type=float, default=0.0, help='Latency of slow quote server responses in milliseconds')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='Fraction of quote server requests dropped without a response')
+    parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    workloads = [os.path.abspath(workload) for workload in args.workloads]
+    output = os.path.abspath(args.output) if args.output else None
+
+    quote_server = QuoteServerStandIn(
+        port=0, latency=args.latency / 1000.0, jitter=args.jitter / 1000.0,
+        slow_rate=args.slow_rate, slow_latency=args.slow_latency / 1000.0, drop_rate=args.drop_rate
+    )
+    app = create_app(quote_server.start())
+
+    # DUMPLOG writes to logs/ relative to the working directory.
+    os.chdir(tempfile.mkdtemp(prefix='offline-bench-'))
+    os.makedirs('logs')
+
+    report = {'quote_server_latency_ms': args.latency, 'workloads': {}}
+    for workload in workloads:
+        start, cpu_start = time.perf_counter(), time.process_time()
+        with open(workload, 'r') as f:
+            samples = replay(app, f)
+        report['workloads'][os.path.basename(workload)] = summarize(samples, time.perf_counter() - start, time.process_time() - cpu_start)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+'''
+Benchmarks quote server access patterns against the stand-in quote server:
+
+    connect    - a new connection per quote, as the original client did
+    pooled     - warm connections reused from QuoteServerPool
+    pipelined  - QuoteServerPool with several requests per connection write
+
+Usage:
+    python3 benchmarks/quoteserver_bench.py --quotes 5000 --threads 16 --latency 5
+'''
+import argparse
+import importlib.util
+import os
+import socket
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from quoteserver_standin import QuoteServerStandIn
+
+# Load the pool module on its own: importing the transaction_server package
+# creates the Flask app and connects to Mongo and Redis.
+_spec = importlib.util.spec_from_file_location('quoteserver_pool', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'transaction_server', 'quoteserver_pool.py'))
+quoteserver_pool = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(quoteserver_pool)
+
+SYMBOLS = ['ABC', 'S', 'XYZ', 'QQ', 'T', 'MSF', 'GOO', 'AMZ']
+
+
+def quote_with_new_connection(address, symbol, username):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.connect(address)
+        s.sendall(str.encode('{:3s} {}\n'.format(symbol, username)))
+        return s.recv(1024)
+
+
+def run(mode, address, quotes, threads, depth):
+    pool = quoteserver_pool.QuoteServerPool(address[0], address[1], max_idle=threads, pipelining=(mode == 'pipelined'))
+    usernames = ['user{}'.format(i) for i in range(threads)]
+
+    def worker(worker_num):
+        latencies = []
+        count = quotes // threads
+        for i in range(0, count, depth if mode == 'pipelined' else 1):
+            start = time.perf_counter()
+            if mode == 'connect':
+                quote_with_new_connection(address, SYMBOLS[i % len(SYMBOLS)], usernames[worker_num])
+            elif mode == 'pooled':
+                pool.quote(SYMBOLS[i % len(SYMBOLS)], usernames[worker_num])
+            else:
+                pool.quote_many([(SYMBOLS[(i + j) % len(SYMBOLS)], usernames[worker_num]) for j in range(min(depth, count - i))])
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        latencies = sorted(latency for result in executor.map(worker, range(threads)) for latency in result)
+    elapsed = time.perf_counter() - start
+    pool.clear()
+
+    return {
+        'mode': mode,
+        'quotes_per_sec': (quotes // threads) * threads / elapsed,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark quote server client access patterns.')
+    parser.add_argument('--quotes', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--depth', type=int, default=8, help='Requests per pipelined batch')
+    parser.add_argument('--latency', type=float, default=0.0, help='Stand-in server latency in milliseconds')
+    parser.add_argument('--modes', default='connect,pooled,pipelined')
+    args = parser.parse_args()
+
+    server = QuoteServerStandIn(port=0, latency=args.latency / 1000.0)
+    address = server.start()
+
+    for mode in args.modes.split(','):
+        result = run(mode, address, args.quotes, args.threads, args.depth)
+        print('{mode:10s} {quotes_per_sec:10.1f} quotes/s  p50 {p50_ms:7.2f} ms  p99 {p99_ms:7.2f} ms (per request batch)'.format(**result))
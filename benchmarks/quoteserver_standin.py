@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+'''
+Local stand-in for the legacy quote server, so the quote server client can be
+benchmarked offline. Speaks the same line protocol: a request is
+"SYM username\n" and the response "price,SYM,username,timestamp,cryptokey\n".
+
+Usage:
+    python3 benchmarks/quoteserver_standin.py --port 4444 --latency 50
+
+Connections are kept open and pipelined requests are answered in order, unless
+--close-after-reply is passed to mimic a server that only serves one request
+per connection.
+
+Faults can be injected to test the client's timeouts, hedging and circuit
+breaker: a fraction of requests can be answered --slow-latency late
+(--slow-rate), or dropped by closing the connection without a response
+(--drop-rate). The rates are attributes of the server and can be changed
+while it runs, e.g. set drop_rate to 1.0 to simulate an outage.
+'''
+import argparse
+import hashlib
+import random
+import socket
+import socketserver
+import threading
+import time
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 4444
+
+
+def make_quote(symbol, username):
+    '''
+    Returns a response line with a price that is stable for a given symbol
+    within a minute, like quotes from the real server.
+    '''
+    minute = int(time.time() // 60)
+    digest = hashlib.sha256('{}:{}'.format(symbol, minute).encode('utf-8')).hexdigest()
+    price = 1 + (int(digest[:8], 16) % 50000) / 100.0
+    cryptokey = hashlib.sha256('{}:{}:{}'.format(symbol, username, time.time()).encode('utf-8')).hexdigest()[:44]
+    return '{:.2f},{},{},{},{}\n'.format(price, symbol, username, int(time.time() * 1000), cryptokey)
+
+
+class QuoteRequestHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        # Pipelined responses are small writes, don't hold them back for ACKs.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            symbol, username = line.decode('utf-8').split()
+            if random.random() < self.server.drop_rate:
+                return
+            self.server.delay()
+            self.wfile.write(make_quote(symbol, username).encode('utf-8'))
+            self.wfile.flush()
+
+            if self.server.close_after_reply:
+                return
+
+
+class QuoteServerStandIn(socketserver.ThreadingTCPServer):
+    '''
+    Threaded stand-in quote server. Each response is delayed by latency
+    seconds, plus up to jitter seconds picked at random. A slow_rate fraction
+    of responses are delayed by slow_latency seconds instead, and a drop_rate
+    fraction of requests are dropped along with their connection.
+    '''
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, latency=0.0, jitter=0.0, close_after_reply=False, slow_rate=0.0, slow_latency=0.0, drop_rate=0.0):
+        super().__init__((host, port), QuoteRequestHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.close_after_reply = close_after_reply
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.drop_rate = drop_rate
+
+    def delay(self):
+        if random.random() < self.slow_rate:
+            time.sleep(self.slow_latency)
+            return
+
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def start(self):
+        '''
+        Serves in a background thread and returns the (host, port) bound.
+        '''
+        threading.Thread(target=self.serve_forever, name='quoteserver-standin', daemon=True).start()
+        return self.server_address
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Local stand-in for the legacy quote server.')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--latency', type=float, default=0.0, help='Response latency in milliseconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Additional random latency, up to this many milliseconds')
+    parser.add_argument('--close-after-reply', action='store_true', help='Close each connection after one response')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='Fraction of responses delayed by --slow-latency')
+    parser.add_argument('--slow-latency', type=float, default=0.0, help='Latency of slow responses in milliseconds')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='Fraction of requests dropped without a response')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    server = QuoteServerStandIn(
+        args.host, args.port, args.latency / 1000.0, args.jitter / 1000.0, args.close_after_reply,
+        args.slow_rate, args.slow_latency / 1000.0, args.drop_rate
+    )
+    print('Stand-in quote server listening on {}:{}'.format(*server.server_address))
+    server.serve_forever()
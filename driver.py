@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+'''
+Workload driver for the transaction servers. Unlike console.py, the workload
+file is streamed rather than read into memory, users are run as asyncio tasks
+sharing a bounded pool of HTTP worker threads with keep-alive connections, and
+per-command latency and throughput over time are reported as JSON.
+
+Usage:
+    python3 driver.py workloads/10userWorkLoad.txt
+    python3 driver.py workloads/100User_testWorkLoad.txt --mode open --rate 2000 --output report.json
+
+Each user's commands are always sent in order, one at a time. In closed-loop
+mode (the default) a user sends its next command as soon as the previous one
+completes. In open-loop mode commands are due at a fixed arrival rate, in file
+order, and latency is measured from the time a command was due, so that a
+slow server is charged for the time commands spent waiting to be sent.
+
+Administrator DUMPLOG commands are sent last, once every other command has
+completed, as console.py does.
+
+Commands that get no valid response (connection errors, timeouts, 5xx) are
+retried up to --retries times with exponential backoff. Every request of a
+run carries the run's X-Run-Id header, with which the server runs each tx_num
+at most once and answers retries with the original response, so retrying
+never applies a command twice.
+'''
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import sys
+import threading
+import time
+import uuid
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_URL = 'http://localhost:8002'
+USER_QUEUE_SIZE = 1000 # commands read ahead per user, in closed-loop mode
+OPEN_LOOP_READ_AHEAD = 1.0 # seconds of commands read before they are due, in open-loop mode
+
+# Route and parameters following the user ID, for each workload command.
+COMMANDS = {
+    'ADD': ('add', ['amount']),
+    'QUOTE': ('quote', ['stocksymbol']),
+    'BUY': ('buy', ['stocksymbol', 'amount']),
+    'COMMIT_BUY': ('commit_buy', []),
+    'CANCEL_BUY': ('cancel_buy', []),
+    'SELL': ('sell', ['stocksymbol', 'amount']),
+    'COMMIT_SELL': ('commit_sell', []),
+    'CANCEL_SELL': ('cancel_sell', []),
+    'SET_BUY_AMOUNT': ('set_buy_amount', ['stocksymbol', 'amount']),
+    'CANCEL_SET_BUY': ('cancel_set_buy', ['stocksymbol']),
+    'SET_BUY_TRIGGER': ('set_buy_trigger', ['stocksymbol', 'amount']),
+    'SET_SELL_AMOUNT': ('set_sell_amount', ['stocksymbol', 'amount']),
+    'SET_SELL_TRIGGER': ('set_sell_trigger', ['stocksymbol', 'amount']),
+    'CANCEL_SET_SELL': ('cancel_set_sell', ['stocksymbol']),
+    'DISPLAY_SUMMARY': ('display_summary', []),
+}
+
+
+def parse_line(line):
+    '''
+    Parses a workload line such as "[3] BUY,oY01WVirLr,S,276.83" into the
+    command name and its route parameters. Returns None for blank lines.
+    '''
+    line = line.strip()
+    if not line:
+        return None
+
+    tx_num, _, fields = line.partition(' ')
+    fields = fields.split(',')
+    command = fields[0]
+    params = {'tx_num': tx_num.strip('[]')}
+
+    if command == 'DUMPLOG':
+        if len(fields) == 3:
+            params['userid'] = fields[1]
+        params['filename'] = fields[-1].removeprefix('./')
+        return command, 'dumplog', params
+
+    route, names = COMMANDS[command]
+    params['userid'] = fields[1]
+    params.update(zip(names, fields[2:]))
+    return command, route, params
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+class Stats():
+    '''
+    Latencies per command and completions per interval since the start.
+    '''
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.latencies = {}
+        self.failures = {}
+        self.errors = {}
+        self.retries = {}
+        self.completions = []
+
+    def record(self, command, latency, failed, error, retries):
+        self.latencies.setdefault(command, []).append(latency)
+        self.failures[command] = self.failures.get(command, 0) + failed
+        self.errors[command] = self.errors.get(command, 0) + error
+        self.retries[command] = self.retries.get(command, 0) + retries
+
+        bucket = int((time.perf_counter() - self.start) / self.interval)
+        self.completions.extend([0] * (bucket + 1 - len(self.completions)))
+        self.completions[bucket] += 1
+
+    def report(self, mode):
+        elapsed = time.perf_counter() - self.start
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        per_command = {}
+        for command, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            per_command[command] = {
+                'count': len(latencies),
+                'failures': self.failures[command],
+                'errors': self.errors[command],
+                'retries': self.retries[command],
+                'p50_ms': percentile(latencies, 0.50) * 1000,
+                'p95_ms': percentile(latencies, 0.95) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000,
+                'max_ms': latencies[-1] * 1000,
+            }
+
+        return {
+            'mode': mode,
+            'commands': total,
+            'failures': sum(self.failures.values()),
+            'errors': sum(self.errors.values()),
+            'retries': sum(self.retries.values()),
+            'elapsed_s': elapsed,
+            'throughput_per_s': total / elapsed if elapsed else 0.0,
+            'per_command': per_command,
+            'interval_s': self.interval,
+            'throughput_over_time': [count / self.interval for count in self.completions],
+        }
+
+
+class Driver():
+    '''
+    Replays a workload file against a transaction server. HTTP requests are
+    made from a pool of worker threads, each with its own keep-alive session,
+    so at most concurrency requests are in flight at once.
+    '''
+
+    def __init__(self, url, mode='closed', rate=None, concurrency=64, interval=1.0, timeout=60.0, retries=3, retry_backoff=0.1):
+        assert mode in ['closed', 'open']
+        assert mode == 'closed' or rate, 'open-loop mode needs an arrival rate'
+
+        self.url = url
+        self.mode = mode
+        self.rate = rate
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.stats = Stats(interval)
+        self.run_id = uuid.uuid4().hex
+        self._local = threading.local()
+
+    def session(self):
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+            self._local.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            self._local.session.headers['X-Run-Id'] = self.run_id
+        return self._local.session
+
+    def send(self, route, params):
+        # Returns (failed, error, retries): failed for commands the server
+        # rejected, error when no valid response was received after retrying.
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            try:
+                response = self.session().get('{}/commands/{}'.format(self.url, route), params=params, timeout=self.timeout)
+                if response.status_code == 200:
+                    return response.json().get('status') != 'success', False, attempt
+                if response.status_code < 500:
+                    return False, True, attempt
+            except (requests.RequestException, ValueError):
+                pass
+        return False, True, self.retries
+
+    async def execute(self, command, route, params, due):
+        loop = asyncio.get_running_loop()
+        if self.mode == 'open':
+            await asyncio.sleep(max(0.0, due - loop.time()))
+        else:
+            due = loop.time()
+
+        failed, error, retries = await loop.run_in_executor(self.executor, self.send, route, params)
+        self.stats.record(command, loop.time() - due, failed, error, retries)
+
+    async def run_user(self, commands):
+        while True:
+            item = await commands.get()
+            if item is None:
+                return
+            await self.execute(*item)
+
+    async def run(self, lines):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        users = {}
+        tasks = []
+        deferred = []
+
+        for line_num, line in enumerate(lines):
+            parsed = parse_line(line)
+            if parsed is None:
+                continue
+
+            command, route, params = parsed
+            due = start + line_num / self.rate if self.mode == 'open' else None
+            if due is not None:
+                await asyncio.sleep(max(0.0, due - OPEN_LOOP_READ_AHEAD - loop.time()))
+            if 'userid' not in params:
+                deferred.append((command, route, params, due))
+                continue
+
+            if params['userid'] not in users:
+                # In open-loop mode, a user falling behind must not hold up
+                # reading the commands of the others as they fall due.
+                users[params['userid']] = asyncio.Queue(maxsize=USER_QUEUE_SIZE if self.mode == 'closed' else 0)
+                tasks.append(asyncio.ensure_future(self.run_user(users[params['userid']])))
+            await users[params['userid']].put((command, route, params, due))
+
+        for commands in users.values():
+            await commands.put(None)
+        await asyncio.gather(*tasks)
+
+        for command, route, params, due in deferred:
+            await self.execute(command, route, params, loop.time() if self.mode == 'open' else due)
+
+        self.executor.shutdown()
+        return self.stats.report(self.mode)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Replay a workload file against the transaction servers.')
+    parser.add_argument('workload', help='Workload file, one command per line')
+    parser.add_argument('--url', default=DEFAULT_URL, help='Transaction server (or load balancer) URL')
+    parser.add_argument('--mode', choices=['closed', 'open'], default='closed', help='Closed-loop, or open-loop at a fixed arrival rate')
+    parser.add_argument('--rate', type=float, help='Commands per second, for open-loop mode')
+    parser.add_argument('--concurrency', type=int, default=64, help='Maximum requests in flight')
+    parser.add_argument('--interval', type=float, default=1.0, help='Seconds per throughput sample')
+    parser.add_argument('--timeout', type=float, default=60.0, help='Request timeout in seconds')
+    parser.add_argument('--retries', type=int, default=3, help='Retries of commands without a valid response')
+    parser.add_argument('--retry-backoff', type=float, default=0.1, help='Seconds before the first retry, doubled for each one after')
+    parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.mode == 'open' and not args.rate:
+        sys.exit('--rate is required in open-loop mode')
+
+    driver = Driver(args.url, args.mode, args.rate, args.concurrency, args.interval, args.timeout, args.retries, args.retry_backoff)
+    with open(args.workload, 'r') as f:
+        report = asyncio.run(driver.run(f))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -1,7 +1,14 @@
 #!/usr/bin/env python3
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request
 import os
 from transaction_server import commands
+from transaction_server.account_state import ACCOUNT_STATE_MODE, account_store
+from transaction_server.admission import ADMISSION_ENABLED, admission_controller
+from transaction_server.instrumentation import METRICS_ENABLED, metrics
+from transaction_server.log_segments import LOG_SEGMENTS, log_segmenter
+from transaction_server.profiling import PROFILE_DIR, GlobalProfile, profile_listener
+from transaction_server.quoteserver_client import QuoteServerClient, pool as quote_server_pool
+from transaction_server.triggers import trigger_engine
 
 # Create and configure app
 app = Flask(__name__, instance_relative_config=True)
@@ -20,4 +27,53 @@ except OSError:
 def ping():
     return jsonify({'status': 'success', 'message': 'Transaction server is alive!'})
 
-app.register_blueprint(commands.bp)
\ No newline at end of file
+# Quote cache statistics for this server
+@app.route('/quote_cache')
+def quote_cache():
+    return jsonify({'status': 'success', 'quote_cache': QuoteServerClient.get_cache_stats()})
+
+# Quote server circuit breaker state, request counts and tail latency of this server process
+@app.route('/quote_server')
+def quote_server():
+    return jsonify({'status': 'success', 'quote_server': quote_server_pool.stats()})
+
+# Admission queue depths and shed counts of this server process
+@app.route('/admission')
+def admission():
+    return jsonify({'status': 'success', 'enabled': ADMISSION_ENABLED, 'admission': admission_controller.stats()})
+
+# Per-command dependency timings, admission and quote server health of this process, in the Prometheus text format
+if METRICS_ENABLED:
+    @app.route('/metrics')
+    def prometheus_metrics():
+        return Response(metrics.render() + admission_controller.render() + quote_server_pool.render(), mimetype='text/plain; version=0.0.4')
+
+# Profile every thread of this server process for the given number of seconds
+@app.route('/profile')
+def profile():
+    try:
+        profile_id, processes = GlobalProfile.start_all(float(request.args.get('seconds', 10)))
+    except (AssertionError, ValueError) as err:
+        return jsonify({'status': 'failure', 'message': str(err)})
+
+    path = os.path.join(PROFILE_DIR, 'profile-global-{}-<host>-<pid>-<date>-<time>.folded'.format(profile_id))
+    return jsonify({'status': 'success', 'message': 'Profiling {} processes, writing stacks to {}'.format(processes, path), 'processes': processes, 'pid': os.getpid()})
+
+app.register_blueprint(commands.bp)
+
+# Ensure the indexes used by queries exist
+commands.db.create_indexes()
+
+# Recover and start checkpointing account state held in Redis, if enabled
+if ACCOUNT_STATE_MODE == 'redis':
+    account_store.start()
+
+# Profile this process whenever any process is asked to
+profile_listener.start()
+
+# Start executing BUY/SELL triggers in the background
+trigger_engine.start()
+
+# Pre-render the XML of sealed log windows in the background, if enabled
+if LOG_SEGMENTS:
+    log_segmenter.start()
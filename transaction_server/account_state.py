@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+'''
+Optional write-behind account state, enabled with ACCOUNT_STATE_MODE=redis.
+
+Each account's balance, holdings, reserves and triggers are held in a Redis
+hash and mutated by Lua scripts, so every check-and-update is atomic and takes
+a single round-trip. Mutated accounts are added to a dirty set, and a
+background checkpointer writes them to the Mongo accounts collection in bulk.
+Only one process checkpoints at a time, holding a lock in Redis, which it
+renews before each bulk write and stops writing if it lost.
+
+On startup, accounts that were dirty or mid-checkpoint when a process stopped
+are written to Mongo before the server starts serving, so no state is lost as
+long as Redis itself persists it.
+
+Account hash layout (account:<userid>):
+    balance                     float
+    stocks:<SYM>                float
+    reserve_buy:<SYM>           float
+    reserve_sell:<SYM>          float
+    buy_triggers:<SYM>          float, or '' for no price
+    sell_triggers:<SYM>         float, or '' for no price
+    trigger_tx_nums:<TYPE>:<SYM> int, or '' if unknown
+'''
+import os
+import threading
+import time
+import traceback
+from transaction_server.cache import cache as redis_client, lock_token, release_lock, renew_lock
+from transaction_server.leader import leader
+from transaction_server.db import DB
+from transaction_server.instrumentation import instrument_class
+
+ACCOUNT_STATE_MODE = os.environ.get('ACCOUNT_STATE_MODE', 'mongo') # mongo or redis
+ACCOUNT_CHECKPOINT_INTERVAL = float(os.environ.get('ACCOUNT_CHECKPOINT_INTERVAL', 1)) # seconds
+ACCOUNT_CHECKPOINT_BATCH_SIZE = int(os.environ.get('ACCOUNT_CHECKPOINT_BATCH_SIZE', 500))
+ACCOUNT_CHECKPOINT_LOCK_TTL = 30 # seconds, renewed before each bulk write
+
+ACCOUNT_KEY = 'account:{}'
+DIRTY_ACCOUNTS_KEY = 'accounts:dirty'
+CHECKPOINTING_ACCOUNTS_KEY = 'accounts:checkpointing'
+CHECKPOINT_LOCK_KEY = 'accounts:checkpoint_lock'
+LOADED_FIELD = '_loaded'
+MAP_FIELDS = ['stocks', 'reserve_buy', 'reserve_sell', 'buy_triggers', 'sell_triggers']
+PRICE_FIELDS = ['buy_triggers', 'sell_triggers']
+
+# Writes the account fields, unless the account is already loaded.
+LOAD_SCRIPT = '''
+if redis.call('EXISTS', KEYS[1]) == 1 then return 0 end
+redis.call('HSET', KEYS[1], unpack(ARGV))
+return 1
+'''
+
+# ARGV: user_id, amount, create. Returns the new balance.
+DEPOSIT_SCRIPT = '''
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    if ARGV[3] ~= '1' then return false end
+    redis.call('HSET', KEYS[1], '_loaded', '1', 'balance', '0')
+end
+local balance = redis.call('HINCRBYFLOAT', KEYS[1], 'balance', ARGV[2])
+redis.call('SADD', KEYS[2], ARGV[1])
+return balance
+'''
+
+# ARGV: user_id, field, amount, credit field or '', unset if zero.
+# Debits the field only if it covers the amount. Returns the field's new value.
+DEBIT_SCRIPT = '''
+local current = tonumber(redis.call('HGET', KEYS[1], ARGV[2]))
+if current == nil or current < tonumber(ARGV[3]) then return false end
+local remaining = redis.call('HINCRBYFLOAT', KEYS[1], ARGV[2], '-' .. ARGV[3])
+if ARGV[4] ~= '' then redis.call('HINCRBYFLOAT', KEYS[1], ARGV[4], ARGV[3]) end
+if ARGV[5] == '1' and tonumber(remaining) == 0 then redis.call('HDEL', KEYS[1], ARGV[2]) end
+redis.call('SADD', KEYS[2], ARGV[1])
+return remaining
+'''
+
+# ARGV: user_id, field, amount. Returns the field's new value.
+INCREMENT_SCRIPT = '''
+if redis.call('EXISTS', KEYS[1]) == 0 then return false end
+local value = redis.call('HINCRBYFLOAT', KEYS[1], ARGV[2], ARGV[3])
+redis.call('SADD', KEYS[2], ARGV[1])
+return value
+'''
+
+# ARGV: user_id, field, value, field, value... Returns {matched, modified}:
+# 1 if the account exists, 1 if any of the values changed.
+SET_FIELDS_SCRIPT = '''
+if redis.call('EXISTS', KEYS[1]) == 0 then return {0, 0} end
+local modified = 0
+for i = 2, #ARGV, 2 do
+    if redis.call('HGET', KEYS[1], ARGV[i]) ~= ARGV[i + 1] then modified = 1 end
+end
+if modified == 1 then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+    redis.call('SADD', KEYS[2], ARGV[1])
+end
+return {1, modified}
+'''
+
+# ARGV: user_id, field... Returns {matched, modified}: 1 if the account
+# exists, 1 if any of the fields was removed.
+DELETE_FIELDS_SCRIPT = '''
+if redis.call('EXISTS', KEYS[1]) == 0 then return {0, 0} end
+local removed = redis.call('HDEL', KEYS[1], unpack(ARGV, 2))
+if removed > 0 then redis.call('SADD', KEYS[2], ARGV[1]) end
+return {1, math.min(removed, 1)}
+'''
+
+# ARGV: user_id, trigger field, price, reserve field, amount, target field, tx num field.
+# Executes the trigger only if its price and reserve are unchanged.
+EXECUTE_TRIGGER_SCRIPT = '''
+local price = tonumber(redis.call('HGET', KEYS[1], ARGV[2]))
+local amount = tonumber(redis.call('HGET', KEYS[1], ARGV[4]))
+if price == nil or amount == nil or price ~= tonumber(ARGV[3]) or amount ~= tonumber(ARGV[5]) then return 0 end
+redis.call('HINCRBYFLOAT', KEYS[1], ARGV[6], ARGV[5])
+redis.call('HDEL', KEYS[1], ARGV[2], ARGV[4], ARGV[7])
+redis.call('SADD', KEYS[2], ARGV[1])
+return 1
+'''
+
+# Moves up to ARGV[1] dirty accounts to the checkpointing set and returns them.
+CLAIM_DIRTY_SCRIPT = '''
+local user_ids = redis.call('SPOP', KEYS[1], ARGV[1])
+if #user_ids > 0 then redis.call('SADD', KEYS[2], unpack(user_ids)) end
+return user_ids
+'''
+
+
+def encode_account(account):
+    '''
+    Returns the account document as a flat list of hash fields and values.
+    '''
+    values = [LOADED_FIELD, '1', 'balance', repr(float(account.get('balance', 0.0)))]
+    for field in MAP_FIELDS:
+        for stock_symbol, value in account.get(field, {}).items():
+            values.extend(['{}:{}'.format(field, stock_symbol), '' if value is None else repr(float(value))])
+    for trigger_type, tx_nums in account.get('trigger_tx_nums', {}).items():
+        for stock_symbol, tx_num in tx_nums.items():
+            values.extend(['trigger_tx_nums:{}:{}'.format(trigger_type, stock_symbol), '' if tx_num is None else str(tx_num)])
+    return values
+
+
+def decode_account(user_id, values):
+    '''
+    Returns the account document stored in the hash values, in the same
+    shape as documents in the accounts collection.
+    '''
+    account = {'userid': user_id, 'balance': 0.0, 'trigger_tx_nums': {}}
+    account.update({field: {} for field in MAP_FIELDS})
+    for key, value in values.items():
+        key, value = key.decode('utf-8'), value.decode('utf-8')
+        field, _, stock_symbol = key.partition(':')
+        if field == 'balance':
+            account['balance'] = float(value)
+        elif field == 'trigger_tx_nums':
+            trigger_type, _, stock_symbol = stock_symbol.partition(':')
+            account['trigger_tx_nums'].setdefault(trigger_type, {})[stock_symbol] = int(value) if value else None
+        elif field in PRICE_FIELDS:
+            account[field][stock_symbol] = float(value) if value else None
+        elif field in MAP_FIELDS:
+            account[field][stock_symbol] = float(value)
+    return account
+
+
+class CheckpointLockLost(Exception):
+    '''
+    The checkpoint lock expired and may be held by another process, so this
+    checkpoint must not write its snapshot over theirs.
+    '''
+
+
+class RedisAccountStore():
+    '''
+    Account store backed by Redis hashes, with the same account methods as
+    DB. Accounts not yet in Redis are loaded from Mongo on first use.
+    '''
+
+    def __init__(self, db):
+        self.db = db
+        self._loaded = set()
+        self._thread = None
+        self._load = redis_client.register_script(LOAD_SCRIPT)
+        self._deposit = redis_client.register_script(DEPOSIT_SCRIPT)
+        self._debit = redis_client.register_script(DEBIT_SCRIPT)
+        self._increment = redis_client.register_script(INCREMENT_SCRIPT)
+        self._set_fields = redis_client.register_script(SET_FIELDS_SCRIPT)
+        self._delete_fields = redis_client.register_script(DELETE_FIELDS_SCRIPT)
+        self._execute_trigger = redis_client.register_script(EXECUTE_TRIGGER_SCRIPT)
+        self._claim_dirty = redis_client.register_script(CLAIM_DIRTY_SCRIPT)
+
+    def get_account(self, user_id):
+        '''
+        Get details for the account specified by the user_id. Returns dict if account found,
+        otherwise None.
+        '''
+        assert type(user_id) == str
+
+        if not self._ensure_loaded(user_id):
+            return None
+        return decode_account(user_id, redis_client.hgetall(ACCOUNT_KEY.format(user_id)))
+
+    def get_account_fields(self, user_id, fields):
+        '''
+        Same as get_account, as the whole hash is read in a single round-trip anyway.
+        '''
+        return self.get_account(user_id)
+
+    def deposit(self, user_id, amount, create=False):
+        assert type(user_id) == str
+        assert type(amount) == float
+        assert amount >= 0
+
+        if not self._ensure_loaded(user_id) and not create:
+            return None
+        return self._float(self._deposit(keys=self._keys(user_id), args=[user_id, repr(amount), '1' if create else '0']))
+
+    def withdraw(self, user_id, amount):
+        assert type(user_id) == str
+        assert type(amount) == float
+        assert amount >= 0
+
+        if not self._ensure_loaded(user_id):
+            return None
+        return self._float(self._debit(keys=self._keys(user_id), args=[user_id, 'balance', repr(amount), '', '0']))
+
+    def add_stock(self, user_id, stock_symbol, amount):
+        return self._increment_field(user_id, 'stocks:{}'.format(stock_symbol), amount)
+
+    def remove_stock(self, user_id, stock_symbol, amount):
+        assert type(user_id) == str
+        assert type(stock_symbol) == str
+        assert type(amount) == float
+        assert amount >= 0
+
+        if not self._ensure_loaded(user_id):
+            return None
+        return self._float(self._debit(keys=self._keys(user_id), args=[user_id, 'stocks:{}'.format(stock_symbol), repr(amount), '', '1']))
+
+    def reserve_buy_amount(self, user_id, stock_symbol, amount):
+        assert type(user_id) == str
+        assert type(stock_symbol) == str
+        assert type(amount) == float
+        assert amount > 0
+
+        if not self._ensure_loaded(user_id):
+            return None
+        return self._float(self._debit(keys=self._keys(user_id), args=[user_id, 'balance', repr(amount), 'reserve_buy:{}'.format(stock_symbol), '0']))
+
+    def add_buy_reserve_amount(self, user_id, stock_symbol, amount):
+        return self._increment_counts(self._increment_field(user_id, 'reserve_buy:{}'.format(stock_symbol), amount), amount)
+
+    def unset_buy_reserve_amount(self, user_id, stock_symbol):
+        return self._delete(user_id, ['reserve_buy:{}'.format(stock_symbol)])
+
+    def add_sell_reserve_amount(self, user_id, stock_symbol, amount):
+        return self._increment_counts(self._increment_field(user_id, 'reserve_sell:{}'.format(stock_symbol), amount), amount)
+
+    def unset_sell_reserve_amount(self, user_id, stock_symbol):
+        return self._delete(user_id, ['reserve_sell:{}'.format(stock_symbol)])
+
+    def set_trigger(self, trigger_type, user_id, stock_symbol, price, tx_num=None):
+        assert trigger_type in ['BUY', 'SELL']
+        assert type(user_id) == str
+        assert type(stock_symbol) == str
+
+        if not self._ensure_loaded(user_id):
+            return 0, 0
+
+        trigger_field = '{}_triggers:{}'.format(trigger_type.lower(), stock_symbol)
+        tx_num_field = 'trigger_tx_nums:{}:{}'.format(trigger_type, stock_symbol)
+        args = [user_id, trigger_field, '' if price is None else repr(float(price)), tx_num_field, '' if tx_num is None else str(tx_num)]
+        matched, modified = self._set_fields(keys=self._keys(user_id), args=args)
+        return matched, modified
+
+    def unset_trigger(self, trigger_type, user_id, stock_symbol):
+        assert trigger_type in ['BUY', 'SELL']
+
+        fields = ['{}_triggers:{}'.format(trigger_type.lower(), stock_symbol), 'trigger_tx_nums:{}:{}'.format(trigger_type, stock_symbol)]
+        return self._delete(user_id, fields)
+
+    def get_armed_triggers(self):
+        '''
+        Returns every account with a trigger set. Pending state is checkpointed
+        first, so that the accounts collection can be scanned.
+        '''
+        self.checkpoint_all()
+        return self.db.get_armed_triggers()
+
+    def get_trigger_reserves(self, user_ids, stock_symbol):
+        assert type(user_ids) == list
+
+        # Triggers can cross before their accounts are used by this process.
+        for user_id in user_ids:
+            self._ensure_loaded(user_id)
+
+        fields = ['reserve_buy', 'reserve_sell', 'buy_triggers', 'sell_triggers']
+        pipeline = redis_client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipeline.hmget(ACCOUNT_KEY.format(user_id), ['{}:{}'.format(field, stock_symbol) for field in fields])
+
+        reserves = {}
+        for user_id, values in zip(user_ids, pipeline.execute()):
+            reserves[user_id] = {'userid': user_id}
+            for field, value in zip(fields, values):
+                reserves[user_id][field] = {}
+                if value is not None:
+                    reserves[user_id][field][stock_symbol] = float(value) if value else None
+        return reserves
+
+    def execute_triggers(self, stock_symbol, buy_fills, sell_fills):
+        '''
+        Executes crossed triggers, one script per trigger, in a single pipeline.
+        See DB.execute_triggers.
+        '''
+        for user_id, _, _ in buy_fills + sell_fills:
+            self._ensure_loaded(user_id)
+
+        pipeline = redis_client.pipeline(transaction=False)
+        for trigger_type, fills, target_field in [('BUY', buy_fills, 'stocks:{}'.format(stock_symbol)), ('SELL', sell_fills, 'balance')]:
+            for user_id, price, amount in fills:
+                args = [user_id, '{}_triggers:{}'.format(trigger_type.lower(), stock_symbol), repr(float(price)),
+                        'reserve_{}:{}'.format(trigger_type.lower(), stock_symbol), repr(float(amount)), target_field,
+                        'trigger_tx_nums:{}:{}'.format(trigger_type, stock_symbol)]
+                self._execute_trigger(keys=self._keys(user_id), args=args, client=pipeline)
+        return sum(pipeline.execute())
+
+    def get_balances(self, user_ids):
+        assert type(user_ids) == list
+
+        pipeline = redis_client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipeline.hget(ACCOUNT_KEY.format(user_id), 'balance')
+        return {user_id: float(balance) for user_id, balance in zip(user_ids, pipeline.execute()) if balance is not None}
+
+    def start(self):
+        '''
+        Recovers state left unflushed by a previous run, then starts the
+        background checkpointer, which only checkpoints while this process
+        holds the leader lease.
+        '''
+        if self._thread is not None:
+            return
+
+        self.recover()
+        leader.start()
+        self._thread = threading.Thread(target=self._run, name='account-checkpointer', daemon=True)
+        self._thread.start()
+
+    def recover(self):
+        '''
+        Writes every account that was dirty, or claimed by a checkpoint that
+        never finished, to Mongo.
+        '''
+        token = self._acquire_checkpoint_lock()
+        while token is None:
+            time.sleep(ACCOUNT_CHECKPOINT_INTERVAL)
+            token = self._acquire_checkpoint_lock()
+
+        try:
+            # Holding the lock, no checkpoint is in progress: anything still
+            # claimed was left behind by a process that stopped mid-checkpoint.
+            redis_client.sunionstore(DIRTY_ACCOUNTS_KEY, [DIRTY_ACCOUNTS_KEY, CHECKPOINTING_ACCOUNTS_KEY])
+            redis_client.delete(CHECKPOINTING_ACCOUNTS_KEY)
+            while self.checkpoint(token) > 0:
+                pass
+        finally:
+            self._release_checkpoint_lock(token)
+
+    def checkpoint_all(self):
+        '''
+        Writes every dirty account to Mongo, waiting for the checkpoint lock.
+        '''
+        token = self._acquire_checkpoint_lock()
+        while token is None:
+            time.sleep(ACCOUNT_CHECKPOINT_INTERVAL / 10)
+            token = self._acquire_checkpoint_lock()
+
+        try:
+            while self.checkpoint(token) > 0:
+                pass
+        finally:
+            self._release_checkpoint_lock(token)
+
+    def checkpoint(self, token, batch_size=ACCOUNT_CHECKPOINT_BATCH_SIZE):
+        '''
+        Writes up to batch_size dirty accounts to Mongo in a single bulk write
+        and returns how many were written. Must hold the checkpoint lock with
+        token, which is renewed before writing; raises CheckpointLockLost,
+        leaving the accounts dirty, if it is no longer held.
+        '''
+        user_ids = [user_id.decode('utf-8') for user_id in self._claim_dirty(keys=[DIRTY_ACCOUNTS_KEY, CHECKPOINTING_ACCOUNTS_KEY], args=[batch_size])]
+        if not user_ids:
+            return 0
+
+        try:
+            pipeline = redis_client.pipeline(transaction=False)
+            for user_id in user_ids:
+                pipeline.hgetall(ACCOUNT_KEY.format(user_id))
+            accounts = [decode_account(user_id, values) for user_id, values in zip(user_ids, pipeline.execute()) if values]
+            # Another process may have taken over and written newer snapshots.
+            if not renew_lock(keys=[CHECKPOINT_LOCK_KEY], args=[token, int(ACCOUNT_CHECKPOINT_LOCK_TTL * 1000)]):
+                raise CheckpointLockLost('Checkpoint lock expired before writing {} accounts'.format(len(accounts)))
+            self.db.checkpoint_accounts(accounts)
+        except Exception:
+            # Leave the accounts dirty so that they are written next time.
+            redis_client.sadd(DIRTY_ACCOUNTS_KEY, *user_ids)
+            redis_client.srem(CHECKPOINTING_ACCOUNTS_KEY, *user_ids)
+            raise
+
+        redis_client.srem(CHECKPOINTING_ACCOUNTS_KEY, *user_ids)
+        return len(user_ids)
+
+    def _run(self):
+        while True:
+            time.sleep(ACCOUNT_CHECKPOINT_INTERVAL)
+            # The checkpoint lock still fences a leader that lost its lease.
+            if not leader.is_leader():
+                continue
+            token = self._acquire_checkpoint_lock()
+            if token is None:
+                continue
+
+            try:
+                while self.checkpoint(token) == ACCOUNT_CHECKPOINT_BATCH_SIZE:
+                    pass
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self._release_checkpoint_lock(token)
+
+    def _acquire_checkpoint_lock(self):
+        # Returns the lock's token if acquired, None otherwise.
+        token = lock_token()
+        if redis_client.set(CHECKPOINT_LOCK_KEY, token, nx=True, px=int(ACCOUNT_CHECKPOINT_LOCK_TTL * 1000)):
+            return token
+        return None
+
+    def _release_checkpoint_lock(self, token):
+        release_lock(keys=[CHECKPOINT_LOCK_KEY], args=[token])
+
+    def _ensure_loaded(self, user_id):
+        # Loads the account from Mongo into Redis, if it is not there yet.
+        # Returns False if the account exists in neither.
+        if user_id in self._loaded:
+            return True
+
+        key = ACCOUNT_KEY.format(user_id)
+        if not redis_client.exists(key):
+            account = self.db.get_account(user_id)
+            if account is None:
+                return False
+            self._load(keys=[key], args=encode_account(account))
+
+        self._loaded.add(user_id)
+        return True
+
+    def _increment_field(self, user_id, field, amount):
+        assert type(user_id) == str
+        assert type(amount) == float
+        assert amount >= 0
+
+        if not self._ensure_loaded(user_id):
+            return None
+        return self._float(self._increment(keys=self._keys(user_id), args=[user_id, field, repr(amount)]))
+
+    def _delete(self, user_id, fields):
+        # Returns (matched_count, modified_count) as the DB methods do.
+        assert type(user_id) == str
+
+        if not self._ensure_loaded(user_id):
+            return 0, 0
+        matched, modified = self._delete_fields(keys=self._keys(user_id), args=[user_id] + fields)
+        return matched, modified
+
+    @staticmethod
+    def _keys(user_id):
+        return [ACCOUNT_KEY.format(user_id), DIRTY_ACCOUNTS_KEY]
+
+    @staticmethod
+    def _float(value):
+        return float(value) if value is not None else None
+
+    @staticmethod
+    def _increment_counts(result, amount):
+        # (matched_count, modified_count) as returned by the DB methods, for
+        # which incrementing by 0 matches the account without modifying it.
+        if result is None:
+            return 0, 0
+        return 1, 1 if amount != 0 else 0
+
+
+instrument_class(RedisAccountStore, 'redis')
+
+db = DB()
+account_store = RedisAccountStore(db) if ACCOUNT_STATE_MODE == 'redis' else db
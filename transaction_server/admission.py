@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+'''
+Admission control for the command routes, enabled with ADMISSION_ENABLED=1.
+At most ADMISSION_MAX_CONCURRENT commands run at once in each process, and the
+rest wait in one of two lanes. Commands that finish a transaction the user has
+already started (COMMIT_* and CANCEL_*) wait in the priority lane, which is
+always admitted from first, so that work already invested in completes before
+new QUOTE, BUY or SELL commands are started.
+
+Rather than queueing without bound, a command is rejected at once with a 503
+and a Retry-After header when its expected wait exceeds ADMISSION_TARGET_WAIT
+or its lane already holds ADMISSION_MAX_QUEUE commands. Its expected wait is
+estimated from the commands ahead of it and the recent average command time.
+A command still waiting after ADMISSION_TARGET_WAIT (ADMISSION_PRIORITY_WAIT
+in the priority lane) is rejected the same way. Commands are idempotent, so
+clients can always retry them.
+
+Commands only wait here if gunicorn runs more threads per worker than
+ADMISSION_MAX_CONCURRENT; otherwise they queue, unseen, in gunicorn.
+'''
+from collections import deque
+import functools
+import math
+import os
+import threading
+import time
+from transaction_server.dispatcher import dispatcher
+from transaction_server.encoding import respond
+from transaction_server.logging import CommandType
+
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', '0') == '1'
+ADMISSION_MAX_CONCURRENT = int(os.environ.get('ADMISSION_MAX_CONCURRENT', 8)) # commands running per process
+ADMISSION_MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', 64)) # commands waiting per lane
+ADMISSION_TARGET_WAIT = float(os.environ.get('ADMISSION_TARGET_WAIT', 0.5)) # seconds
+ADMISSION_PRIORITY_WAIT = float(os.environ.get('ADMISSION_PRIORITY_WAIT', 2.0)) # seconds
+ADMISSION_SMOOTHING = 0.1 # weight of each command's time in the average
+PRIORITY_COMMANDS = [
+    CommandType.COMMIT_BUY, CommandType.CANCEL_BUY, CommandType.COMMIT_SELL, CommandType.CANCEL_SELL,
+    CommandType.CANCEL_SET_BUY, CommandType.CANCEL_SET_SELL,
+]
+LANES = ['priority', 'normal']
+SHED_MESSAGE = 'Server is overloaded, retry after {} seconds.'
+
+
+class AdmissionController():
+    '''
+    A limit on running commands with two lanes of waiting commands, and
+    counts of the commands admitted and shed from each lane.
+    '''
+
+    def __init__(self, max_concurrent=ADMISSION_MAX_CONCURRENT, max_queue=ADMISSION_MAX_QUEUE, target_wait=ADMISSION_TARGET_WAIT, priority_wait=ADMISSION_PRIORITY_WAIT):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = {'priority': priority_wait, 'normal': target_wait}
+        self.target_wait = target_wait
+        self.running = 0
+        self.command_time = None # seconds, moving average
+        self.waiting = {lane: deque() for lane in LANES}
+        self.admitted = {lane: 0 for lane in LANES}
+        self.shed = {lane: 0 for lane in LANES}
+        self._condition = threading.Condition()
+
+    def acquire(self, lane):
+        '''
+        Waits until a command in the lane may run. Returns None once it is
+        admitted, or the number of seconds to retry after if it is shed.
+        '''
+        with self._condition:
+            if self.running < self.max_concurrent and self._next() is None:
+                return self._admit(lane)
+
+            expected_wait = self.expected_wait(lane)
+            if len(self.waiting[lane]) >= self.max_queue or expected_wait > self.target_wait:
+                return self._shed(lane, expected_wait)
+
+            waiter = object()
+            self.waiting[lane].append(waiter)
+            deadline = time.time() + self.max_wait[lane]
+            while not (self.running < self.max_concurrent and self._next() is waiter):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.waiting[lane].remove(waiter)
+                    # The next waiter may now be at the head of the lanes.
+                    self._condition.notify_all()
+                    return self._shed(lane, self.expected_wait(lane))
+                self._condition.wait(remaining)
+
+            self.waiting[lane].popleft()
+            # Let the next waiter take any other free slot.
+            self._condition.notify_all()
+            return self._admit(lane)
+
+    def release(self, seconds):
+        '''
+        Frees the slot of a command that ran for seconds.
+        '''
+        with self._condition:
+            self.running -= 1
+            if self.command_time is None:
+                self.command_time = seconds
+            else:
+                self.command_time += ADMISSION_SMOOTHING * (seconds - self.command_time)
+            self._condition.notify_all()
+
+    def expected_wait(self, lane):
+        '''
+        Returns the seconds a command joining the lane would wait, if the
+        commands ahead of it take the average command time.
+        '''
+        ahead = len(self.waiting['priority']) + (len(self.waiting['normal']) if lane == 'normal' else 0)
+        return (ahead + 1) * (self.command_time or 0.0) / self.max_concurrent
+
+    def stats(self):
+        with self._condition:
+            return {
+                'running': self.running,
+                'max_concurrent': self.max_concurrent,
+                'command_time_ms': (self.command_time or 0.0) * 1000,
+                'lanes': {lane: {'waiting': len(self.waiting[lane]), 'admitted': self.admitted[lane], 'shed': self.shed[lane]} for lane in LANES},
+            }
+
+    def render(self):
+        '''
+        Returns the queue depths and admission counts in the Prometheus text
+        exposition format.
+        '''
+        stats = self.stats()
+        lines = [
+            '# HELP transaction_server_admission_running Commands running.',
+            '# TYPE transaction_server_admission_running gauge',
+            'transaction_server_admission_running {}'.format(stats['running']),
+        ]
+        for name, kind, description in [('waiting', 'gauge', 'Commands waiting to run.'), ('admitted', 'counter', 'Commands admitted.'), ('shed', 'counter', 'Commands rejected with 503.')]:
+            metric = 'transaction_server_admission_{}'.format(name if kind == 'gauge' else name + '_total')
+            lines.append('# HELP {} {}'.format(metric, description))
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            for lane in LANES:
+                lines.append('{}{{lane="{}"}} {}'.format(metric, lane, stats['lanes'][lane][name]))
+        return '\n'.join(lines) + '\n'
+
+    def _next(self):
+        for lane in LANES:
+            if self.waiting[lane]:
+                return self.waiting[lane][0]
+        return None
+
+    def _admit(self, lane):
+        self.running += 1
+        self.admitted[lane] += 1
+        return None
+
+    def _shed(self, lane, expected_wait):
+        self.shed[lane] += 1
+        return max(1, int(math.ceil(expected_wait)))
+
+
+admission_controller = AdmissionController()
+
+def lane_of(command_type):
+    return 'priority' if command_type in PRIORITY_COMMANDS else 'normal'
+
+def shed(response, retry_after):
+    '''
+    Marks the response of a shed command as a 503, to be retried after
+    retry_after seconds.
+    '''
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def admitted(command_type=None):
+    '''
+    Decorates a command route to run only once admitted, in the priority lane
+    if command_type is one of PRIORITY_COMMANDS, and to be rejected with a 503
+    if it is shed. Returns the route unchanged unless ADMISSION_ENABLED.
+    '''
+    def decorator(view):
+        if not ADMISSION_ENABLED:
+            return view
+
+        lane = lane_of(command_type)
+
+        @functools.wraps(view)
+        def admitted_view(*args, **kwargs):
+            # A command run by another command was admitted with it.
+            if dispatcher.in_worker():
+                return view(*args, **kwargs)
+
+            retry_after = admission_controller.acquire(lane)
+            if retry_after is not None:
+                return shed(respond({'status': 'failure', 'message': SHED_MESSAGE.format(retry_after)}), retry_after)
+
+            start = time.perf_counter()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                admission_controller.release(time.perf_counter() - start)
+        return admitted_view
+    return decorator
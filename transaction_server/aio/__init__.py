@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+'''
+Asyncio transaction server, serving the same /commands API as the Flask app
+from a single event loop per process. Run it with an ASGI server, e.g.:
+
+    hypercorn transaction_server.aio:app --bind 0.0.0.0:8000
+
+Importing this package also imports the transaction_server package, which
+starts the trigger engine and log writer threads shared by both servers.
+'''
+import asyncio
+import os
+from quart import Quart, Response, jsonify, request
+from transaction_server.admission import ADMISSION_ENABLED
+from transaction_server.aio import commands
+from transaction_server.aio.admission import admission_controller
+from transaction_server.aio.db import db
+from transaction_server.aio.quoteserver_client import AsyncQuoteServerClient, cache, pool
+from transaction_server.instrumentation import METRICS_ENABLED, metrics
+from transaction_server.logging import log_sink
+from transaction_server.profiling import PROFILE_DIR, GlobalProfile
+
+app = Quart(__name__)
+
+# Logs are recorded from the event loop, which must not wait for the log writer.
+log_sink.block = False
+
+# Ping server
+@app.route('/')
+async def ping():
+    return jsonify({'status': 'success', 'message': 'Transaction server is alive!'})
+
+# Quote cache statistics for this server
+@app.route('/quote_cache')
+async def quote_cache():
+    return jsonify({'status': 'success', 'quote_cache': AsyncQuoteServerClient.get_cache_stats()})
+
+# Admission queue depths and shed counts of this server process
+@app.route('/admission')
+async def admission():
+    return jsonify({'status': 'success', 'enabled': ADMISSION_ENABLED, 'admission': admission_controller.stats()})
+
+# Command durations and admission of this process, in the Prometheus text format
+if METRICS_ENABLED:
+    @app.route('/metrics')
+    async def prometheus_metrics():
+        return Response(metrics.render() + admission_controller.render(), mimetype='text/plain; version=0.0.4')
+
+# Profile every thread of this server process for the given number of seconds
+@app.route('/profile')
+async def profile():
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        profile_id, processes = await asyncio.get_running_loop().run_in_executor(None, GlobalProfile.start_all, seconds)
+    except (AssertionError, ValueError) as err:
+        return jsonify({'status': 'failure', 'message': str(err)})
+
+    path = os.path.join(PROFILE_DIR, 'profile-global-{}-<host>-<pid>-<date>-<time>.folded'.format(profile_id))
+    return jsonify({'status': 'success', 'message': 'Profiling {} processes, writing stacks to {}'.format(processes, path), 'processes': processes, 'pid': os.getpid()})
+
+app.register_blueprint(commands.bp)
+
+@app.before_serving
+async def connect():
+    # The Mongo client must be created from the event loop it is used in.
+    db.connect()
+
+@app.after_serving
+async def disconnect():
+    pool.clear()
+    await cache.close()
+    db.close_connection()
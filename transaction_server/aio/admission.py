@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+'''
+Same as transaction_server.admission, for the asyncio server, with the same
+lanes, limits and wait estimates. A waiting command awaits a future that is
+resolved when a slot is handed to it, instead of blocking a thread. Without
+admission control, the event loop runs every command it accepts at once, so
+ADMISSION_MAX_CONCURRENT is the only bound on the commands running in each
+process of this server.
+'''
+import asyncio
+import functools
+import time
+from transaction_server.admission import ADMISSION_ENABLED, LANES, SHED_MESSAGE, AdmissionController, lane_of, shed
+from transaction_server.aio.dispatcher import dispatcher
+from transaction_server.aio.encoding import respond
+
+
+class AsyncAdmissionController(AdmissionController):
+    '''
+    Same as AdmissionController, but a waiting command is a future in its
+    lane, and acquire() is a coroutine. Only used from the event loop.
+    '''
+
+    async def acquire(self, lane):
+        '''
+        Waits until a command in the lane may run. Returns None once it is
+        admitted, or the number of seconds to retry after if it is shed.
+        '''
+        if self.running < self.max_concurrent and self._next() is None:
+            return self._admit(lane)
+
+        expected_wait = self.expected_wait(lane)
+        if len(self.waiting[lane]) >= self.max_queue or expected_wait > self.target_wait:
+            return self._shed(lane, expected_wait)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiting[lane].append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait[lane])
+        except asyncio.TimeoutError:
+            # The slot may have been handed over just as the wait timed out.
+            if waiter.done():
+                return None
+            self.waiting[lane].remove(waiter)
+            return self._shed(lane, self.expected_wait(lane))
+        except BaseException:
+            # Cancelled, e.g. the client went away: give up the slot or the place in the lane.
+            if waiter.done():
+                self.running -= 1
+                self._hand_over()
+            else:
+                self.waiting[lane].remove(waiter)
+            raise
+        return None
+
+    def release(self, seconds):
+        super().release(seconds)
+        self._hand_over()
+
+    def _hand_over(self):
+        # Admits the commands at the head of the lanes into the free slots.
+        while self.running < self.max_concurrent:
+            lane = next((lane for lane in LANES if self.waiting[lane]), None)
+            if lane is None:
+                return
+            self._admit(lane)
+            self.waiting[lane].popleft().set_result(None)
+
+
+admission_controller = AsyncAdmissionController()
+
+def admitted(command_type=None):
+    '''
+    Decorates a command route to run only once admitted, in the priority lane
+    if command_type is one of PRIORITY_COMMANDS, and to be rejected with a 503
+    if it is shed. Returns the route unchanged unless ADMISSION_ENABLED.
+    '''
+    def decorator(view):
+        if not ADMISSION_ENABLED:
+            return view
+
+        lane = lane_of(command_type)
+
+        @functools.wraps(view)
+        async def admitted_view(*args, **kwargs):
+            # A command run by another command was admitted with it.
+            if dispatcher.in_command():
+                return await view(*args, **kwargs)
+
+            retry_after = await admission_controller.acquire(lane)
+            if retry_after is not None:
+                return shed(respond({'status': 'failure', 'message': SHED_MESSAGE.format(retry_after)}), retry_after)
+
+            start = time.perf_counter()
+            try:
+                return await view(*args, **kwargs)
+            finally:
+                admission_controller.release(time.perf_counter() - start)
+        return admitted_view
+    return decorator
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+'''
+Non-blocking counterpart of Cache for the asyncio server. Keys and values are
+the same as those of Cache, so pending transactions, quotes and command results
+are shared with the blocking server.
+'''
+from json import dumps, loads
+import redis.asyncio
+from transaction_server.cache import (
+    CACHE_COMMAND_RESULT_KEY, CACHE_PENDING_TX_KEY, CACHE_QUOTE_KEY, CACHE_QUOTE_LOCK_KEY, COMMAND_CLAIM_TTL, COMMAND_RESULT_TTL, COMMAND_RUNNING,
+    PENDING_TX_TTL, QUOTE_CACHE_TTL, QUOTE_LOCK_TTL, RELEASE_LOCK_SCRIPT, RENEW_LOCK_SCRIPT, REPLACE_LOCK_SCRIPT, lock_token
+)
+
+cache = redis.asyncio.StrictRedis(host='redis', port=6379)
+release_lock = cache.register_script(RELEASE_LOCK_SCRIPT)
+renew_lock = cache.register_script(RENEW_LOCK_SCRIPT)
+replace_lock = cache.register_script(REPLACE_LOCK_SCRIPT)
+
+class AsyncCache():
+    '''
+    Same as Cache, but every method is a coroutine.
+    '''
+
+    async def add_pending_transaction(self, user_id, tx_type, stock_symbol, amount, unix_timestamp):
+        assert type(user_id) == str
+        assert tx_type in ['BUY', 'SELL']
+        assert type(stock_symbol) == str
+        assert type(amount) == float
+        assert type(unix_timestamp) == float
+
+        element_to_insert = {'tx_type': tx_type, 'stock_symbol': stock_symbol, 'amount': amount, 'timestamp': unix_timestamp}
+        await cache.set(CACHE_PENDING_TX_KEY.format(tx_type, user_id), dumps(element_to_insert), ex=PENDING_TX_TTL)
+
+    async def get_pending_transaction(self, user_id, tx_type):
+        value = await cache.get(CACHE_PENDING_TX_KEY.format(tx_type, user_id))
+
+        # Convert to JSON
+        if value:
+            return loads(value)
+        return value
+
+    async def pop_pending_transaction(self, user_id, tx_type):
+        pipeline = cache.pipeline(transaction=True)
+        pipeline.get(CACHE_PENDING_TX_KEY.format(tx_type, user_id))
+        pipeline.delete(CACHE_PENDING_TX_KEY.format(tx_type, user_id))
+        value, _ = await pipeline.execute()
+
+        # Convert to JSON
+        if value:
+            return loads(value)
+        return value
+
+    async def delete_pending_transaction(self, user_id, tx_type):
+        return await cache.delete(CACHE_PENDING_TX_KEY.format(tx_type, user_id))
+
+    async def get_quote(self, stock_symbol):
+        value = await cache.get(CACHE_QUOTE_KEY.format(stock_symbol))
+        if value:
+            return loads(value)
+        return value
+
+    async def set_quote(self, stock_symbol, quote):
+        assert type(quote) == dict
+
+        await cache.set(CACHE_QUOTE_KEY.format(stock_symbol), dumps(quote), px=int(QUOTE_CACHE_TTL * 1000))
+
+    async def acquire_quote_lock(self, stock_symbol):
+        token = lock_token()
+        if await cache.set(CACHE_QUOTE_LOCK_KEY.format(stock_symbol), token, nx=True, px=int(QUOTE_LOCK_TTL * 1000)):
+            return token
+        return None
+
+    async def release_quote_lock(self, stock_symbol, token):
+        return await release_lock(keys=[CACHE_QUOTE_LOCK_KEY.format(stock_symbol)], args=[token])
+
+    async def claim_command(self, run_id, command, user_id, tx_num):
+        token = COMMAND_RUNNING.decode('utf-8') + lock_token()
+        if await cache.set(CACHE_COMMAND_RESULT_KEY.format(run_id, command, user_id, tx_num), token, nx=True, px=int(COMMAND_CLAIM_TTL * 1000)):
+            return token
+        return None
+
+    async def renew_command(self, run_id, command, user_id, tx_num, token):
+        return bool(await renew_lock(keys=[CACHE_COMMAND_RESULT_KEY.format(run_id, command, user_id, tx_num)], args=[token, int(COMMAND_CLAIM_TTL * 1000)]))
+
+    async def get_command_result(self, run_id, command, user_id, tx_num):
+        return await cache.get(CACHE_COMMAND_RESULT_KEY.format(run_id, command, user_id, tx_num))
+
+    async def set_command_result(self, run_id, command, user_id, tx_num, token, result):
+        return bool(await replace_lock(keys=[CACHE_COMMAND_RESULT_KEY.format(run_id, command, user_id, tx_num)], args=[token, result, int(COMMAND_RESULT_TTL * 1000)]))
+
+    async def release_command(self, run_id, command, user_id, tx_num, token):
+        return await release_lock(keys=[CACHE_COMMAND_RESULT_KEY.format(run_id, command, user_id, tx_num)], args=[token])
+
+    async def close(self):
+        await cache.close()
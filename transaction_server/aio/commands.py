@@ -0,0 +1,1194 @@
+#!/usr/bin/env python3
+'''
+Same API as the commands blueprint of transaction_server.commands, for the
+asyncio server. Handlers await the database, Redis and the quote server
+instead of blocking a worker thread, and independent reads are awaited
+together. Calls that can only block, such as recording trigger changes, run
+in the default executor. Routes are admitted, run in order per user,
+deduplicated, timed and profiled as in the Flask blueprint, by the asyncio
+counterparts of its decorators.
+'''
+import asyncio
+import time
+from quart import Blueprint, current_app, g, request
+from transaction_server.aio.admission import admitted
+from transaction_server.aio.cache import AsyncCache
+from transaction_server.aio.db import AsyncAccountLoader, account_store, db
+from transaction_server.aio.dispatcher import dispatched, dispatcher
+from transaction_server.aio.encoding import respond
+from transaction_server.aio.idempotency import idempotent
+from transaction_server.aio.instrumentation import instrumented
+from transaction_server.aio.profiling import profiled
+from transaction_server.aio.quoteserver_client import AsyncQuoteServerClient
+from transaction_server.commands import DUMPLOG_MERGE, batch_segments, quote_server_unavailable
+from transaction_server.idempotency import RUN_ID_HEADER
+from transaction_server.db import SUMMARY_PAGE_SIZE
+from transaction_server.log_segments import LOG_SEGMENTS, log_segmenter
+from transaction_server.logging import Logging, CommandType
+from transaction_server.triggers import trigger_engine
+
+bp = Blueprint('commands', __name__, url_prefix='/commands')
+cache = AsyncCache()
+
+def get_accounts():
+    '''
+    Returns the account loader for the current request, so that each account
+    is read from the database at most once per command.
+    '''
+    if 'accounts' not in g:
+        g.accounts = AsyncAccountLoader(account_store)
+    return g.accounts
+
+@bp.route('/add', methods=['GET'])
+@admitted(CommandType.ADD)
+@dispatched
+@idempotent
+@instrumented(CommandType.ADD)
+@profiled
+async def add():
+    '''
+	Add the given amount of money to the user's account. GET parameters are:
+        command_num: Command number
+        userid: Username
+        amount: Amount to add to username's account.
+
+    Pre-conditions:
+        None
+    Post-conditions:
+        The user's account is increased by the amount of money specified
+    '''
+    args = dict(request.args)
+    response = {'status': None}
+
+    try:
+        assert 'tx_num' in args, 'tx_num paramter not provided'
+        assert 'userid' in args, 'userid parameter not provided'
+        assert 'amount' in args, 'amount parameter not provided'
+
+        # If account does not exist, create.
+        tx_num = int(args['tx_num'])
+        user_id = args['userid']
+        amount = float(args['amount'])
+
+        Logging.log_debug(transactionNum=tx_num, command=CommandType.ADD, username=user_id)
+        balance = await get_accounts().deposit(user_id, amount, create=True)
+
+        # Log as AccountTransactionType with updated balance
+        Logging.log_account_transaction(transactionNum=tx_num, action='add', username=user_id, funds=float(balance))
+    except AssertionError as err:
+        response['status'] = 'failure'
+        response['message'] = str(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.ADD, errorMessage=str(err))
+        return respond(response)
+
+    Logging.log_user_command(transactionNum=tx_num, command=CommandType.ADD, username=user_id)
+    response['status'] = 'success'
+    response['matched_count'] = 1
+    response['modified_count'] = 1
+    return respond(response)
+
+@bp.route('/quote', methods=['GET'])
+@admitted(CommandType.QUOTE)
+@dispatched
+@idempotent
+@instrumented(CommandType.QUOTE)
+@profiled
+async def quote():
+    '''
+    Get the current quote for the stock for the specified user.
+
+    Pre-conditions:
+        None
+    Post-conditions:
+        The current price of the specified stock is displayed to the user
+    '''
+    args = dict(request.args)
+    response = {'status': None}
+
+    try:
+        assert 'tx_num' in args, 'tx_num paramter not provided'
+        assert 'userid' in args, 'userid parameter not provided'
+        assert 'stocksymbol' in args, 'stocksymbol parameter not provided'
+
+        tx_num = int(args['tx_num'])
+        user_id = args['userid']
+        stock_symbol = args['stocksymbol']
+
+        Logging.log_debug(transactionNum=tx_num, command=CommandType.QUOTE, username=user_id)
+    except AssertionError as err:
+        response['status'] = 'failure'
+        response['message'] = str(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.QUOTE, errorMessage=str(err))
+        return respond(response)
+
+    try:
+        price, symbol, username, timestamp, cryptokey = await AsyncQuoteServerClient.get_quote(stock_symbol, user_id, tx_num, allow_stale=True)
+    except OSError as err:
+        response['status'] = 'failure'
+        response['message'] = 'Quote server unavailable: {}'.format(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.QUOTE, errorMessage=response['message'])
+        return quote_server_unavailable(respond(response))
+
+    Logging.log_user_command(transactionNum=tx_num, command=CommandType.QUOTE, username=user_id)
+    response['status'] = 'success'
+    response['price'] = price
+    response['symbol'] = symbol
+    response['username'] = username
+    response['timestamp'] = timestamp
+    response['cryptokey'] = cryptokey
+    return respond(response)
+
+@bp.route('/buy', methods=['GET'])
+@admitted(CommandType.BUY)
+@dispatched
+@idempotent
+@instrumented(CommandType.BUY)
+@profiled
+async def buy():
+    '''
+    Buy the dollar amount of the stock for the specified user at the current price.
+
+    Pre-conditions:
+        The user's account must be greater or equal to the amount of the purchase.
+    Post-conditions:
+        The user is asked to confirm or cancel the transaction
+    '''
+    args = dict(request.args)
+    response = {'status': None}
+
+    try:
+        assert 'tx_num' in args, 'tx_num paramter not provided'
+        assert 'userid' in args, 'userid parameter not provided'
+        assert 'stocksymbol' in args, 'stocksymbol parameter not provided'
+        assert 'amount' in args, 'amount parameter not provided'
+
+        tx_num = int(args['tx_num'])
+        userid = args['userid']
+        stocksymbol = args['stocksymbol']
+        amount = float(args['amount'])
+
+        Logging.log_debug(transactionNum=tx_num, command=CommandType.BUY, username=userid)
+    except AssertionError as err:
+        response['status'] = 'failure'
+        response['message'] = str(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.BUY, errorMessage=str(err))
+        return respond(response)
+
+    # Read the balance and get the quote for the stock at the same time.
+    try:
+        account, (price, symbol, username, timestamp, cryptokey) = await asyncio.gather(
+            get_accounts().get(userid, ['balance']),
+            AsyncQuoteServerClient.get_quote(stocksymbol, userid, tx_num)
+        )
+    except OSError as err:
+        response['status'] = 'failure'
+        response['message'] = 'Quote server unavailable: {}'.format(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.BUY, errorMessage=response['message'])
+        return quote_server_unavailable(respond(response))
+
+    # Ensure account exists and balance is sufficient.
+    if account is None:
+        response['status'] = 'failure'
+        response['message'] = 'Account does not exist.'
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.BUY, errorMessage=response['message'])
+        return respond(response)
+
+    # Get account balance
+    balance = account['balance']
+    if balance < amount:
+        response['status'] = 'failure'
+        response['message'] = 'Not enough money in account to buy.'
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.BUY, errorMessage=response['message'])
+        return respond(response)
+
+    # Determine nearest whole number of shares that can be bought.
+    shares_to_buy = amount//price
+
+    # Add transaction as pending confirmation from user, replacing any previous pending transaction
+    await cache.add_pending_transaction(userid, 'BUY', stocksymbol, amount, time.time()) # (shares_to_buy * price)
+
+    Logging.log_user_command(transactionNum=tx_num, command=CommandType.BUY, username=args['userid'])
+
+    response['status'] = 'success'
+    response['message'] = 'Successfully registered pending transaction. Confirm buy within 60 seconds.'
+    response['price'] = price
+    response['shares_to_buy'] = shares_to_buy
+    response['symbol'] = symbol
+    response['username'] = username
+    response['timestamp'] = timestamp
+    response['cryptokey'] = cryptokey
+    return respond(response)
+
+@bp.route('/commit_buy', methods=['GET'])
+@admitted(CommandType.COMMIT_BUY)
+@dispatched
+@idempotent
+@instrumented(CommandType.COMMIT_BUY)
+@profiled
+async def commit_buy():
+    '''
+	Commits the most recently executed BUY command.
+
+    Pre-conditions:
+        The user must have executed a BUY command within the previous 60 seconds.
+    Post-conditions:
+        (a) The user's cash account is decreased by the amount used to purchase the stock
+        (b) the user's account for the given stock is increased by the purchase amount
+    '''
+    args = dict(request.args)
+    response = {'status': None}
+
+    try:
+        assert 'tx_num' in args, 'tx_num paramter not provided'
+        assert 'userid' in args, 'userid parameter not provided'
+
+        tx_num = int(args['tx_num'])
+        user_id = args['userid']
+
+        Logging.log_debug(transactionNum=tx_num, command=CommandType.COMMIT_BUY, username=user_id)
+    except AssertionError as err:
+        response['status'] = 'failure'
+        response['message'] = str(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.COMMIT_BUY, errorMessage=response['message'])
+        return respond(response)
+
+    # Ensure latest buy command exists and is less than 60 seconds old, claiming it so it is only committed once.
+    pending_transaction = await cache.pop_pending_transaction(user_id, 'BUY')
+    if not pending_transaction:
+        response['status'] = 'failure'
+        response['message'] = 'No pending BUY transaction found.'
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.COMMIT_BUY, errorMessage=response['message'])
+        return respond(response)
+
+    original_timestamp = pending_transaction['timestamp']
+    stock_symbol = pending_transaction['stock_symbol']
+    amount = pending_transaction['amount'] # Total share value being bought.
+    tx_type = pending_transaction['tx_type']
+
+    current_timestamp = time.time()
+    if (current_timestamp - original_timestamp) > 60:
+        response['status'] = 'failure'
+        response['message'] = 'Most recent BUY command is more than 60 seconds old.'
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.COMMIT_BUY, errorMessage=response['message'])
+        return respond(response)
+
+    # Reduce account balance by specified amount, only if the balance still covers it.
+    balance = await get_accounts().withdraw(user_id, amount)
+    if balance is None:
+        response['status'] = 'failure'
+        response['message'] = 'Not enough money in account to buy.'
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.COMMIT_BUY, errorMessage=response['message'])
+        return respond(response)
+
+    # Log as AccountTransactionType with updated balance
+    Logging.log_account_transaction(transactionNum=tx_num, action='remove', username=user_id, funds=float(balance))
+
+    # Increase account amount of stock owned
+    await get_accounts().add_stock(user_id, stock_symbol, amount)
+
+    # Record the committed transaction for DISPLAY_SUMMARY
+    await db.log_transaction(user_id, tx_type, stock_symbol, amount, original_timestamp)
+
+    Logging.log_user_command(transactionNum=tx_num, command=CommandType.COMMIT_BUY, username=user_id)
+
+    response['status'] = 'success'
+    response['message'] = 'Successfully commited BUY transaction for {} for amount {}'.format(stock_symbol, amount)
+    response['matched_count'] = 1
+    response['modified_count'] = 1
+    return respond(response)
+
+
+@bp.route('/cancel_buy', methods=['GET'])
+@admitted(CommandType.CANCEL_BUY)
+@dispatched
+@idempotent
+@instrumented(CommandType.CANCEL_BUY)
+@profiled
+async def cancel_buy():
+    '''
+	Cancels the most recently executed BUY Command
+
+    Pre-conditions:
+        The user must have executed a BUY command within the previous 60 seconds
+    Post-conditions:
+        The last BUY command is canceled and any allocated system resources are reset and released.
+    '''
+    args = dict(request.args)
+    response = {'status': None}
+
+    try:
+        assert 'tx_num' in args, 'tx_num paramter not provided'
+        assert 'userid' in args, 'userid parameter not provided'
+
+        tx_num = int(args['tx_num'])
+        userid = args['userid']
+
+        Logging.log_debug(transactionNum=tx_num, command=CommandType.CANCEL_BUY, username=userid)
+    except AssertionError as err:
+        response['status'] = 'failure'
+        response['message'] = str(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.CANCEL_BUY, errorMessage=response['message'])
+        return respond(response)
+
+    # Ensure latest buy command exists and is less than 60 seconds old.
+    pending_transaction = await cache.get_pending_transaction(userid, 'BUY')
+    if not pending_transaction:
+        response['status'] = 'failure'
+        response['message'] = 'No pending BUY transaction found.'
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.CANCEL_BUY, errorMessage=response['message'])
+        return respond(response)
+
+    original_timestamp = pending_transaction['timestamp']
+
+    current_timestamp = time.time()
+    if (current_timestamp - original_timestamp) > 60:
+        response['status'] = 'failure'
+        response['message'] = 'Most recent BUY command is more than 60 seconds old.'
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.CANCEL_BUY, errorMessage=response['message'])
+        return respond(response)
+
+    Logging.log_user_command(transactionNum=tx_num, command=CommandType.CANCEL_BUY, username=userid)
+
+    # Delete pending BUY transaction such that COMMIT_BUY will not find any pending transactions.
+    deleted_count = await cache.delete_pending_transaction(userid, 'BUY')
+    response['status'] = 'success'
+    response['message'] = 'Successfully cancelled {} BUY transactions'.format(deleted_count)
+    return respond(response)
+
+
+@bp.route('/sell', methods=['GET'])
+@admitted(CommandType.SELL)
+@dispatched
+@idempotent
+@instrumented(CommandType.SELL)
+@profiled
+async def sell():
+    '''
+    Sell the specified dollar mount of the stock currently held by the specified user at the current price.
+
+    Pre-conditions:
+        The user's account for the given stock must be greater than or equal to the amount being sold.
+    Post-conditions:
+        The user is asked to confirm or cancel the given transaction
+    '''
+    args = dict(request.args)
+    response = {'status': None}
+
+    try:
+        assert 'tx_num' in args, 'tx_num paramter not provided'
+        assert 'userid' in args, 'userid parameter not provided'
+        assert 'stocksymbol' in args, 'stocksymbol parameter not provided'
+        assert 'amount' in args, 'amount parameter not provided'
+
+        tx_num = int(args['tx_num'])
+        userid = args['userid']
+        stocksymbol = args['stocksymbol']
+        amount = float(args['amount'])
+
+        Logging.log_debug(transactionNum=tx_num, command=CommandType.SELL, username=userid)
+    except AssertionError as err:
+        response['status'] = 'failure'
+        response['message'] = str(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.SELL, errorMessage=response['message'])
+        return respond(response)
+
+    # Read the stocks owned and get the quote for the stock at the same time.
+    try:
+        account, (price, symbol, username, timestamp, cryptokey) = await asyncio.gather(
+            get_accounts().get(userid, ['stocks']),
+            AsyncQuoteServerClient.get_quote(stocksymbol, userid, tx_num)
+        )
+    except OSError as err:
+        response['status'] = 'failure'
+        response['message'] = 'Quote server unavailable: {}'.format(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.SELL, errorMessage=response['message'])
+        return quote_server_unavailable(respond(response))
+
+    # Ensure account exists and user owns enough stock to sell at the price specified.
+    if account is None:
+        response['status'] = 'failure'
+        response['message'] = 'Account does not exist.'
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.SELL, errorMessage=response['message'])
+        return respond(response)
+
+    # Ensure user owns sufficient amount of stock at the current price.
+    user_stocks = account['stocks']
+    if stocksymbol not in user_stocks:
+        response['status'] = 'failure'
+        response['message'] = 'User does not own any {} stock'.format(stocksymbol)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.SELL, errorMessage=response['message'])
+        return respond(response)
+
+    total_share_value = amount * price
+
+    if amount > user_stocks[stocksymbol]: # total_share_value
+        response['status'] = 'failure'
+        #response['message'] = 'Not enough stock owned at current price to sell. Current price: {}, Total share value: {}, Requested amount: {}'.format(price, total_share_value, amount)
+        response['message'] = 'Not enough stock owned to sell'
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.SELL, errorMessage=response['message'])
+        return respond(response)
+
+    # Add transaction as pending confirmation from user, replacing any previous pending transaction
+    await cache.add_pending_transaction(userid, 'SELL', stocksymbol, amount, time.time())
+
+    Logging.log_user_command(transactionNum=tx_num, command=CommandType.SELL, username=userid)
+    response['status'] = 'success'
+    response['message'] = 'Successfully registered pending transaction. Confirm sell within 60 seconds.'
+    response['price'] = price
+    response['symbol'] = symbol
+    response['username'] = username
+    response['timestamp'] = timestamp
+    response['cryptokey'] = cryptokey
+    return respond(response)
+
+@bp.route('/commit_sell', methods=['GET'])
+@admitted(CommandType.COMMIT_SELL)
+@dispatched
+@idempotent
+@instrumented(CommandType.COMMIT_SELL)
+@profiled
+async def commit_sell():
+    '''
+	Commits the most recently executed SELL command
+
+    Pre-conditions:
+        The user must have executed a SELL command within the previous 60 seconds
+    Post-conditions:
+        (a) the user's account for the given stock is decremented by the sale amount
+        (b) the user's cash account is increased by the sell amount
+    '''
+    args = dict(request.args)
+    response = {'status': None}
+    try:
+        assert 'tx_num' in args, 'tx_num paramter not provided'
+        assert 'userid' in args, 'userid parameter not provided'
+
+        tx_num = int(args['tx_num'])
+        user_id = args['userid']
+
+        Logging.log_debug(transactionNum=tx_num, command=CommandType.COMMIT_SELL, username=user_id)
+    except AssertionError as err:
+        response['status'] = 'failure'
+        response['message'] = str(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.COMMIT_SELL, errorMessage=response['message'])
+        return respond(response)
+
+    # Ensure latest sell command exists and is less than 60 seconds old, claiming it so it is only committed once.
+    pending_transaction = await cache.pop_pending_transaction(user_id, 'SELL')
+    if not pending_transaction:
+        response['status'] = 'failure'
+        response['message'] = 'No pending SELL transaction found.'
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.COMMIT_SELL, errorMessage=response['message'])
+        return respond(response)
+
+    original_timestamp = pending_transaction['timestamp']
+    stock_symbol = pending_transaction['stock_symbol']
+    amount = pending_transaction['amount']
+    tx_type = pending_transaction['tx_type']
+
+    current_timestamp = time.time()
+    if (current_timestamp - original_timestamp) > 60:
+        response['status'] = 'failure'
+        response['message'] = 'Most recent SELL command is more than 60 seconds old.'
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.COMMIT_SELL, errorMessage=response['message'])
+        return respond(response)
+
+    # Decrease account amount of stock owned, only if the user still owns enough.
+    if await get_accounts().remove_stock(user_id, stock_symbol, amount) is None:
+        response['status'] = 'failure'
+        response['message'] = 'Not enough stock owned to sell'
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.COMMIT_SELL, errorMessage=response['message'])
+        return respond(response)
+
+    # Increase account balance by specified amount
+    balance = await get_accounts().deposit(user_id, amount)
+
+    # Record the committed transaction for DISPLAY_SUMMARY
+    await db.log_transaction(user_id, tx_type, stock_symbol, amount, original_timestamp)
+
+    # Log as AccountTransactionType with updated balance
+    Logging.log_account_transaction(transactionNum=tx_num, action='add', username=user_id, funds=float(balance))
+
+    Logging.log_user_command(transactionNum=tx_num, command=CommandType.COMMIT_SELL, username=user_id)
+    response['status'] = 'success'
+    response['message'] = 'Successfully commited SELL transaction for {} for amount {}'.format(stock_symbol, amount)
+    response['matched_count'] = 1
+    response['modified_count'] = 1
+    return respond(response)
+
+@bp.route('/cancel_sell', methods=['GET'])
+@admitted(CommandType.CANCEL_SELL)
+@dispatched
+@idempotent
+@instrumented(CommandType.CANCEL_SELL)
+@profiled
+async def cancel_sell():
+    '''
+	Cancels the most recently executed SELL Command
+
+    Pre-conditions:
+        The user must have executed a SELL command within the previous 60 seconds
+    Post-conditions:
+        The last SELL command is canceled and any allocated system resources are reset and released.
+    '''
+    args = dict(request.args)
+    response = {'status': None}
+
+    try:
+        assert 'tx_num' in args, 'tx_num paramter not provided'
+        assert 'userid' in args, 'userid parameter not provided'
+
+        tx_num = int(args['tx_num'])
+        userid = args['userid']
+
+        Logging.log_debug(transactionNum=tx_num, command=CommandType.CANCEL_SELL, username=userid)
+    except AssertionError as err:
+        response['status'] = 'failure'
+        response['message'] = str(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.CANCEL_SELL, errorMessage=response['message'])
+        return respond(response)
+
+    # Ensure latest sell command exists and is less than 60 seconds old.
+    pending_transaction = await cache.get_pending_transaction(userid, 'SELL')
+    if not pending_transaction:
+        response['status'] = 'failure'
+        response['message'] = 'No pending SELL transaction found.'
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.CANCEL_SELL, errorMessage=response['message'])
+        return respond(response)
+
+    original_timestamp = pending_transaction['timestamp']
+
+    current_timestamp = time.time()
+    if (current_timestamp - original_timestamp) > 60:
+        response['status'] = 'failure'
+        response['message'] = 'Most recent SELL command is more than 60 seconds old.'
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.CANCEL_SELL, errorMessage=response['message'])
+        return respond(response)
+
+    Logging.log_user_command(transactionNum=tx_num, command=CommandType.CANCEL_SELL, username=userid)
+
+    # Delete pending SELL transaction such that COMMIT_SELL will not find any pending transactions.
+    deleted_count = await cache.delete_pending_transaction(userid, 'SELL')
+    response['status'] = 'success'
+    response['message'] = 'Successfully cancelled {} SELL transactions'.format(deleted_count)
+    return respond(response)
+
+@bp.route('/set_buy_amount', methods=['GET'])
+@admitted(CommandType.SET_BUY_AMOUNT)
+@dispatched
+@idempotent
+@instrumented(CommandType.SET_BUY_AMOUNT)
+@profiled
+async def set_buy_amount():
+    '''
+    Sets a defined amount of the given stock to buy when the current stock price is less than or equal to the BUY_TRIGGER
+
+    Pre-conditions:
+        The user's cash account must be greater than or equal to the BUY amount at the time the transaction occurs
+    Post-conditions:
+        (a) a reserve account is created for the BUY transaction to hold the specified amount in reserve for when the transaction is triggered
+        (b) the user's cash account is decremented by the specified amount
+        (c) when the trigger point is reached the user's stock account is updated to reflect the BUY transaction.
+    '''
+    args = dict(request.args)
+    response = {'status': None}
+
+    try:
+        assert 'tx_num' in args, 'tx_num paramter not provided'
+        assert 'userid' in args, 'userid parameter not provided'
+        assert 'stocksymbol' in args, 'stocksymbol parameter not provided'
+        assert 'amount' in args, 'amount parameter not provided'
+
+        tx_num = int(args['tx_num'])
+        user_id = args['userid']
+        stock_symbol = args['stocksymbol']
+        amount = float(args['amount'])
+
+        Logging.log_debug(transactionNum=tx_num, command=CommandType.SET_BUY_AMOUNT, username=user_id)
+    except AssertionError as err:
+        response['status'] = 'failure'
+        response['message'] = str(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.SET_BUY_AMOUNT, errorMessage=response['message'])
+        return respond(response)
+
+    # Remove money from account and set aside in reserve account, only if the user has enough cash.
+    # TODO: Replace any other existing buy amounts or just increment?
+    if await get_accounts().reserve_buy_amount(user_id, stock_symbol, amount) is None:
+        response['status'] = 'failure'
+        response['message'] = 'Not enough money in account for set buy amount.'
+
+         # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.SET_BUY_AMOUNT, errorMessage=response['message'])
+        return respond(response)
+
+    Logging.log_user_command(transactionNum=tx_num, command=CommandType.SET_BUY_AMOUNT, username=user_id)
+    response['status'] = 'success'
+    response['matched_count'] = 1
+    response['modified_count'] = 1
+    return respond(response)
+
+@bp.route('/cancel_set_buy', methods=['GET'])
+@admitted(CommandType.CANCEL_SET_BUY)
+@dispatched
+@idempotent
+@instrumented(CommandType.CANCEL_SET_BUY)
+@profiled
+async def cancel_set_buy():
+    '''
+    Cancels a SET_BUY command issued for the given stock
+
+    Pre-conditions:
+        The must have been a SET_BUY Command issued for the given stock by the user
+    Post-conditions:
+        (a) All accounts are reset to the values they would have had had the SET_BUY Command not been issued
+        (b) the BUY_TRIGGER for the given user and stock is also canceled.
+    '''
+    args = dict(request.args)
+    response = {'status': None}
+
+    try:
+        assert 'tx_num' in args, 'tx_num paramter not provided'
+        assert 'userid' in args, 'userid parameter not provided'
+        assert 'stocksymbol' in args, 'stocksymbol parameter not provided'
+
+        tx_num = int(args['tx_num'])
+        user_id = args['userid']
+        stock_symbol = args['stocksymbol']
+
+        Logging.log_debug(transactionNum=tx_num, command=CommandType.CANCEL_SET_BUY, username=user_id)
+    except AssertionError as err:
+        response['status'] = 'failure'
+        response['message'] = str(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.CANCEL_SET_BUY, errorMessage=response['message'])
+        return respond(response)
+
+    # Ensure account exists
+    if not await get_accounts().exists(user_id):
+        response['status'] = 'failure'
+        response['message'] = 'Account does not exist.'
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.CANCEL_SET_BUY, errorMessage=response['message'])
+        return respond(response)
+
+    # Cancel, or return that no reserve buys were found.
+    cancel_matched, cancel_modified = await account_store.unset_buy_reserve_amount(user_id, stock_symbol)
+    get_accounts().invalidate(user_id, 'reserve_buy')
+    if cancel_modified == 0:
+        response['status'] = 'failure'
+        response['message'] = 'No reserve accounts for stock {} and user {} found.'.format(stock_symbol, user_id)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.CANCEL_SET_BUY, errorMessage=response['message'])
+        return respond(response)
+
+    # Remove any buy triggers for that stock
+    await account_store.unset_trigger('BUY', user_id, stock_symbol)
+    get_accounts().invalidate(user_id, 'buy_triggers')
+    await asyncio.get_running_loop().run_in_executor(None, trigger_engine.disarm, 'BUY', user_id, stock_symbol)
+
+    Logging.log_user_command(transactionNum=tx_num, command=CommandType.CANCEL_SET_BUY, username=user_id)
+    response['status'] = 'success'
+    response['matched_count'] = cancel_matched
+    response['modified_count'] = cancel_modified
+    return respond(response)
+
+
+@bp.route('/set_buy_trigger', methods=['GET'])
+@admitted(CommandType.SET_BUY_TRIGGER)
+@dispatched
+@idempotent
+@instrumented(CommandType.SET_BUY_TRIGGER)
+@profiled
+async def set_buy_trigger():
+    '''
+    Sets the trigger point base on the current stock price when any SET_BUY will execute.
+
+    Pre-conditions:
+        The user must have specified a SET_BUY_AMOUNT prior to setting a SET_BUY_TRIGGER
+    Post-conditions:
+        The set of the user's buy triggers is updated to include the specified trigger
+    '''
+    args = dict(request.args)
+    response = {'status': None}
+
+    try:
+        assert 'tx_num' in args, 'tx_num paramter not provided'
+        assert 'userid' in args, 'userid parameter not provided'
+        assert 'stocksymbol' in args, 'stocksymbol parameter not provided'
+        assert 'amount' in args, 'amount parameter not provided'
+
+        tx_num = int(args['tx_num'])
+        user_id = args['userid']
+        stock_symbol = args['stocksymbol']
+        amount = float(args['amount'])
+
+        Logging.log_debug(transactionNum=tx_num, command=CommandType.SET_BUY_TRIGGER, username=user_id)
+    except AssertionError as err:
+        response['status'] = 'failure'
+        response['message'] = str(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.SET_BUY_TRIGGER, errorMessage=response['message'])
+        return respond(response)
+
+    # Ensure set buy amount exists for user's stock.
+    account = await get_accounts().get(user_id, ['reserve_buy'])
+    if account is None or stock_symbol not in account['reserve_buy']:
+        response['status'] = 'failure'
+        response['message'] = 'No buy reserve exists for stock {} for user {}'.format(stock_symbol, user_id)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.SET_BUY_TRIGGER, errorMessage=response['message'])
+        return respond(response)
+
+    await account_store.set_trigger('BUY', user_id, stock_symbol, amount, tx_num)
+    get_accounts().invalidate(user_id, 'buy_triggers')
+    await asyncio.get_running_loop().run_in_executor(None, trigger_engine.arm, 'BUY', user_id, stock_symbol, amount, tx_num)
+
+    Logging.log_user_command(transactionNum=tx_num, command=CommandType.SET_BUY_TRIGGER, username=user_id)
+    response['status'] = 'success'
+    response['message'] = 'Successfully added trigger for user {} for stock {} at price {}'.format(user_id, stock_symbol, amount)
+    return respond(response)
+
+
+@bp.route('/set_sell_amount', methods=['GET'])
+@admitted(CommandType.SET_SELL_AMOUNT)
+@dispatched
+@idempotent
+@instrumented(CommandType.SET_SELL_AMOUNT)
+@profiled
+async def set_sell_amount():
+    '''
+    Sets a defined amount of the specified stock to sell when the current stock price is equal or greater than the sell trigger point
+
+    Pre-conditions:
+        The user must have the specified amount of stock in their account for that stock.
+    Post-conditions:
+        A trigger is initialized for this username/stock symbol combination, but is not complete until SET_SELL_TRIGGER is executed.
+    '''
+    args = dict(request.args)
+    response = {'status': None}
+
+    try:
+        assert 'tx_num' in args, 'tx_num paramter not provided'
+        assert 'userid' in args, 'userid parameter not provided'
+        assert 'stocksymbol' in args, 'stocksymbol parameter not provided'
+        assert 'amount' in args, 'amount parameter not provided'
+
+        tx_num = int(args['tx_num'])
+        user_id = args['userid']
+        stock_symbol = args['stocksymbol']
+        amount = float(args['amount'])
+
+        Logging.log_debug(transactionNum=tx_num, command=CommandType.SET_SELL_AMOUNT, username=user_id)
+    except AssertionError as err:
+        response['status'] = 'failure'
+        response['message'] = str(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.SET_SELL_AMOUNT, errorMessage=response['message'])
+        return respond(response)
+
+    # Ensure user owns sufficient amount of stock at the current price.
+    account = await get_accounts().get(user_id, ['stocks'])
+    user_stocks = account['stocks'] if account else {}
+    if stock_symbol not in user_stocks:
+        response['status'] = 'failure'
+        response['message'] = 'User does not own any {} stock'.format(stock_symbol)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.SET_SELL_AMOUNT, errorMessage=response['message'])
+        return respond(response)
+
+    if amount > user_stocks[stock_symbol]: # total_share_value
+        response['status'] = 'failure'
+        #response['message'] = 'Not enough stock owned at current price to sell. Current price: {}, Total share value: {}, Requested amount: {}'.format(price, total_share_value, amount)
+        response['message'] = 'Not enough stock owned to set aside'
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.SET_SELL_AMOUNT, errorMessage=response['message'])
+        return respond(response)
+
+    # Set SELL trigger with no price specified (until SET_SELL_TRIGGER called)
+    trigger_matched_count, trigger_modified_count = await account_store.set_trigger('SELL', user_id, stock_symbol, price=None, tx_num=tx_num)
+    await asyncio.get_running_loop().run_in_executor(None, trigger_engine.disarm, 'SELL', user_id, stock_symbol)
+
+    # Add SELL reserve amount
+    reserve_matched_count, reserve_modified_count = await account_store.add_sell_reserve_amount(user_id, stock_symbol, amount)
+    get_accounts().invalidate(user_id, 'sell_triggers', 'reserve_sell')
+
+    Logging.log_user_command(transactionNum=tx_num, command=CommandType.SET_SELL_AMOUNT, username=user_id)
+    response['status'] = 'success'
+    response['message'] = 'Successfully added trigger for user {} for stock {}.'.format(user_id, stock_symbol)
+    response['matched_count'] = reserve_matched_count
+    response['modified_count'] = reserve_modified_count
+    return respond(response)
+
+@bp.route('/set_sell_trigger', methods=['GET'])
+@admitted(CommandType.SET_SELL_TRIGGER)
+@dispatched
+@idempotent
+@instrumented(CommandType.SET_SELL_TRIGGER)
+@profiled
+async def set_sell_trigger():
+    '''
+    Sets the stock price trigger point for executing any SET_SELL triggers associated with the given stock and user
+
+    Pre-conditions:
+        The user must have specified a SET_SELL_AMOUNT prior to setting a SET_SELL_TRIGGER
+    Post-coniditons:
+        (a) a reserve account is created for the specified amount of the given stock
+        (b) the user account for the given stock is reduced by the max number of stocks that could be purchased and
+        (c) the set of the user's sell triggers is updated to include the specified trigger.
+    '''
+    args = dict(request.args)
+    response = {'status': None}
+
+    try:
+        assert 'tx_num' in args, 'tx_num paramter not provided'
+        assert 'userid' in args, 'userid parameter not provided'
+        assert 'stocksymbol' in args, 'stocksymbol parameter not provided'
+        assert 'amount' in args, 'amount parameter not provided'
+
+        tx_num = int(args['tx_num'])
+        user_id = args['userid']
+        stock_symbol = args['stocksymbol']
+        amount = float(args['amount'])
+
+        Logging.log_debug(transactionNum=tx_num, command=CommandType.SET_SELL_TRIGGER, username=user_id)
+    except AssertionError as err:
+        response['status'] = 'failure'
+        response['message'] = str(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.SET_SELL_TRIGGER, errorMessage=response['message'])
+        return respond(response)
+
+    # Ensure SELL trigger for that stock exists.
+    account = await get_accounts().get(user_id, ['sell_triggers'])
+    triggers = account['sell_triggers'] if account else {}
+    if stock_symbol not in triggers:
+        response['status'] = 'failure'
+        response['message'] = 'No sell triggers for stock {}'.format(stock_symbol)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.SET_SELL_TRIGGER, errorMessage=response['message'])
+        return respond(response)
+
+    # Remove stock amount from account, only if the user owns enough.
+    if await get_accounts().remove_stock(user_id, stock_symbol, amount) is None:
+        response['status'] = 'failure'
+        response['message'] = 'Not enough stock owned to set aside'
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.SET_SELL_TRIGGER, errorMessage=response['message'])
+        return respond(response)
+
+    # Set SELL trigger for stock at that price
+    trigger_matched_count, trigger_modified_count = await account_store.set_trigger('SELL', user_id, stock_symbol, amount, tx_num)
+    get_accounts().invalidate(user_id, 'sell_triggers')
+    await asyncio.get_running_loop().run_in_executor(None, trigger_engine.arm, 'SELL', user_id, stock_symbol, amount, tx_num)
+
+    Logging.log_user_command(transactionNum=tx_num, command=CommandType.SET_SELL_TRIGGER, username=user_id)
+    response['status'] = 'success'
+    response['matched_count'] = trigger_matched_count
+    response['modified_count'] = trigger_modified_count
+    return respond(response)
+
+@bp.route('/cancel_set_sell', methods=['GET'])
+@admitted(CommandType.CANCEL_SET_SELL)
+@dispatched
+@idempotent
+@instrumented(CommandType.CANCEL_SET_SELL)
+@profiled
+async def cancel_set_sell():
+    '''
+	Cancels the SET_SELL associated with the given stock and user
+
+    Pre-conditions:
+        The user must have had a previously set SET_SELL for the given stock
+    Post-conditions:
+        (a) The set of the user's sell triggers is updated to remove the sell trigger associated with the specified stock
+        (b) all user account information is reset to the values they would have been if the given SET_SELL command had not been issued
+    '''
+    args = dict(request.args)
+    response = {'status': None}
+
+    try:
+        assert 'tx_num' in args, 'tx_num paramter not provided'
+        assert 'userid' in args, 'userid parameter not provided'
+        assert 'stocksymbol' in args, 'stocksymbol parameter not provided'
+
+        tx_num = int(args['tx_num'])
+        user_id = args['userid']
+        stock_symbol = args['stocksymbol']
+
+        Logging.log_debug(transactionNum=tx_num, command=CommandType.CANCEL_SET_SELL, username=user_id)
+    except AssertionError as err:
+        response['status'] = 'failure'
+        response['message'] = str(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.CANCEL_SET_SELL, errorMessage=response['message'])
+        return respond(response)
+
+    # Cancel, or return that no reserve sells were found.
+    cancel_matched, cancel_modified = await account_store.unset_sell_reserve_amount(user_id, stock_symbol)
+    get_accounts().invalidate(user_id, 'reserve_sell')
+    if cancel_modified == 0:
+        response['status'] = 'failure'
+        response['message'] = 'No sell reserve accounts for stock {} and user {} found.'.format(stock_symbol, user_id)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.CANCEL_SET_SELL, errorMessage=response['message'])
+        return respond(response)
+
+    # Remove any sell triggers for that stock
+    await account_store.unset_trigger('SELL', user_id, stock_symbol)
+    get_accounts().invalidate(user_id, 'sell_triggers')
+    await asyncio.get_running_loop().run_in_executor(None, trigger_engine.disarm, 'SELL', user_id, stock_symbol)
+
+    Logging.log_user_command(transactionNum=tx_num, command=CommandType.CANCEL_SET_SELL, username=user_id)
+    response['status'] = 'success'
+    response['matched_count'] = cancel_matched
+    response['modified_count'] = cancel_modified
+    return respond(response)
+
+
+@bp.route('/dumplog', methods=['GET'])
+@admitted(CommandType.DUMPLOG)
+@dispatched
+@idempotent
+@instrumented(CommandType.DUMPLOG)
+@profiled
+async def dumplog():
+    '''
+    2 possible parameter combinations:
+
+    1) (userid, filename): Print out the history of the users transactions to the user specified file
+        Pre-conditions:
+            none
+        Post-conditions:
+            The history of the user's transaction are written to the specified file.
+
+    2) (filename): Print out to the specified file the complete set of transactions that have occurred in the system.
+        Pre-conditions:
+            Can only be executed from the supervisor (root/administrator) account.
+        Post-conditions:
+            Places a complete log file of all transactions that have occurred in the system into the file specified by filename
+
+    Output is to specified filename appended with date and time it was created, to keep unique logs.
+    The optional merge parameter (1 or 0, default DUMPLOG_MERGE) selects whether logs are merged from
+    per-server sorted streams or read with a single sorted query.
+    '''
+    args = dict(request.args)
+    response = {'status': None}
+
+    try:
+        assert 'tx_num' in args, 'tx_num paramter not provided'
+        assert 'filename' in args, 'filename parameter not provided'
+
+        Logging.log_debug(transactionNum=int(args['tx_num']), command=CommandType.DUMPLOG)
+    except AssertionError as err:
+        response['status'] = 'failure'
+        response['message'] = str(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.DUMPLOG, errorMessage=response['message'])
+        return respond(response)
+
+    filename = '{}-{}'.format(args['filename'], time.strftime('%Y%m%d-%H%M%S'))
+    # Merge per-server sorted streams unless requested otherwise.
+    merge = args.get('merge', '1' if DUMPLOG_MERGE else '0') == '1'
+
+    def write_logs():
+        # Query logs, once every log recorded so far has been written.
+        flushed = Logging.flush()
+
+        # Stream logs to XML as they are read (Assume logs have been validated when entered.)
+        if LOG_SEGMENTS and 'userid' not in args:
+            log_segmenter.write_logs_xml('logs/{}.xml'.format(filename), merge=merge)
+        else:
+            Logging.write_logs_xml(Logging.iter_logs(args.get('userid'), merge=merge), 'logs/{}.xml'.format(filename))
+        return flushed
+
+    # Writing the log file is long and blocking, keep it off the event loop.
+    flushed = await asyncio.get_running_loop().run_in_executor(None, write_logs)
+
+    # Log as SystemEventType
+    Logging.log_system_event(transactionNum=int(args['tx_num']), command=CommandType.DUMPLOG, filename=filename)
+    Logging.log_user_command(transactionNum=int(args['tx_num']), command=CommandType.DUMPLOG)
+    response['status'] = 'success'
+    response['message'] = 'Wrote logs to {}'.format(filename)
+    if not flushed:
+        response['warning'] = 'Not every server wrote its recent logs in time, some may be missing.'
+    return respond(response)
+
+@bp.route('/display_summary', methods=['GET'])
+@admitted(CommandType.DISPLAY_SUMMARY)
+@dispatched
+@idempotent
+@instrumented(CommandType.DISPLAY_SUMMARY)
+@profiled
+async def display_summary():
+    '''
+	Provides a summary to the client of the given user's transaction history and the current status of their accounts as well as any set buy or sell triggers and their parameters
+
+    Pre-conditions:
+        none
+    Post-conditions:
+	    A summary of the given user's transaction history and the current status of their accounts as well as any set buy or sell triggers and their parameters is displayed to the user.
+
+    The transaction history is paginated, newest first: limit (default SUMMARY_PAGE_SIZE) transactions are returned,
+    with the totals per transaction type and, if there are older transactions, a next_cursor to pass as cursor for
+    the next page.
+    '''
+    args = dict(request.args)
+    response = {'status': None}
+
+    try:
+        assert 'tx_num' in args, 'tx_num paramter not provided'
+        assert 'userid' in args, 'userid parameter not provided'
+
+        Logging.log_debug(transactionNum=int(args['tx_num']), command=CommandType.DISPLAY_SUMMARY, username=args['userid'])
+        try:
+            limit = int(args.get('limit', SUMMARY_PAGE_SIZE))
+        except ValueError:
+            raise AssertionError('limit must be an integer')
+        account, (totals, transactions, next_cursor) = await asyncio.gather(
+            get_accounts().get(args['userid']), db.get_transaction_summary(args['userid'], args.get('cursor'), limit)
+        )
+    except AssertionError as err:
+        response['status'] = 'failure'
+        response['message'] = str(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.DISPLAY_SUMMARY, errorMessage=response['message'])
+        return respond(response)
+
+
+    Logging.log_system_event(transactionNum=int(args['tx_num']), command=CommandType.DISPLAY_SUMMARY, username=args['userid'])
+    Logging.log_user_command(transactionNum=int(args['tx_num']), command=CommandType.DISPLAY_SUMMARY, username=args['userid'])
+    response['transactions'] = transactions
+    response['totals'] = totals
+    response['next_cursor'] = next_cursor
+    response['account'] = account
+    response['status'] = 'success'
+    return respond(response)
+
+@bp.route('/batch', methods=['POST'])
+@admitted()
+@idempotent
+async def batch():
+    '''
+    Same as the batch route of transaction_server.commands. Each user's
+    commands are awaited in order behind the user's other requests, and
+    different users' commands concurrently.
+
+    Returns the result of each command, in the order they were given.
+    '''
+    commands = await request.get_json(silent=True)
+    response = {'status': None}
+
+    if type(commands) != list or not all(type(command) == dict for command in commands):
+        response['status'] = 'failure'
+        response['message'] = 'Request body must be a JSON array of commands'
+        return respond(response)
+
+    app = current_app._get_current_object()
+    headers = {RUN_ID_HEADER: request.headers[RUN_ID_HEADER]} if RUN_ID_HEADER in request.headers else {}
+    results = [None] * len(commands)
+
+    for positions_by_user in batch_segments(commands):
+        await asyncio.gather(*[
+            run_user_commands(app, commands, positions, results, headers) if user_id is None
+            else dispatcher.run(str(user_id), run_user_commands, app, commands, positions, results, headers)
+            for user_id, positions in positions_by_user.items()
+        ])
+
+    response['status'] = 'success'
+    response['results'] = results
+    return respond(response)
+
+async def run_user_commands(app, commands, positions, results, headers):
+    '''
+    Runs one user's commands of a batch in order, storing each result at the
+    command's position. The commands share an application context, and so
+    the account loader returned by get_accounts().
+    '''
+    async with app.app_context():
+        for position in positions:
+            params = {key: str(value) for key, value in commands[position].items() if key != 'command'}
+            view = BATCH_COMMANDS.get(commands[position].get('command'))
+            if view is None:
+                results[position] = {'status': 'failure', 'message': 'Unknown command {}'.format(commands[position].get('command'))}
+                continue
+
+            try:
+                async with app.test_request_context('{}/{}'.format(bp.url_prefix, view.__name__), query_string=params, headers=headers):
+                    results[position] = await (await view()).get_json()
+            except Exception as err:
+                results[position] = {'status': 'failure', 'message': 'Command failed: {}'.format(err)}
+
+BATCH_COMMANDS = {view.__name__: view for view in [
+    add, quote, buy, commit_buy, cancel_buy, sell, commit_sell, cancel_sell,
+    set_buy_amount, cancel_set_buy, set_buy_trigger, set_sell_amount, set_sell_trigger, cancel_set_sell,
+    dumplog, display_summary
+]}
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+'''
+Non-blocking counterparts of DB and AccountLoader for the asyncio server,
+backed by the motor driver. Queries and updates are the same as those of DB,
+so both servers can run against the same database.
+'''
+import asyncio
+import functools
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from transaction_server.account_state import ACCOUNT_STATE_MODE, account_store as blocking_account_store
+from transaction_server.db import (
+    ALL_FIELDS, DB_PORT, HOST, NEW_ACCOUNT_FIELDS, SUMMARY_MAX_PAGE_SIZE, SUMMARY_PAGE_SIZE, TRANSACTION_ORDER,
+    AccountLoader, summary_update, transaction_page, transaction_page_query
+)
+
+
+class AsyncDB():
+    '''
+    Same as DB, but every method is a coroutine. The client is created by
+    connect(), once the event loop it is used from is running.
+    '''
+
+    def __init__(self):
+        self.client = None
+        self.db = None
+
+    def connect(self):
+        self.client = AsyncIOMotorClient(host=HOST, port=DB_PORT)
+        self.db = self.client.day_trading
+
+    async def get_account(self, user_id):
+        assert type(user_id) == str
+
+        return await self.db.accounts.find_one({'userid': user_id})
+
+    async def get_account_fields(self, user_id, fields):
+        assert type(user_id) == str
+        assert type(fields) == list
+
+        projection = {'_id': False, 'userid': True}
+        projection.update({field: True for field in fields})
+        return await self.db.accounts.find_one({'userid': user_id}, projection)
+
+    async def deposit(self, user_id, amount, create=False):
+        assert type(user_id) == str
+        assert type(amount) == float
+        assert amount >= 0
+
+        update = {'$inc': {'balance': amount}}
+        if create:
+            update['$setOnInsert'] = NEW_ACCOUNT_FIELDS
+
+        try:
+            account = await self.db.accounts.find_one_and_update({'userid': user_id}, update, projection={'_id': False, 'balance': True}, upsert=create, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # A concurrent deposit created the account first, update it instead.
+            account = await self.db.accounts.find_one_and_update({'userid': user_id}, update, projection={'_id': False, 'balance': True}, return_document=ReturnDocument.AFTER)
+        return account['balance'] if account else None
+
+    async def withdraw(self, user_id, amount):
+        assert type(user_id) == str
+        assert type(amount) == float
+        assert amount >= 0
+
+        account = await self.db.accounts.find_one_and_update({'userid': user_id, 'balance': {'$gte': amount}}, {'$inc': {'balance': -amount}}, projection={'_id': False, 'balance': True}, return_document=ReturnDocument.AFTER)
+        return account['balance'] if account else None
+
+    async def add_stock(self, user_id, stock_symbol, amount):
+        assert type(user_id) == str
+        assert type(stock_symbol) == str
+        assert type(amount) == float
+        assert amount >= 0
+
+        stock_field = 'stocks.{}'.format(stock_symbol)
+        account = await self.db.accounts.find_one_and_update({'userid': user_id}, {'$inc': {stock_field: amount}}, projection={'_id': False, stock_field: True}, return_document=ReturnDocument.AFTER)
+        return account['stocks'][stock_symbol] if account else None
+
+    async def remove_stock(self, user_id, stock_symbol, amount):
+        assert type(user_id) == str
+        assert type(stock_symbol) == str
+        assert type(amount) == float
+        assert amount >= 0
+
+        stock_field = 'stocks.{}'.format(stock_symbol)
+        account = await self.db.accounts.find_one_and_update({'userid': user_id, stock_field: {'$gte': amount}}, {'$inc': {stock_field: -amount}}, projection={'_id': False, stock_field: True}, return_document=ReturnDocument.AFTER)
+        if account is None:
+            return None
+
+        remaining = account['stocks'][stock_symbol]
+        if remaining == 0:
+            await self.db.accounts.update_one({'userid': user_id, stock_field: 0}, {'$unset': {stock_field: ''}})
+        return remaining
+
+    async def reserve_buy_amount(self, user_id, stock_symbol, amount):
+        assert type(user_id) == str
+        assert type(stock_symbol) == str
+        assert type(amount) == float
+        assert amount > 0
+
+        update = {'$inc': {'balance': -amount, 'reserve_buy.{}'.format(stock_symbol): amount}}
+        account = await self.db.accounts.find_one_and_update({'userid': user_id, 'balance': {'$gte': amount}}, update, projection={'_id': False, 'balance': True}, return_document=ReturnDocument.AFTER)
+        return account['balance'] if account else None
+
+    async def unset_buy_reserve_amount(self, user_id, stock_symbol):
+        assert type(user_id) == str
+        assert type(stock_symbol) == str
+
+        update_result = await self.db.accounts.update_one({'userid': user_id}, {'$unset': {'reserve_buy.{}'.format(stock_symbol): ''}})
+        return update_result.matched_count, update_result.modified_count
+
+    async def add_sell_reserve_amount(self, user_id, stock_symbol, amount):
+        assert type(user_id) == str
+        assert type(stock_symbol) == str
+        assert type(amount) == float
+        assert amount > 0
+
+        update_result = await self.db.accounts.update_one({'userid': user_id}, {'$inc': {'reserve_sell.{}'.format(stock_symbol): amount}})
+        return update_result.matched_count, update_result.modified_count
+
+    async def unset_sell_reserve_amount(self, user_id, stock_symbol):
+        assert type(user_id) == str
+        assert type(stock_symbol) == str
+
+        update_result = await self.db.accounts.update_one({'userid': user_id}, {'$unset': {'reserve_sell.{}'.format(stock_symbol): ''}})
+        return update_result.matched_count, update_result.modified_count
+
+    async def set_trigger(self, trigger_type, user_id, stock_symbol, price, tx_num=None):
+        assert trigger_type in ['BUY', 'SELL']
+        assert type(user_id) == str
+        assert type(stock_symbol) == str
+
+        update = {'trigger_tx_nums.{}.{}'.format(trigger_type, stock_symbol): tx_num}
+        if trigger_type == 'BUY':
+            update['buy_triggers.{}'.format(stock_symbol)] = price
+        else:
+            update['sell_triggers.{}'.format(stock_symbol)] = price
+
+        update_result = await self.db.accounts.update_one({'userid': user_id}, {'$set': update})
+        return update_result.matched_count, update_result.modified_count
+
+    async def unset_trigger(self, trigger_type, user_id, stock_symbol):
+        assert trigger_type in ['BUY', 'SELL']
+        assert type(user_id) == str
+        assert type(stock_symbol) == str
+
+        update = {'trigger_tx_nums.{}.{}'.format(trigger_type, stock_symbol): ''}
+        if trigger_type == 'BUY':
+            update['buy_triggers.{}'.format(stock_symbol)] = ''
+        else:
+            update['sell_triggers.{}'.format(stock_symbol)] = ''
+
+        update_result = await self.db.accounts.update_one({'userid': user_id}, {'$unset': update})
+        return update_result.matched_count, update_result.modified_count
+
+    async def log_transaction(self, user_id, tx_type, stock_symbol, amount, unix_timestamp):
+        assert type(user_id) == str
+        assert tx_type in ['BUY', 'SELL']
+        assert type(stock_symbol) == str
+        assert type(amount) == float
+        assert type(unix_timestamp) == float
+
+        document_to_insert = {'userid': user_id, 'tx_type': tx_type, 'stock_symbol': stock_symbol, 'amount': amount, 'timestamp': unix_timestamp}
+        insert_one_result = await self.db.transactions.insert_one(document_to_insert)
+        try:
+            await self.db.summaries.update_one({'userid': user_id}, summary_update(document_to_insert), upsert=True)
+        except DuplicateKeyError:
+            await self.db.summaries.update_one({'userid': user_id}, summary_update(document_to_insert))
+        return insert_one_result.inserted_id
+
+    async def get_user_transactions(self, user_id):
+        assert type(user_id) == str
+
+        return await self.db.transactions.find({'userid': user_id}).to_list(None)
+
+    async def get_summary(self, user_id):
+        assert type(user_id) == str
+
+        summary = await self.db.summaries.find_one({'userid': user_id}, {'_id': False, 'userid': False})
+        return summary if summary is not None else {'totals': {}, 'recent': []}
+
+    async def get_transaction_summary(self, user_id, cursor=None, limit=SUMMARY_PAGE_SIZE):
+        assert type(user_id) == str
+        assert 0 < limit <= SUMMARY_MAX_PAGE_SIZE, 'limit must be between 1 and {}'.format(SUMMARY_MAX_PAGE_SIZE)
+
+        summary = await self.get_summary(user_id)
+        count = sum(totals['count'] for totals in summary['totals'].values())
+        recent = summary['recent'][::-1]
+        if not cursor and (limit <= len(recent) or count == len(recent)):
+            return (summary['totals'],) + transaction_page(recent, limit, count > limit)
+
+        transactions = await self.db.transactions.find(transaction_page_query(user_id, cursor)).sort(TRANSACTION_ORDER).limit(limit + 1).to_list(None)
+        return (summary['totals'],) + transaction_page(transactions, limit, len(transactions) > limit)
+
+    def close_connection(self):
+        if self.client is not None:
+            self.client.close()
+
+
+class ExecutorAccountStore():
+    '''
+    Wraps a blocking account store so that each of its methods is a coroutine
+    run in the event loop's default executor. Used for account state held in
+    Redis, whose updates are Lua scripts shared with the blocking server.
+    '''
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getattr__(self, name):
+        method = getattr(self.store, name)
+
+        async def run_in_executor(*args, **kwargs):
+            return await asyncio.get_running_loop().run_in_executor(None, functools.partial(method, *args, **kwargs))
+        return run_in_executor
+
+
+class AsyncAccountLoader(AccountLoader):
+    '''
+    Same as AccountLoader, for an account store whose methods are coroutines.
+    The view is kept in the same way, only the reads and writes are awaited.
+    '''
+
+    async def get(self, user_id, fields=None):
+        assert type(user_id) == str
+
+        loaded_fields, account = self._accounts.get(user_id, (set(), None))
+        if user_id in self._accounts and (account is None or ALL_FIELDS in loaded_fields):
+            return account
+
+        if fields is None:
+            account = await self.db.get_account(user_id)
+            self._accounts[user_id] = ({ALL_FIELDS}, account)
+            return account
+
+        missing_fields = [field for field in fields if field not in loaded_fields]
+        if user_id in self._accounts and not missing_fields:
+            return account
+
+        fetched = await self.db.get_account_fields(user_id, missing_fields)
+        if fetched is None:
+            self._accounts[user_id] = ({ALL_FIELDS}, None)
+            return None
+
+        # Another read for the same account may have completed meanwhile.
+        loaded_fields, account = self._accounts.get(user_id, (set(), None))
+        account = dict(account or {}, **fetched)
+        self._accounts[user_id] = (loaded_fields | set(missing_fields), account)
+        return account
+
+    async def exists(self, user_id):
+        return await self.get(user_id, []) is not None
+
+    async def deposit(self, user_id, amount, create=False):
+        balance = await self.db.deposit(user_id, amount, create)
+        if balance is not None and self._accounts.get(user_id, (None, None))[1] is None:
+            # Account may have just been created, only its balance is known.
+            self._accounts[user_id] = ({'balance'}, {'userid': user_id, 'balance': balance})
+        elif balance is not None:
+            self._set(user_id, 'balance', balance)
+        return balance
+
+    async def withdraw(self, user_id, amount):
+        balance = await self.db.withdraw(user_id, amount)
+        if balance is not None:
+            self._set(user_id, 'balance', balance)
+        return balance
+
+    async def add_stock(self, user_id, stock_symbol, amount):
+        holding = await self.db.add_stock(user_id, stock_symbol, amount)
+        if holding is not None:
+            self._set(user_id, 'stocks', holding, stock_symbol)
+        return holding
+
+    async def remove_stock(self, user_id, stock_symbol, amount):
+        holding = await self.db.remove_stock(user_id, stock_symbol, amount)
+        if holding == 0:
+            # A holding that reached 0 was unset.
+            self._unset(user_id, 'stocks', stock_symbol)
+        elif holding is not None:
+            self._set(user_id, 'stocks', holding, stock_symbol)
+        return holding
+
+    async def reserve_buy_amount(self, user_id, stock_symbol, amount):
+        balance = await self.db.reserve_buy_amount(user_id, stock_symbol, amount)
+        if balance is not None:
+            self._set(user_id, 'balance', balance)
+            self.invalidate(user_id, 'reserve_buy')
+        return balance
+
+
+db = AsyncDB()
+account_store = ExecutorAccountStore(blocking_account_store) if ACCOUNT_STATE_MODE == 'redis' else db
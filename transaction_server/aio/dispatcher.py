@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+'''
+Same as transaction_server.dispatcher, for the asyncio server. A user's
+commands in this process wait in turn on an asyncio lock of the user, which
+lets them through in the order they arrived, so a user whose command is slow
+only holds up their own later commands. Each command then takes the same
+Redis lock on the user as the Flask server's dispatcher, so that a user's
+commands never run concurrently on either server. A user whose lock is held
+elsewhere retries every DISPATCH_LOCK_RETRY_INTERVAL seconds without holding
+up the event loop, and the lock is renewed by a task of its own while the
+command runs.
+'''
+import asyncio
+import contextvars
+import functools
+import traceback
+from quart import request
+from transaction_server.aio.cache import cache as redis_client, lock_token, release_lock, renew_lock
+from transaction_server.dispatcher import DISPATCH_LOCK_RETRY_INTERVAL, DISPATCH_LOCK_TTL, DISPATCH_USER_LOCK, USER_LOCK_KEY
+
+_user_id = contextvars.ContextVar('dispatch_user_id', default=None)
+
+
+async def renew_user_lock(user_id, token):
+    # Runs until cancelled once the command completes.
+    while True:
+        await asyncio.sleep(DISPATCH_LOCK_TTL / 3)
+        try:
+            await renew_lock(keys=[USER_LOCK_KEY.format(user_id)], args=[token, int(DISPATCH_LOCK_TTL * 1000)])
+        except Exception:
+            traceback.print_exc()
+
+
+class AsyncDispatcher():
+    '''
+    An asyncio lock per user with commands waiting or running in this process.
+    '''
+
+    def __init__(self, user_lock=DISPATCH_USER_LOCK):
+        self.user_lock = user_lock
+        self._users = {} # user_id -> [asyncio.Lock, commands waiting or running]
+
+    async def run(self, user_id, fn, *args, **kwargs):
+        '''
+        Awaits fn(*args, **kwargs) behind user_id's other commands and returns
+        its result. Called while running one of the user's commands, e.g. by a
+        command run by another command, fn is awaited directly instead of
+        waiting behind itself.
+        '''
+        assert type(user_id) == str
+
+        if _user_id.get() == user_id:
+            return await fn(*args, **kwargs)
+
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = [asyncio.Lock(), 0]
+        user[1] += 1
+        try:
+            async with user[0]:
+                token = await self._acquire_user_lock(user_id) if self.user_lock else None
+                renewer = asyncio.ensure_future(renew_user_lock(user_id, token)) if token is not None else None
+                reset = _user_id.set(user_id)
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    _user_id.reset(reset)
+                    if renewer is not None:
+                        renewer.cancel()
+                        try:
+                            await release_lock(keys=[USER_LOCK_KEY.format(user_id)], args=[token])
+                        except Exception:
+                            # The lock expires on its own.
+                            traceback.print_exc()
+        finally:
+            user[1] -= 1
+            if not user[1]:
+                del self._users[user_id]
+
+    def in_command(self):
+        '''
+        Returns True when called from a command run by the dispatcher.
+        '''
+        return _user_id.get() is not None
+
+    async def _acquire_user_lock(self, user_id):
+        # Waits for the user's commands running in other processes, taking
+        # over once their lock expires.
+        token = lock_token()
+        while not await redis_client.set(USER_LOCK_KEY.format(user_id), token, nx=True, px=int(DISPATCH_LOCK_TTL * 1000)):
+            await asyncio.sleep(DISPATCH_LOCK_RETRY_INTERVAL)
+        return token
+
+
+dispatcher = AsyncDispatcher()
+
+def dispatched(view):
+    '''
+    Decorates a command route so that it runs behind the other commands of
+    the request's userid. Requests without a userid run directly, and fail
+    validation as before if the route requires one.
+    '''
+    @functools.wraps(view)
+    async def dispatch_view(*args, **kwargs):
+        user_id = request.args.get('userid')
+        if user_id is None:
+            return await view(*args, **kwargs)
+        return await dispatcher.run(user_id, view, *args, **kwargs)
+    return dispatch_view
@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+'''
+Encoding of command responses for the asyncio server, in the same formats as
+transaction_server.encoding.
+'''
+from quart import Response, request
+from transaction_server.encoding import encode
+
+
+def respond(data):
+    '''
+    Returns a response with data encoded for the current request, in place of
+    jsonify.
+    '''
+    body, mimetype = encode(data, request.headers.get('Accept'))
+    return Response(body, mimetype=mimetype)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+'''
+Same as transaction_server.idempotency, for the asyncio server. Claims and
+results are stored under the same keys, so a retry of a command sent to the
+other transaction server is answered with its result as well. The claim of
+a running command is renewed by a task of its own.
+'''
+import asyncio
+import functools
+import hashlib
+import traceback
+from quart import Response, request
+from transaction_server.aio.cache import AsyncCache
+from transaction_server.aio.encoding import respond
+from transaction_server.cache import COMMAND_CLAIM_TTL, COMMAND_RUNNING
+from transaction_server.idempotency import DEFAULT_RUN_ID, IDEMPOTENCY_ENABLED, IDEMPOTENCY_POLL_INTERVAL, RUN_ID_HEADER
+
+cache = AsyncCache()
+
+
+async def renew_claim(claim, token):
+    # Runs until cancelled once the command completes.
+    while True:
+        await asyncio.sleep(COMMAND_CLAIM_TTL / 3)
+        try:
+            await cache.renew_command(*claim, token)
+        except Exception:
+            traceback.print_exc()
+
+
+def idempotent(view):
+    '''
+    Decorates a command route to run at most once per run, tx_num and userid.
+    Returns the route unchanged unless IDEMPOTENCY_ENABLED.
+    '''
+    if not IDEMPOTENCY_ENABLED:
+        return view
+
+    @functools.wraps(view)
+    async def idempotent_view(*args, **kwargs):
+        tx_num = request.args.get('tx_num')
+        if tx_num is None:
+            body = await request.get_data()
+            if not body:
+                return await view(*args, **kwargs)
+            tx_num = 'sha1-' + hashlib.sha1(body).hexdigest()
+        claim = (request.headers.get(RUN_ID_HEADER, DEFAULT_RUN_ID), view.__name__, request.args.get('userid', ''), tx_num)
+
+        # Wait for another request running the command, taking over if its claim expires.
+        deadline = asyncio.get_running_loop().time() + COMMAND_CLAIM_TTL
+        token = await cache.claim_command(*claim)
+        while token is None:
+            result = await cache.get_command_result(*claim)
+            if result is not None and not result.startswith(COMMAND_RUNNING):
+                mimetype, _, body = result.partition(b'\n')
+                response = Response(body, mimetype=mimetype.decode('utf-8'))
+                response.headers['X-Idempotent-Replay'] = '1'
+                return response
+            if asyncio.get_running_loop().time() > deadline:
+                return respond({'status': 'failure', 'message': 'Command {} is still running.'.format(tx_num)})
+            await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL)
+            token = await cache.claim_command(*claim)
+
+        renewer = asyncio.ensure_future(renew_claim(claim, token))
+        try:
+            response = await view(*args, **kwargs)
+        except Exception:
+            await cache.release_command(*claim, token)
+            raise
+        finally:
+            renewer.cancel()
+
+        # A server error is not a result, the command may succeed when retried.
+        if response.status_code >= 500:
+            await cache.release_command(*claim, token)
+            return response
+
+        await cache.set_command_result(*claim, token, response.mimetype.encode('utf-8') + b'\n' + await response.get_data())
+        return response
+    return idempotent_view
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+'''
+Same as transaction_server.instrumentation, for the asyncio server. Command
+durations are recorded in the same histograms, which /metrics exposes. Time
+spent in each dependency is not broken down: the awaits of the commands
+running on the event loop interleave, so it cannot be told apart per command
+the way the Flask server does per thread.
+'''
+import functools
+import time
+from transaction_server.instrumentation import METRICS_ENABLED, metrics
+
+
+def instrumented(command_type):
+    '''
+    Decorates a command route to record its duration under command_type.
+    Returns the route unchanged unless METRICS_ENABLED.
+    '''
+    def decorator(view):
+        if not METRICS_ENABLED:
+            return view
+
+        @functools.wraps(view)
+        async def instrumented_view(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await view(*args, **kwargs)
+            finally:
+                metrics.record(command_type.value, time.perf_counter() - start, {})
+        return instrumented_view
+    return decorator
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+'''
+Same as transaction_server.profiling's profiled, for the asyncio server. The
+event loop's thread is sampled while the command runs, so the stacks of other
+commands interleaved with it on the loop are counted as well. Every process
+of this server also answers /profile requests, as it imports the
+transaction_server package, which starts the profile listener.
+'''
+import asyncio
+import functools
+import threading
+from quart import request
+from transaction_server.profiling import Sampler, profile_path, write_folded
+
+
+def profiled(view):
+    '''
+    Decorates a command route so that it is profiled when its request asks
+    for it. Requests that do not only pay for the check.
+    '''
+    @functools.wraps(view)
+    async def profiled_view(*args, **kwargs):
+        if request.args.get('profile') != '1' and request.headers.get('X-Profile') != '1':
+            return await view(*args, **kwargs)
+
+        sampler = Sampler(thread_id=threading.get_ident()).start()
+        try:
+            response = await view(*args, **kwargs)
+        finally:
+            counts = sampler.stop()
+
+        path = profile_path('{}-{}'.format(view.__name__, request.args.get('tx_num', 'none')))
+        response.headers['X-Profile-File'] = await asyncio.get_running_loop().run_in_executor(None, write_folded, counts, path)
+        return response
+    return profiled_view
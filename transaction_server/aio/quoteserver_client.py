@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+'''
+Non-blocking quote server client for the asyncio server. Quotes are cached
+and fetched under the same Redis keys and lock as QuoteServerClient, so both
+servers share them, and requests are bounded by the same timeouts and circuit
+breaker settings.
+'''
+import asyncio
+import os
+import socket
+import time
+from transaction_server.aio.cache import AsyncCache
+from transaction_server.cache import QUOTE_CACHE_TTL, QUOTE_LOCK_TTL
+from transaction_server.logging import Logging
+from transaction_server.quoteserver_client import (
+    HOST, PORT, QUOTE_BREAKER_FAILURES, QUOTE_BREAKER_RESET, QUOTE_CONNECT_TIMEOUT, QUOTE_KEEPALIVE_BACKOFF, QUOTE_LOCK_POLL_INTERVAL,
+    QUOTE_POOL_SIZE, QUOTE_READ_TIMEOUT, QUOTE_SERVER_KEEPALIVE, QUOTE_STALE_TTL
+)
+from transaction_server.quoteserver_pool import CircuitBreaker, QuoteServerConnectionClosed, QuoteServerUnavailable
+
+QUOTE_MAX_CONNECTIONS = int(os.environ.get('QUOTE_MAX_CONNECTIONS', 64))
+cache = AsyncCache()
+
+
+class AsyncQuoteServerPool():
+    '''
+    Same as QuoteServerPool, for asyncio streams, without pipelining or
+    hedging. At most max_connections requests are sent to the quote server at
+    once, the others wait for a connection to be released.
+    '''
+
+    def __init__(self, host, port, max_idle=8, max_connections=64, keepalive=True, keepalive_backoff=30.0, connect_timeout=None, read_timeout=None, breaker=None):
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self.max_connections = max_connections
+        self.keepalive = keepalive
+        self.keepalive_backoff = keepalive_backoff
+        self.keepalive_resumes = 0.0
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.breaker = breaker or CircuitBreaker()
+        self._idle = []
+        self._semaphore = None
+
+    async def quote(self, symbol, username):
+        '''
+        Returns the raw response line for a single quote request, unless the
+        circuit breaker is open.
+        '''
+        if not self.breaker.allow():
+            raise QuoteServerUnavailable('Quote server is unavailable, not retrying for up to {} seconds'.format(self.breaker.reset_timeout))
+
+        try:
+            response = await self._quote(symbol, username)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+
+        self.breaker.record_success()
+        return response
+
+    async def _quote(self, symbol, username):
+        line = str.encode('{:3s} {}\n'.format(symbol, username))
+
+        # Created on first use, from the event loop it is used in.
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+
+        async with self._semaphore:
+            reused = bool(self._idle)
+            reader, writer = self._idle.pop() if reused else await self._connect()
+            try:
+                response = await self._request(reader, writer, line)
+            except socket.timeout:
+                # The quote server is slow, not gone: don't retry or stop keeping alive.
+                writer.close()
+                raise
+            except (OSError, QuoteServerConnectionClosed):
+                writer.close()
+                if not reused:
+                    raise
+
+                # The idle connection was closed by the quote server, retry once
+                # on a fresh connection and stop keeping connections alive for a while.
+                self.keepalive_resumes = time.time() + self.keepalive_backoff
+                self.clear()
+                reader, writer = await self._connect()
+                try:
+                    response = await self._request(reader, writer, line)
+                except Exception:
+                    writer.close()
+                    raise
+            except BaseException:
+                writer.close()
+                raise
+
+            if self.keepalive and time.time() >= self.keepalive_resumes and len(self._idle) < self.max_idle:
+                self._idle.append((reader, writer))
+            else:
+                writer.close()
+            return response
+
+    def clear(self):
+        '''
+        Closes every idle connection.
+        '''
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+
+    async def _connect(self):
+        try:
+            return await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.connect_timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout('Timed out connecting to the quote server') from None
+
+    async def _request(self, reader, writer, line):
+        writer.write(line)
+        await writer.drain()
+        try:
+            response = await asyncio.wait_for(reader.readline(), self.read_timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout('Timed out waiting for the quote server') from None
+        if not response.endswith(b'\n'):
+            raise QuoteServerConnectionClosed('Quote server closed the connection')
+        return response.decode('utf-8').rstrip('\r\n')
+
+
+pool = AsyncQuoteServerPool(
+    HOST, PORT, max_idle=QUOTE_POOL_SIZE, max_connections=QUOTE_MAX_CONNECTIONS, keepalive=QUOTE_SERVER_KEEPALIVE, keepalive_backoff=QUOTE_KEEPALIVE_BACKOFF,
+    connect_timeout=QUOTE_CONNECT_TIMEOUT, read_timeout=QUOTE_READ_TIMEOUT, breaker=CircuitBreaker(QUOTE_BREAKER_FAILURES, QUOTE_BREAKER_RESET)
+)
+
+
+class AsyncQuoteServerClient():
+    '''
+    Same as QuoteServerClient, for coroutines. Concurrent requests for the same
+    symbol within the process await the same future, across processes the
+    Redis quote lock lets only one server query the quote server at a time.
+    Quotes fetched by this process are kept for QUOTE_STALE_TTL seconds, for
+    QUOTE to answer with while the quote server is unavailable.
+    '''
+    _flights = {}
+    _recent_quotes = {} # symbol -> (quote, time fetched)
+    _hits = 0
+    _misses = 0
+
+    @staticmethod
+    async def get_quote(symbol, username, tx_num, allow_stale=False):
+        '''
+        Get price of stock by specified symbol, as a tuple of (price, symbol,
+        username, timestamp, cryptokey). See QuoteServerClient.get_quote.
+        '''
+        assert type(symbol) == str
+        assert type(username) == str
+        assert type(tx_num) == int
+
+        try:
+            return await AsyncQuoteServerClient._get_quote(symbol, username, tx_num)
+        except OSError:
+            recent = AsyncQuoteServerClient._recent_quotes.get(symbol)
+            if not allow_stale or recent is None or time.time() - recent[1] > QUOTE_STALE_TTL:
+                raise
+            return AsyncQuoteServerClient._as_tuple(recent[0], username)
+
+    @staticmethod
+    async def _get_quote(symbol, username, tx_num):
+        if QUOTE_CACHE_TTL <= 0:
+            return AsyncQuoteServerClient._as_tuple(await AsyncQuoteServerClient._fetch_quote(symbol, username, tx_num), username)
+
+        quote = await cache.get_quote(symbol)
+        if quote:
+            AsyncQuoteServerClient._hits += 1
+            return AsyncQuoteServerClient._as_tuple(quote, username)
+
+        # Join the request already in flight for this symbol, if any.
+        flight = AsyncQuoteServerClient._flights.get(symbol)
+        if flight is not None:
+            quote = await asyncio.shield(flight)
+            AsyncQuoteServerClient._hits += 1
+            return AsyncQuoteServerClient._as_tuple(quote, username)
+
+        AsyncQuoteServerClient._misses += 1
+        flight = asyncio.ensure_future(AsyncQuoteServerClient._fetch_shared_quote(symbol, username, tx_num))
+        AsyncQuoteServerClient._flights[symbol] = flight
+        flight.add_done_callback(lambda _: AsyncQuoteServerClient._flights.pop(symbol, None))
+
+        # Shielded so that a cancelled caller does not cancel the other callers' quote.
+        return AsyncQuoteServerClient._as_tuple(await asyncio.shield(flight), username)
+
+    @staticmethod
+    def get_cache_stats():
+        '''
+        Returns the quote cache hits, misses and hit ratio of this process.
+        '''
+        hits, misses = AsyncQuoteServerClient._hits, AsyncQuoteServerClient._misses
+        lookups = hits + misses
+        return {'hits': hits, 'misses': misses, 'hit_ratio': float(hits) / lookups if lookups else 0.0}
+
+    @staticmethod
+    async def _fetch_shared_quote(symbol, username, tx_num):
+        # Wait for the other transaction server if it is already fetching the
+        # symbol, falling back to fetching it ourselves if its lock expires.
+        deadline = time.time() + QUOTE_LOCK_TTL
+        token = await cache.acquire_quote_lock(symbol)
+        while token is None:
+            quote = await cache.get_quote(symbol)
+            if quote:
+                return quote
+            if time.time() > deadline:
+                return await AsyncQuoteServerClient._fetch_quote(symbol, username, tx_num)
+            await asyncio.sleep(QUOTE_LOCK_POLL_INTERVAL)
+            token = await cache.acquire_quote_lock(symbol)
+
+        try:
+            quote = await AsyncQuoteServerClient._fetch_quote(symbol, username, tx_num)
+            await cache.set_quote(symbol, quote)
+        finally:
+            await cache.release_quote_lock(symbol, token)
+        return quote
+
+    @staticmethod
+    async def _fetch_quote(symbol, username, tx_num):
+        price, symbol, username, timestamp, cryptokey = (await pool.quote(symbol, username)).split(',')
+
+        # Log as QuoteServerType, only for quotes actually served by the quote server.
+        Logging.log_quote_server_hit(transactionNum=tx_num, price=float(price), stockSymbol=symbol, username=username, quoteServerTime=int(timestamp), cryptokey=cryptokey)
+
+        quote = {'price': float(price), 'symbol': symbol, 'username': username, 'timestamp': int(timestamp), 'cryptokey': cryptokey}
+        AsyncQuoteServerClient._recent_quotes[symbol] = (quote, time.time())
+        return quote
+
+    @staticmethod
+    def _as_tuple(quote, username):
+        # Cached quotes were requested on behalf of another user.
+        return quote['price'], quote['symbol'], username, quote['timestamp'], quote['cryptokey']
@@ -1,10 +1,51 @@
 from json import dumps, loads
+import os
 import redis
+import uuid
+from transaction_server.instrumentation import instrument_class
 
 cache = redis.StrictRedis(host='redis', port=6379)
 
-CACHE_PENDING_BUY_TX_NAME = 'pending_buy_transactions'
-CACHE_PENDING_SELL_TX_NAME = 'pending_sell_transactions'
+CACHE_PENDING_TX_KEY = 'pending:{}:{}' # tx_type, user_id
+PENDING_TX_TTL = 60 # seconds a BUY or SELL can be committed or cancelled for
+CACHE_QUOTE_KEY = 'quote:{}'
+CACHE_QUOTE_LOCK_KEY = 'quote_lock:{}'
+QUOTE_CACHE_TTL = float(os.environ.get('QUOTE_CACHE_TTL', 60)) # seconds, 0 disables the cache
+QUOTE_LOCK_TTL = float(os.environ.get('QUOTE_LOCK_TTL', 5)) # seconds
+CACHE_COMMAND_RESULT_KEY = 'result:{}:{}:{}:{}' # run_id, command, user_id, tx_num
+COMMAND_RESULT_TTL = float(os.environ.get('COMMAND_RESULT_TTL', 3600)) # seconds a command's result is kept for retries
+COMMAND_CLAIM_TTL = float(os.environ.get('COMMAND_CLAIM_TTL', 60)) # seconds, if the process running a command dies
+COMMAND_RUNNING = b'running:' # prefix of a claim, followed by its token
+
+# Deletes a lock only if it still holds the caller's token, so that a holder
+# whose lock expired cannot release the lock of the next holder.
+RELEASE_LOCK_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+'''
+release_lock = cache.register_script(RELEASE_LOCK_SCRIPT)
+
+# Extends a lock to ARGV[2] ms only if it still holds the caller's token.
+# Returns 1 if it was extended, 0 if the lock was lost.
+RENEW_LOCK_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('PEXPIRE', KEYS[1], ARGV[2]) end
+return 0
+'''
+renew_lock = cache.register_script(RENEW_LOCK_SCRIPT)
+
+# Replaces a lock with the value ARGV[2] for ARGV[3] ms only if it still holds
+# the caller's token. Returns 1 if it was replaced, 0 if the lock was lost.
+REPLACE_LOCK_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then redis.call('SET', KEYS[1], ARGV[2], 'PX', ARGV[3]) return 1 end
+return 0
+'''
+replace_lock = cache.register_script(REPLACE_LOCK_SCRIPT)
+
+def lock_token():
+    '''
+    Returns a token unique to one acquisition of a lock.
+    '''
+    return uuid.uuid4().hex
 
 class Cache():
     def __init__(self):
@@ -13,7 +54,8 @@ class Cache():
     def add_pending_transaction(self, user_id, tx_type, stock_symbol, amount, unix_timestamp):
         '''
         Adds the provided transaction as a pending transaction the user
-        needs to confirm.
+        needs to confirm, atomically replacing any pending transaction of the
+        same type. The transaction expires after PENDING_TX_TTL seconds.
         '''
         assert type(user_id) == str
         assert tx_type in ['BUY', 'SELL']
@@ -22,20 +64,28 @@ class Cache():
         assert type(unix_timestamp) == float
 
         element_to_insert = {'tx_type': tx_type, 'stock_symbol': stock_symbol, 'amount': amount, 'timestamp': unix_timestamp}
-
-        if tx_type == 'BUY':
-            cache.hset(CACHE_PENDING_BUY_TX_NAME, user_id, dumps(element_to_insert))
-        else:
-            cache.hset(CACHE_PENDING_SELL_TX_NAME, user_id, dumps(element_to_insert))
+        cache.set(CACHE_PENDING_TX_KEY.format(tx_type, user_id), dumps(element_to_insert), ex=PENDING_TX_TTL)
 
     def get_pending_transaction(self, user_id, tx_type):
         '''
         Returns the pending transaction, if one exists.
         '''
-        if tx_type == 'BUY':
-            value = cache.hget(CACHE_PENDING_BUY_TX_NAME, user_id)
-        else:
-            value = cache.hget(CACHE_PENDING_SELL_TX_NAME, user_id)
+        value = cache.get(CACHE_PENDING_TX_KEY.format(tx_type, user_id))
+
+        # Convert to JSON
+        if value:
+            return loads(value)
+        return value
+
+    def pop_pending_transaction(self, user_id, tx_type):
+        '''
+        Returns and deletes the pending transaction in one atomic step, if one
+        exists, so that it can only be committed once.
+        '''
+        pipeline = cache.pipeline(transaction=True)
+        pipeline.get(CACHE_PENDING_TX_KEY.format(tx_type, user_id))
+        pipeline.delete(CACHE_PENDING_TX_KEY.format(tx_type, user_id))
+        value, _ = pipeline.execute()
 
         # Convert to JSON
         if value:
@@ -46,11 +96,112 @@ class Cache():
         '''
         Deletes the pending transaction associated with the user ID, if one
         exists.
-        '''     
-        if tx_type == 'BUY':
-            return cache.hdel(CACHE_PENDING_BUY_TX_NAME, user_id)
-        else:
-            return cache.hdel(CACHE_PENDING_SELL_TX_NAME, user_id)
+        '''
+        return cache.delete(CACHE_PENDING_TX_KEY.format(tx_type, user_id))
 
+    def get_quote(self, stock_symbol):
+        '''
+        Returns the cached quote for the stock symbol, if one is still valid.
+        '''
+        value = cache.get(CACHE_QUOTE_KEY.format(stock_symbol))
+
+        # Convert to JSON
+        if value:
+            return loads(value)
+        return value
 
+    def set_quote(self, stock_symbol, quote):
+        '''
+        Caches the quote returned by the quote server for QUOTE_CACHE_TTL seconds.
+        '''
+        assert type(stock_symbol) == str
+        assert type(quote) == dict
+
+        cache.set(CACHE_QUOTE_KEY.format(stock_symbol), dumps(quote), px=int(QUOTE_CACHE_TTL * 1000))
+
+    def get_quotes(self, stock_symbols):
+        '''
+        Returns the cached quotes that are still valid for the stock symbols,
+        as a dict keyed by symbol, in a single round-trip.
+        '''
+        assert type(stock_symbols) == list
+
+        if not stock_symbols:
+            return {}
+
+        values = cache.mget([CACHE_QUOTE_KEY.format(stock_symbol) for stock_symbol in stock_symbols])
+        return {stock_symbol: loads(value) for stock_symbol, value in zip(stock_symbols, values) if value}
+
+    def set_quotes(self, quotes):
+        '''
+        Caches several quotes, keyed by symbol, in a single round-trip.
+        '''
+        assert type(quotes) == dict
+
+        pipeline = cache.pipeline(transaction=False)
+        for stock_symbol, quote in quotes.items():
+            pipeline.set(CACHE_QUOTE_KEY.format(stock_symbol), dumps(quote), px=int(QUOTE_CACHE_TTL * 1000))
+        pipeline.execute()
+
+    def acquire_quote_lock(self, stock_symbol):
+        '''
+        Attempts to become the only transaction server fetching the stock symbol
+        from the quote server. Returns the lock's token if the lock was
+        acquired, None otherwise. The lock expires on its own after
+        QUOTE_LOCK_TTL seconds.
+        '''
+        token = lock_token()
+        if cache.set(CACHE_QUOTE_LOCK_KEY.format(stock_symbol), token, nx=True, px=int(QUOTE_LOCK_TTL * 1000)):
+            return token
+        return None
+
+    def release_quote_lock(self, stock_symbol, token):
+        '''
+        Releases the quote server lock for the stock symbol, if it is still
+        held with the token returned by acquire_quote_lock.
+        '''
+        return release_lock(keys=[CACHE_QUOTE_LOCK_KEY.format(stock_symbol)], args=[token])
+
+    def claim_command(self, run_id, command, user_id, tx_num):
+        '''
+        Attempts to become the only execution of the user's command tx_num in
+        the client's run. Returns the claim's token if claimed, None otherwise.
+        The claim expires after COMMAND_CLAIM_TTL seconds unless renewed with
+        renew_command or replaced by a result.
+        '''
+        token = COMMAND_RUNNING.decode('utf-8') + lock_token()
+        if cache.set(CACHE_COMMAND_RESULT_KEY.format(run_id, command, user_id, tx_num), token, nx=True, px=int(COMMAND_CLAIM_TTL * 1000)):
+            return token
+        return None
+
+    def renew_command(self, run_id, command, user_id, tx_num, token):
+        '''
+        Extends the claim on the command by COMMAND_CLAIM_TTL seconds. Returns
+        False if the claim was lost.
+        '''
+        return bool(renew_lock(keys=[CACHE_COMMAND_RESULT_KEY.format(run_id, command, user_id, tx_num)], args=[token, int(COMMAND_CLAIM_TTL * 1000)]))
+
+    def get_command_result(self, run_id, command, user_id, tx_num):
+        '''
+        Returns the result stored for the user's command tx_num, a value
+        starting with COMMAND_RUNNING if it is still running, or None if it is
+        neither.
+        '''
+        return cache.get(CACHE_COMMAND_RESULT_KEY.format(run_id, command, user_id, tx_num))
+
+    def set_command_result(self, run_id, command, user_id, tx_num, token, result):
+        '''
+        Stores the result (bytes) of the user's command tx_num for
+        COMMAND_RESULT_TTL seconds in place of its claim, if the claim is still
+        held with token. Returns False if it was not.
+        '''
+        return bool(replace_lock(keys=[CACHE_COMMAND_RESULT_KEY.format(run_id, command, user_id, tx_num)], args=[token, result, int(COMMAND_RESULT_TTL * 1000)]))
+
+    def release_command(self, run_id, command, user_id, tx_num, token):
+        '''
+        Releases the claim on the user's command tx_num without a result, so
+        that it can be run again, if it is still held with token.
+        '''
+        return release_lock(keys=[CACHE_COMMAND_RESULT_KEY.format(run_id, command, user_id, tx_num)], args=[token])
 
+instrument_class(Cache, 'redis')
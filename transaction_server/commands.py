@@ -3,20 +3,53 @@
 This blueprint provides an API to process all user commands specified in:
 https://www.ece.uvic.ca/~seng468/ProjectWebSite/Commands.html
 '''
-from bson import json_util
-from flask import Blueprint, jsonify, request
-import json
+from flask import Blueprint, current_app, g, request
+import os
 import time
+from transaction_server.account_state import account_store
+from transaction_server.admission import admitted
 from transaction_server.cache import Cache
-from transaction_server.db import DB
+from transaction_server.db import SUMMARY_PAGE_SIZE, AccountLoader, DB
+from transaction_server.dispatcher import dispatched, dispatcher
+from transaction_server.encoding import respond
+from transaction_server.idempotency import RUN_ID_HEADER, idempotent
+from transaction_server.instrumentation import instrumented
+from transaction_server.log_segments import LOG_SEGMENTS, log_segmenter
 from transaction_server.logging import Logging, CommandType
-from transaction_server.quoteserver_client import QuoteServerClient
+from transaction_server.profiling import profiled
+from transaction_server.quoteserver_client import QUOTE_BREAKER_RESET, QuoteServerClient
+from transaction_server.triggers import trigger_engine
+
+DUMPLOG_MERGE = os.environ.get('DUMPLOG_MERGE', '1') == '1'
 
 bp = Blueprint('commands', __name__, url_prefix='/commands')
 cache = Cache()
 db = DB()
 
+def get_accounts():
+    '''
+    Returns the account loader for the current request, so that each account
+    is read from the database at most once per command.
+    '''
+    if 'accounts' not in g:
+        g.accounts = AccountLoader(account_store)
+    return g.accounts
+
+def quote_server_unavailable(response):
+    '''
+    Marks the response of a command that could not get a quote as a 503, to
+    be retried once the quote server may have recovered.
+    '''
+    response.status_code = 503
+    response.headers['Retry-After'] = str(int(QUOTE_BREAKER_RESET))
+    return response
+
 @bp.route('/add', methods=['GET'])
+@admitted(CommandType.ADD)
+@dispatched
+@idempotent
+@instrumented(CommandType.ADD)
+@profiled
 def add():
     '''
 	Add the given amount of money to the user's account. GET parameters are:
@@ -43,28 +76,30 @@ def add():
         amount = float(args['amount'])
 
         Logging.log_debug(transactionNum=tx_num, command=CommandType.ADD, username=user_id)
-        if not db.does_account_exist(user_id):
-            db.create_account(user_id)
-
-        matched_count, modified_count = db.add_money_to_account(user_id, amount)
+        balance = get_accounts().deposit(user_id, amount, create=True)
 
         # Log as AccountTransactionType with updated balance
-        Logging.log_account_transaction(transactionNum=tx_num, action='add', username=user_id, funds=float(db.get_account(user_id)['balance']))
+        Logging.log_account_transaction(transactionNum=tx_num, action='add', username=user_id, funds=float(balance))
     except AssertionError as err:
         response['status'] = 'failure'
         response['message'] = str(err)
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.ADD, errorMessage=str(err))
-        return jsonify(response)
+        return respond(response)
 
     Logging.log_user_command(transactionNum=tx_num, command=CommandType.ADD, username=user_id)
     response['status'] = 'success'
-    response['matched_count'] = matched_count
-    response['modified_count'] = modified_count
-    return jsonify(response)
+    response['matched_count'] = 1
+    response['modified_count'] = 1
+    return respond(response)
 
 @bp.route('/quote', methods=['GET'])
+@admitted(CommandType.QUOTE)
+@dispatched
+@idempotent
+@instrumented(CommandType.QUOTE)
+@profiled
 def quote():
     '''
     Get the current quote for the stock for the specified user.
@@ -93,9 +128,18 @@ def quote():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.QUOTE, errorMessage=str(err))
-        return jsonify(response)
+        return respond(response)
+
+    try:
+        price, symbol, username, timestamp, cryptokey = QuoteServerClient.get_quote(stock_symbol, user_id, tx_num, allow_stale=True)
+    except OSError as err:
+        response['status'] = 'failure'
+        response['message'] = 'Quote server unavailable: {}'.format(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.QUOTE, errorMessage=response['message'])
+        return quote_server_unavailable(respond(response))
 
-    price, symbol, username, timestamp, cryptokey = QuoteServerClient.get_quote(stock_symbol, user_id, tx_num)
     Logging.log_user_command(transactionNum=tx_num, command=CommandType.QUOTE, username=user_id)
     response['status'] = 'success'
     response['price'] = price
@@ -103,9 +147,14 @@ def quote():
     response['username'] = username
     response['timestamp'] = timestamp
     response['cryptokey'] = cryptokey
-    return jsonify(response)
+    return respond(response)
 
 @bp.route('/buy', methods=['GET'])
+@admitted(CommandType.BUY)
+@dispatched
+@idempotent
+@instrumented(CommandType.BUY)
+@profiled
 def buy():
     '''
     Buy the dollar amount of the stock for the specified user at the current price.
@@ -136,34 +185,42 @@ def buy():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.BUY, errorMessage=str(err))
-        return jsonify(response)
+        return respond(response)
 
     # Ensure account exists and balance is sufficient.
-    if not db.does_account_exist(userid):
+    account = get_accounts().get(userid, ['balance'])
+    if account is None:
         response['status'] = 'failure'
         response['message'] = 'Account does not exist.'
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.BUY, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     # Get account balance
-    balance = db.get_account(userid)['balance']
+    balance = account['balance']
     if balance < amount:
         response['status'] = 'failure'
         response['message'] = 'Not enough money in account to buy.'
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.BUY, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     # Get quote for stock and determine nearest whole number of shares that can be bought.
-    price, symbol, username, timestamp, cryptokey = QuoteServerClient.get_quote(args['stocksymbol'], args['userid'], tx_num)
+    try:
+        price, symbol, username, timestamp, cryptokey = QuoteServerClient.get_quote(args['stocksymbol'], args['userid'], tx_num)
+    except OSError as err:
+        response['status'] = 'failure'
+        response['message'] = 'Quote server unavailable: {}'.format(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.BUY, errorMessage=response['message'])
+        return quote_server_unavailable(respond(response))
+
     shares_to_buy = amount//price
 
-    # Add transaction as pending confirmation from user & delete any previous pending transactions
-    if cache.get_pending_transaction(userid, 'BUY'):
-        cache.delete_pending_transaction(userid, 'BUY')
+    # Add transaction as pending confirmation from user, replacing any previous pending transaction
     cache.add_pending_transaction(userid, 'BUY', stocksymbol, amount, time.time()) # (shares_to_buy * price)
 
     Logging.log_user_command(transactionNum=tx_num, command=CommandType.BUY, username=args['userid'])
@@ -176,9 +233,14 @@ def buy():
     response['username'] = username
     response['timestamp'] = timestamp
     response['cryptokey'] = cryptokey
-    return jsonify(response)
+    return respond(response)
 
 @bp.route('/commit_buy', methods=['GET'])
+@admitted(CommandType.COMMIT_BUY)
+@dispatched
+@idempotent
+@instrumented(CommandType.COMMIT_BUY)
+@profiled
 def commit_buy():
     '''
 	Commits the most recently executed BUY command.
@@ -206,23 +268,22 @@ def commit_buy():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.COMMIT_BUY, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
-    # Ensure latest buy command exists and is less than 60 seconds old.
-    pending_transaction = cache.get_pending_transaction(user_id, 'BUY')
+    # Ensure latest buy command exists and is less than 60 seconds old, claiming it so it is only committed once.
+    pending_transaction = cache.pop_pending_transaction(user_id, 'BUY')
     if not pending_transaction:
         response['status'] = 'failure'
         response['message'] = 'No pending BUY transaction found.'
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.COMMIT_BUY, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     original_timestamp = pending_transaction['timestamp']
     stock_symbol = pending_transaction['stock_symbol']
     amount = pending_transaction['amount'] # Total share value being bought.
     tx_type = pending_transaction['tx_type']
-    db.log_transaction(user_id, tx_type, stock_symbol, amount, original_timestamp)
 
     current_timestamp = time.time()
     if (current_timestamp - original_timestamp) > 60:
@@ -231,32 +292,42 @@ def commit_buy():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.COMMIT_BUY, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
-    # Delete pending transaction
-    deleted_count = cache.delete_pending_transaction(user_id, 'BUY')
-    assert deleted_count == 1
+    # Reduce account balance by specified amount, only if the balance still covers it.
+    balance = get_accounts().withdraw(user_id, amount)
+    if balance is None:
+        response['status'] = 'failure'
+        response['message'] = 'Not enough money in account to buy.'
 
-    # Reduce account balance by specified amount
-    matched_count, modified_count = db.remove_money_from_account(user_id, amount)
-    assert matched_count == 1
-    assert modified_count == 1
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.COMMIT_BUY, errorMessage=response['message'])
+        return respond(response)
 
     # Log as AccountTransactionType with updated balance
-    Logging.log_account_transaction(transactionNum=tx_num, action='remove', username=user_id, funds=float(db.get_account(user_id)['balance']))
+    Logging.log_account_transaction(transactionNum=tx_num, action='remove', username=user_id, funds=float(balance))
 
     # Increase account amount of stock owned
-    portfolio_matched_count, portfolio_modified_count = db.increase_stock_portfolio_amount(user_id, stock_symbol, amount)
+    get_accounts().add_stock(user_id, stock_symbol, amount)
+
+    # Record the committed transaction for DISPLAY_SUMMARY
+    db.log_transaction(user_id, tx_type, stock_symbol, amount, original_timestamp)
+
     Logging.log_user_command(transactionNum=tx_num, command=CommandType.COMMIT_BUY, username=user_id)
 
     response['status'] = 'success'
     response['message'] = 'Successfully commited BUY transaction for {} for amount {}'.format(stock_symbol, amount)
-    response['matched_count'] = portfolio_matched_count
-    response['modified_count'] = portfolio_modified_count
-    return jsonify(response)
+    response['matched_count'] = 1
+    response['modified_count'] = 1
+    return respond(response)
 
 
 @bp.route('/cancel_buy', methods=['GET'])
+@admitted(CommandType.CANCEL_BUY)
+@dispatched
+@idempotent
+@instrumented(CommandType.CANCEL_BUY)
+@profiled
 def cancel_buy():
     '''
 	Cancels the most recently executed BUY Command
@@ -283,7 +354,7 @@ def cancel_buy():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.CANCEL_BUY, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     # Ensure latest buy command exists and is less than 60 seconds old.
     pending_transaction = cache.get_pending_transaction(userid, 'BUY')
@@ -293,7 +364,7 @@ def cancel_buy():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.CANCEL_BUY, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     original_timestamp = pending_transaction['timestamp']
 
@@ -304,7 +375,7 @@ def cancel_buy():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.CANCEL_BUY, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     Logging.log_user_command(transactionNum=tx_num, command=CommandType.CANCEL_BUY, username=userid)
 
@@ -312,10 +383,15 @@ def cancel_buy():
     deleted_count = cache.delete_pending_transaction(userid, 'BUY')
     response['status'] = 'success'
     response['message'] = 'Successfully cancelled {} BUY transactions'.format(deleted_count)
-    return jsonify(response)
+    return respond(response)
 
 
 @bp.route('/sell', methods=['GET'])
+@admitted(CommandType.SELL)
+@dispatched
+@idempotent
+@instrumented(CommandType.SELL)
+@profiled
 def sell():
     '''
     Sell the specified dollar mount of the stock currently held by the specified user at the current price.
@@ -346,29 +422,39 @@ def sell():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.SELL, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     # Ensure account exists and user owns enough stock to sell at the price specified.
-    if not db.does_account_exist(userid):
+    account = get_accounts().get(userid, ['stocks'])
+    if account is None:
         response['status'] = 'failure'
         response['message'] = 'Account does not exist.'
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.SELL, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     # Ensure user owns sufficient amount of stock at the current price.
-    user_stocks = db.get_account(userid)['stocks']
+    user_stocks = account['stocks']
     if stocksymbol not in user_stocks:
         response['status'] = 'failure'
         response['message'] = 'User does not own any {} stock'.format(stocksymbol)
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.SELL, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     # Get quote for stock and determine nearest whole number of shares that can be bought.
-    price, symbol, username, timestamp, cryptokey = QuoteServerClient.get_quote(stocksymbol, userid, tx_num)
+    try:
+        price, symbol, username, timestamp, cryptokey = QuoteServerClient.get_quote(stocksymbol, userid, tx_num)
+    except OSError as err:
+        response['status'] = 'failure'
+        response['message'] = 'Quote server unavailable: {}'.format(err)
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.SELL, errorMessage=response['message'])
+        return quote_server_unavailable(respond(response))
+
     total_share_value = amount * price
 
     if amount > user_stocks[stocksymbol]: # total_share_value
@@ -378,13 +464,9 @@ def sell():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.SELL, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
-    # Add transaction as pending confirmation from user.
-    # TODO: Replace with Redis?
-    # Delete any previous pending transactions
-    if cache.get_pending_transaction(userid, 'SELL'):
-        cache.delete_pending_transaction(userid, 'SELL')
+    # Add transaction as pending confirmation from user, replacing any previous pending transaction
     cache.add_pending_transaction(userid, 'SELL', stocksymbol, amount, time.time())
 
     Logging.log_user_command(transactionNum=tx_num, command=CommandType.SELL, username=userid)
@@ -395,9 +477,14 @@ def sell():
     response['username'] = username
     response['timestamp'] = timestamp
     response['cryptokey'] = cryptokey
-    return jsonify(response)
+    return respond(response)
 
 @bp.route('/commit_sell', methods=['GET'])
+@admitted(CommandType.COMMIT_SELL)
+@dispatched
+@idempotent
+@instrumented(CommandType.COMMIT_SELL)
+@profiled
 def commit_sell():
     '''
 	Commits the most recently executed SELL command
@@ -424,23 +511,22 @@ def commit_sell():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.COMMIT_SELL, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
-    # Ensure latest sell command exists and is less than 60 seconds old.
-    pending_transaction = cache.get_pending_transaction(user_id, 'SELL')
+    # Ensure latest sell command exists and is less than 60 seconds old, claiming it so it is only committed once.
+    pending_transaction = cache.pop_pending_transaction(user_id, 'SELL')
     if not pending_transaction:
         response['status'] = 'failure'
         response['message'] = 'No pending SELL transaction found.'
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.COMMIT_SELL, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     original_timestamp = pending_transaction['timestamp']
     stock_symbol = pending_transaction['stock_symbol']
     amount = pending_transaction['amount']
     tx_type = pending_transaction['tx_type']
-    db.log_transaction(user_id, tx_type, stock_symbol, amount, original_timestamp)
 
     current_timestamp = time.time()
     if (current_timestamp - original_timestamp) > 60:
@@ -449,31 +535,39 @@ def commit_sell():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.COMMIT_SELL, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
-    # Delete pending transaction
-    deleted_count = cache.delete_pending_transaction(user_id, 'SELL')
-    assert deleted_count == 1
+    # Decrease account amount of stock owned, only if the user still owns enough.
+    if get_accounts().remove_stock(user_id, stock_symbol, amount) is None:
+        response['status'] = 'failure'
+        response['message'] = 'Not enough stock owned to sell'
 
-    # Decrease account amount of stock owned
-    portfolio_matched_count, portfolio_modified_count = db.decrease_stock_portfolio_amount(user_id, stock_symbol, amount)
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.COMMIT_SELL, errorMessage=response['message'])
+        return respond(response)
 
     # Increase account balance by specified amount
-    matched_count, modified_count = db.add_money_to_account(user_id, amount)
-    assert matched_count == 1
-    assert modified_count == 1
+    balance = get_accounts().deposit(user_id, amount)
+
+    # Record the committed transaction for DISPLAY_SUMMARY
+    db.log_transaction(user_id, tx_type, stock_symbol, amount, original_timestamp)
 
     # Log as AccountTransactionType with updated balance
-    Logging.log_account_transaction(transactionNum=tx_num, action='add', username=user_id, funds=float(db.get_account(user_id)['balance']))
+    Logging.log_account_transaction(transactionNum=tx_num, action='add', username=user_id, funds=float(balance))
 
     Logging.log_user_command(transactionNum=tx_num, command=CommandType.COMMIT_SELL, username=user_id)
     response['status'] = 'success'
     response['message'] = 'Successfully commited SELL transaction for {} for amount {}'.format(stock_symbol, amount)
-    response['matched_count'] = portfolio_matched_count
-    response['modified_count'] = portfolio_modified_count
-    return jsonify(response)
+    response['matched_count'] = 1
+    response['modified_count'] = 1
+    return respond(response)
 
 @bp.route('/cancel_sell', methods=['GET'])
+@admitted(CommandType.CANCEL_SELL)
+@dispatched
+@idempotent
+@instrumented(CommandType.CANCEL_SELL)
+@profiled
 def cancel_sell():
     '''
 	Cancels the most recently executed SELL Command
@@ -500,7 +594,7 @@ def cancel_sell():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.CANCEL_SELL, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     # Ensure latest sell command exists and is less than 60 seconds old.
     pending_transaction = cache.get_pending_transaction(userid, 'SELL')
@@ -510,7 +604,7 @@ def cancel_sell():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.CANCEL_SELL, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     original_timestamp = pending_transaction['timestamp']
 
@@ -521,7 +615,7 @@ def cancel_sell():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.CANCEL_SELL, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     Logging.log_user_command(transactionNum=tx_num, command=CommandType.CANCEL_SELL, username=userid)
 
@@ -529,9 +623,14 @@ def cancel_sell():
     deleted_count = cache.delete_pending_transaction(userid, 'SELL')
     response['status'] = 'success'
     response['message'] = 'Successfully cancelled {} SELL transactions'.format(deleted_count)
-    return jsonify(response)
+    return respond(response)
 
 @bp.route('/set_buy_amount', methods=['GET'])
+@admitted(CommandType.SET_BUY_AMOUNT)
+@dispatched
+@idempotent
+@instrumented(CommandType.SET_BUY_AMOUNT)
+@profiled
 def set_buy_amount():
     '''
     Sets a defined amount of the given stock to buy when the current stock price is less than or equal to the BUY_TRIGGER
@@ -564,33 +663,30 @@ def set_buy_amount():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.SET_BUY_AMOUNT, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
-    # Ensure user has enough cash in their account.
-    balance = db.get_account(user_id)['balance']
-    if balance < amount:
+    # Remove money from account and set aside in reserve account, only if the user has enough cash.
+    # TODO: Replace any other existing buy amounts or just increment?
+    if get_accounts().reserve_buy_amount(user_id, stock_symbol, amount) is None:
         response['status'] = 'failure'
         response['message'] = 'Not enough money in account for set buy amount.'
 
          # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.SET_BUY_AMOUNT, errorMessage=response['message'])
-        return jsonify(response)
-
-    # Remove money from account and set aside in reserve account.
-    matched_count, modified_count = db.remove_money_from_account(user_id, amount)
-    assert matched_count == 1
-    assert modified_count == 1
-
-    # TODO: Replace any other existing buy amounts or just increment?
-    reserve_matched_count, reserve_modified_count = db.add_buy_reserve_amount(user_id, stock_symbol, amount)
+        return respond(response)
 
     Logging.log_user_command(transactionNum=tx_num, command=CommandType.SET_BUY_AMOUNT, username=user_id)
     response['status'] = 'success'
-    response['matched_count'] = reserve_matched_count
-    response['modified_count'] = reserve_modified_count
-    return jsonify(response)
+    response['matched_count'] = 1
+    response['modified_count'] = 1
+    return respond(response)
 
 @bp.route('/cancel_set_buy', methods=['GET'])
+@admitted(CommandType.CANCEL_SET_BUY)
+@dispatched
+@idempotent
+@instrumented(CommandType.CANCEL_SET_BUY)
+@profiled
 def cancel_set_buy():
     '''
     Cancels a SET_BUY command issued for the given stock
@@ -620,38 +716,46 @@ def cancel_set_buy():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.CANCEL_SET_BUY, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     # Ensure account exists
-    if not db.does_account_exist(user_id):
+    if not get_accounts().exists(user_id):
         response['status'] = 'failure'
         response['message'] = 'Account does not exist.'
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.CANCEL_SET_BUY, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     # Cancel, or return that no reserve buys were found.
-    cancel_matched, cancel_modified = db.unset_buy_reserve_amount(user_id, stock_symbol)
+    cancel_matched, cancel_modified = account_store.unset_buy_reserve_amount(user_id, stock_symbol)
+    get_accounts().invalidate(user_id, 'reserve_buy')
     if cancel_modified == 0:
         response['status'] = 'failure'
         response['message'] = 'No reserve accounts for stock {} and user {} found.'.format(stock_symbol, user_id)
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.CANCEL_SET_BUY, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     # Remove any buy triggers for that stock
-    db.unset_trigger('BUY', user_id, stock_symbol)
+    account_store.unset_trigger('BUY', user_id, stock_symbol)
+    get_accounts().invalidate(user_id, 'buy_triggers')
+    trigger_engine.disarm('BUY', user_id, stock_symbol)
 
     Logging.log_user_command(transactionNum=tx_num, command=CommandType.CANCEL_SET_BUY, username=user_id)
     response['status'] = 'success'
     response['matched_count'] = cancel_matched
     response['modified_count'] = cancel_modified
-    return jsonify(response)
+    return respond(response)
 
 
 @bp.route('/set_buy_trigger', methods=['GET'])
+@admitted(CommandType.SET_BUY_TRIGGER)
+@dispatched
+@idempotent
+@instrumented(CommandType.SET_BUY_TRIGGER)
+@profiled
 def set_buy_trigger():
     '''
     Sets the trigger point base on the current stock price when any SET_BUY will execute.
@@ -682,26 +786,34 @@ def set_buy_trigger():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.SET_BUY_TRIGGER, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     # Ensure set buy amount exists for user's stock.
-    if stock_symbol not in db.get_account(user_id)['reserve_buy']:
+    account = get_accounts().get(user_id, ['reserve_buy'])
+    if account is None or stock_symbol not in account['reserve_buy']:
         response['status'] = 'failure'
         response['message'] = 'No buy reserve exists for stock {} for user {}'.format(stock_symbol, user_id)
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.SET_BUY_TRIGGER, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
-    db.set_trigger('BUY', user_id, stock_symbol, amount)
+    account_store.set_trigger('BUY', user_id, stock_symbol, amount, tx_num)
+    get_accounts().invalidate(user_id, 'buy_triggers')
+    trigger_engine.arm('BUY', user_id, stock_symbol, amount, tx_num)
 
     Logging.log_user_command(transactionNum=tx_num, command=CommandType.SET_BUY_TRIGGER, username=user_id)
     response['status'] = 'success'
     response['message'] = 'Successfully added trigger for user {} for stock {} at price {}'.format(user_id, stock_symbol, amount)
-    return jsonify(response)
+    return respond(response)
 
 
 @bp.route('/set_sell_amount', methods=['GET'])
+@admitted(CommandType.SET_SELL_AMOUNT)
+@dispatched
+@idempotent
+@instrumented(CommandType.SET_SELL_AMOUNT)
+@profiled
 def set_sell_amount():
     '''
     Sets a defined amount of the specified stock to sell when the current stock price is equal or greater than the sell trigger point
@@ -732,17 +844,18 @@ def set_sell_amount():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.SET_SELL_AMOUNT, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     # Ensure user owns sufficient amount of stock at the current price.
-    user_stocks = db.get_account(user_id)['stocks']
+    account = get_accounts().get(user_id, ['stocks'])
+    user_stocks = account['stocks'] if account else {}
     if stock_symbol not in user_stocks:
         response['status'] = 'failure'
         response['message'] = 'User does not own any {} stock'.format(stock_symbol)
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.SET_SELL_AMOUNT, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     if amount > user_stocks[stock_symbol]: # total_share_value
         response['status'] = 'failure'
@@ -751,22 +864,29 @@ def set_sell_amount():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.SET_SELL_AMOUNT, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     # Set SELL trigger with no price specified (until SET_SELL_TRIGGER called)
-    trigger_matched_count, trigger_modified_count = db.set_trigger('SELL', user_id, stock_symbol, price=None)
+    trigger_matched_count, trigger_modified_count = account_store.set_trigger('SELL', user_id, stock_symbol, price=None, tx_num=tx_num)
+    trigger_engine.disarm('SELL', user_id, stock_symbol)
 
     # Add SELL reserve amount
-    reserve_matched_count, reserve_modified_count = db.add_sell_reserve_amount(user_id, stock_symbol, amount)
+    reserve_matched_count, reserve_modified_count = account_store.add_sell_reserve_amount(user_id, stock_symbol, amount)
+    get_accounts().invalidate(user_id, 'sell_triggers', 'reserve_sell')
 
     Logging.log_user_command(transactionNum=tx_num, command=CommandType.SET_SELL_AMOUNT, username=user_id)
     response['status'] = 'success'
     response['message'] = 'Successfully added trigger for user {} for stock {}.'.format(user_id, stock_symbol)
     response['matched_count'] = reserve_matched_count
     response['modified_count'] = reserve_modified_count
-    return jsonify(response)
+    return respond(response)
 
 @bp.route('/set_sell_trigger', methods=['GET'])
+@admitted(CommandType.SET_SELL_TRIGGER)
+@dispatched
+@idempotent
+@instrumented(CommandType.SET_SELL_TRIGGER)
+@profiled
 def set_sell_trigger():
     '''
     Sets the stock price trigger point for executing any SET_SELL triggers associated with the given stock and user
@@ -799,33 +919,45 @@ def set_sell_trigger():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.SET_SELL_TRIGGER, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     # Ensure SELL trigger for that stock exists.
-    triggers = db.get_account(user_id)['sell_triggers']
+    account = get_accounts().get(user_id, ['sell_triggers'])
+    triggers = account['sell_triggers'] if account else {}
     if stock_symbol not in triggers:
         response['status'] = 'failure'
         response['message'] = 'No sell triggers for stock {}'.format(stock_symbol)
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.SET_SELL_TRIGGER, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
-    # Remove stock amount from account
-    matched_count, modified_count = db.decrease_stock_portfolio_amount(user_id, stock_symbol, amount)
-    assert matched_count == 1
-    assert modified_count == 1
+    # Remove stock amount from account, only if the user owns enough.
+    if get_accounts().remove_stock(user_id, stock_symbol, amount) is None:
+        response['status'] = 'failure'
+        response['message'] = 'Not enough stock owned to set aside'
+
+        # Log as ErrorEventType
+        Logging.log_error_event(transactionNum=tx_num, command=CommandType.SET_SELL_TRIGGER, errorMessage=response['message'])
+        return respond(response)
 
     # Set SELL trigger for stock at that price
-    trigger_matched_count, trigger_modified_count = db.set_trigger('SELL', user_id, stock_symbol, amount)
+    trigger_matched_count, trigger_modified_count = account_store.set_trigger('SELL', user_id, stock_symbol, amount, tx_num)
+    get_accounts().invalidate(user_id, 'sell_triggers')
+    trigger_engine.arm('SELL', user_id, stock_symbol, amount, tx_num)
 
     Logging.log_user_command(transactionNum=tx_num, command=CommandType.SET_SELL_TRIGGER, username=user_id)
     response['status'] = 'success'
     response['matched_count'] = trigger_matched_count
     response['modified_count'] = trigger_modified_count
-    return jsonify(response)
+    return respond(response)
 
 @bp.route('/cancel_set_sell', methods=['GET'])
+@admitted(CommandType.CANCEL_SET_SELL)
+@dispatched
+@idempotent
+@instrumented(CommandType.CANCEL_SET_SELL)
+@profiled
 def cancel_set_sell():
     '''
 	Cancels the SET_SELL associated with the given stock and user
@@ -855,29 +987,37 @@ def cancel_set_sell():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.CANCEL_SET_SELL, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     # Cancel, or return that no reserve sells were found.
-    cancel_matched, cancel_modified = db.unset_sell_reserve_amount(user_id, stock_symbol)
+    cancel_matched, cancel_modified = account_store.unset_sell_reserve_amount(user_id, stock_symbol)
+    get_accounts().invalidate(user_id, 'reserve_sell')
     if cancel_modified == 0:
         response['status'] = 'failure'
         response['message'] = 'No sell reserve accounts for stock {} and user {} found.'.format(stock_symbol, user_id)
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=tx_num, command=CommandType.CANCEL_SET_SELL, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
     # Remove any sell triggers for that stock
-    db.unset_trigger('SELL', user_id, stock_symbol)
+    account_store.unset_trigger('SELL', user_id, stock_symbol)
+    get_accounts().invalidate(user_id, 'sell_triggers')
+    trigger_engine.disarm('SELL', user_id, stock_symbol)
 
     Logging.log_user_command(transactionNum=tx_num, command=CommandType.CANCEL_SET_SELL, username=user_id)
     response['status'] = 'success'
     response['matched_count'] = cancel_matched
     response['modified_count'] = cancel_modified
-    return jsonify(response)
+    return respond(response)
 
 
 @bp.route('/dumplog', methods=['GET'])
+@admitted(CommandType.DUMPLOG)
+@dispatched
+@idempotent
+@instrumented(CommandType.DUMPLOG)
+@profiled
 def dumplog():
     '''
     2 possible parameter combinations:
@@ -895,6 +1035,9 @@ def dumplog():
             Places a complete log file of all transactions that have occurred in the system into the file specified by filename
 
     Output is to specified filename appended with date and time it was created, to keep unique logs.
+    The optional merge parameter (1 or 0, default DUMPLOG_MERGE) selects whether logs are merged from
+    per-server sorted streams or read with a single sorted query.
+    With LOG_SEGMENTS, the complete log file is copied from pre-rendered segments and only recent logs are read.
     '''
     args = dict(request.args)
     response = {'status': None}
@@ -910,27 +1053,35 @@ def dumplog():
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.DUMPLOG, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
-    # Query logs
+    # Query logs, once every log recorded so far has been written.
+    flushed = Logging.flush()
     filename = '{}-{}'.format(args['filename'], time.strftime('%Y%m%d-%H%M%S'))
-    if 'userid' in args:
-        logs = db.get_logs(args['userid'])
-    else:
-        logs = db.get_logs()
+    # Merge per-server sorted streams unless requested otherwise.
+    merge = args.get('merge', '1' if DUMPLOG_MERGE else '0') == '1'
 
-    # Convert logs to XML (Assume logs have been validated when entered.)
-    logs_xml = Logging.convert_dicts_to_xml(logs)
-    logs_xml.write('logs/{}.xml'.format(filename), encoding='utf-8')
+    # Stream logs to XML as they are read (Assume logs have been validated when entered.)
+    if LOG_SEGMENTS and 'userid' not in args:
+        log_segmenter.write_logs_xml('logs/{}.xml'.format(filename), merge=merge)
+    else:
+        Logging.write_logs_xml(Logging.iter_logs(args.get('userid'), merge=merge), 'logs/{}.xml'.format(filename))
 
     # Log as SystemEventType
     Logging.log_system_event(transactionNum=int(args['tx_num']), command=CommandType.DUMPLOG, filename=filename)
     Logging.log_user_command(transactionNum=int(args['tx_num']), command=CommandType.DUMPLOG)
     response['status'] = 'success'
     response['message'] = 'Wrote logs to {}'.format(filename)
-    return jsonify(response)
+    if not flushed:
+        response['warning'] = 'Not every server wrote its recent logs in time, some may be missing.'
+    return respond(response)
 
 @bp.route('/display_summary', methods=['GET'])
+@admitted(CommandType.DISPLAY_SUMMARY)
+@dispatched
+@idempotent
+@instrumented(CommandType.DISPLAY_SUMMARY)
+@profiled
 def display_summary():
     '''
 	Provides a summary to the client of the given user's transaction history and the current status of their accounts as well as any set buy or sell triggers and their parameters
@@ -939,6 +1090,10 @@ def display_summary():
         none
     Post-conditions:
 	    A summary of the given user's transaction history and the current status of their accounts as well as any set buy or sell triggers and their parameters is displayed to the user.
+
+    The transaction history is paginated, newest first: limit (default SUMMARY_PAGE_SIZE) transactions are returned,
+    with the totals per transaction type and, if there are older transactions, a next_cursor to pass as cursor for
+    the next page.
     '''
     args = dict(request.args)
     response = {'status': None}
@@ -948,20 +1103,123 @@ def display_summary():
         assert 'userid' in args, 'userid parameter not provided'
 
         Logging.log_debug(transactionNum=int(args['tx_num']), command=CommandType.DISPLAY_SUMMARY, username=args['userid'])
+        try:
+            limit = int(args.get('limit', SUMMARY_PAGE_SIZE))
+        except ValueError:
+            raise AssertionError('limit must be an integer')
+        totals, transactions, next_cursor = db.get_transaction_summary(args['userid'], args.get('cursor'), limit)
     except AssertionError as err:
         response['status'] = 'failure'
         response['message'] = str(err)
 
         # Log as ErrorEventType
         Logging.log_error_event(transactionNum=int(args.get('tx_num', 99999)), command=CommandType.DISPLAY_SUMMARY, errorMessage=response['message'])
-        return jsonify(response)
+        return respond(response)
 
-    account = json.loads(json_util.dumps(db.get_account(args['userid'])))
-    transactions = json.loads(json_util.dumps(db.get_user_transactions(args['userid'])))
+    account = get_accounts().get(args['userid'])
 
     Logging.log_system_event(transactionNum=int(args['tx_num']), command=CommandType.DISPLAY_SUMMARY, username=args['userid'])
     Logging.log_user_command(transactionNum=int(args['tx_num']), command=CommandType.DISPLAY_SUMMARY, username=args['userid'])
     response['transactions'] = transactions
+    response['totals'] = totals
+    response['next_cursor'] = next_cursor
     response['account'] = account
     response['status'] = 'success'
-    return jsonify(response)
+    return respond(response)
+
+@bp.route('/batch', methods=['POST'])
+@admitted()
+@idempotent
+def batch():
+    '''
+    Executes an ordered list of commands in a single request. The body is a
+    JSON array of objects, each with a command (the name of its route, e.g.
+    commit_buy) and the same parameters as that route:
+
+        [{"command": "add", "tx_num": 1, "userid": "u1", "amount": 100.0}, ...]
+
+    Commands of the same user run in order, one user's commands after the
+    other, in a shared application context so that each account is read from
+    the database at most once for all of them. Each user's commands are
+    dispatched together, so different users' commands run in parallel and in
+    order with the user's other requests. A command without a userid (an
+    administrator DUMPLOG) only runs once every command before it has
+    completed, and before any command after it starts. Logs of every command
+    are written together by the log sink, as for individual requests. Each
+    command is run at most once per tx_num, in the batch's X-Run-Id run, as
+    for individual requests, so a batch can be retried as a whole.
+
+    Returns the result of each command, in the order they were given.
+    '''
+    commands = request.get_json(silent=True)
+    response = {'status': None}
+
+    if type(commands) != list or not all(type(command) == dict for command in commands):
+        response['status'] = 'failure'
+        response['message'] = 'Request body must be a JSON array of commands'
+        return respond(response)
+
+    app = current_app._get_current_object()
+    headers = {RUN_ID_HEADER: request.headers[RUN_ID_HEADER]} if RUN_ID_HEADER in request.headers else {}
+    results = [None] * len(commands)
+
+    for positions_by_user in batch_segments(commands):
+        futures = []
+        for user_id, positions in positions_by_user.items():
+            if user_id is None:
+                run_user_commands(app, commands, positions, results, headers)
+            else:
+                futures.append(dispatcher.submit(str(user_id), run_user_commands, app, commands, positions, results, headers))
+        for future in futures:
+            future.result()
+
+    response['status'] = 'success'
+    response['results'] = results
+    return respond(response)
+
+def batch_segments(commands):
+    '''
+    Splits a batch at the commands without a userid, which must run on their
+    own. Returns the segments in order, each as a dict of the positions of
+    each user's commands, in order, by userid (None for a command without one).
+    '''
+    segments = [[]]
+    for position, command in enumerate(commands):
+        if 'userid' in command:
+            segments[-1].append(position)
+        else:
+            segments.extend([[position], []])
+
+    segments_by_user = []
+    for segment in segments:
+        positions_by_user = {}
+        for position in segment:
+            positions_by_user.setdefault(commands[position].get('userid'), []).append(position)
+        segments_by_user.append(positions_by_user)
+    return segments_by_user
+
+def run_user_commands(app, commands, positions, results, headers):
+    '''
+    Runs one user's commands of a batch in order, storing each result at the
+    command's position. The commands share an application context, and so
+    the account loader returned by get_accounts().
+    '''
+    with app.app_context():
+        for position in positions:
+            params = {key: str(value) for key, value in commands[position].items() if key != 'command'}
+            view = BATCH_COMMANDS.get(commands[position].get('command'))
+            if view is None:
+                results[position] = {'status': 'failure', 'message': 'Unknown command {}'.format(commands[position].get('command'))}
+                continue
+
+            try:
+                with app.test_request_context('{}/{}'.format(bp.url_prefix, view.__name__), query_string=params, headers=headers):
+                    results[position] = view().get_json()
+            except Exception as err:
+                results[position] = {'status': 'failure', 'message': 'Command failed: {}'.format(err)}
+
+BATCH_COMMANDS = {view.__name__: view for view in [
+    add, quote, buy, commit_buy, cancel_buy, sell, commit_sell, cancel_sell,
+    set_buy_amount, cancel_set_buy, set_buy_trigger, set_sell_amount, set_sell_trigger, cancel_set_sell,
+    dumplog, display_summary
+]}
@@ -1,21 +1,133 @@
 #!/usr/bin/env python3
+import heapq
+from operator import itemgetter
 import os
-from pymongo import MongoClient
+import threading
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from transaction_server.instrumentation import instrument_class
 
 HOST = os.environ['DB_HOST']
 DB_PORT = 27017
+LOG_CURSOR_BATCH_SIZE = 10000
+LOG_BUCKET_SECONDS = int(os.environ.get('LOG_BUCKET_SECONDS', 60)) # time window of a log bucket
+LOG_BUCKET_SIZE = int(os.environ.get('LOG_BUCKET_SIZE', 1000)) # events per log bucket, before another is started
+LOG_EVENT_TIMESTAMP = 't' # field code of an event's timestamp, in ms
+LOG_EVENT_USERNAME = 'u' # field code of an event's username
+LOG_EVENT_ID = 'i' # field code of an event's id
+ALL_FIELDS = '*'
+NEW_ACCOUNT_FIELDS = {'stocks': {}, 'reserve_buy': {}, 'reserve_sell': {}, 'buy_triggers': {}, 'sell_triggers': {}}
+DB_MAX_POOL_SIZE = int(os.environ.get('DB_MAX_POOL_SIZE', 100))
+SUMMARY_RECENT_TRANSACTIONS = int(os.environ.get('SUMMARY_RECENT_TRANSACTIONS', 10)) # kept in each user's summary
+SUMMARY_PAGE_SIZE = SUMMARY_RECENT_TRANSACTIONS # transactions per DISPLAY_SUMMARY page, by default
+SUMMARY_MAX_PAGE_SIZE = 100
+TRANSACTION_ORDER = [('timestamp', DESCENDING), ('_id', DESCENDING)] # newest first
+DUPLICATE_KEY_ERROR = 11000
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+def get_client():
+    '''
+    Returns the MongoClient shared by every DB of this process, creating it on
+    first use. A client must not be used across a fork, so a forked worker
+    creates its own instead of inheriting its parent's.
+    '''
+    global _client, _client_pid
+    if _client_pid == os.getpid():
+        return _client
+
+    with _client_lock:
+        if _client_pid != os.getpid():
+            _client = MongoClient(host=HOST, port=DB_PORT, maxPoolSize=DB_MAX_POOL_SIZE, connect=False)
+            _client_pid = os.getpid()
+    return _client
+
+def log_query(user_id=None, since=None, until=None):
+    '''
+    Returns the query for logs of user_id, if specified, with timestamps
+    (in ms) from since and before until, if specified.
+    '''
+    query = {'username': user_id} if user_id else {}
+    if since is not None or until is not None:
+        query['timestamp'] = {}
+        if since is not None:
+            query['timestamp']['$gte'] = since
+        if until is not None:
+            query['timestamp']['$lt'] = until
+    return query
+
+def summary_update(transaction):
+    '''
+    Returns the update of a user's summary that records the transaction: its
+    type's count and amount are added to, and it is kept among the user's
+    SUMMARY_RECENT_TRANSACTIONS most recent transactions.
+    '''
+    return {
+        '$inc': {'totals.{}.count'.format(transaction['tx_type']): 1, 'totals.{}.amount'.format(transaction['tx_type']): transaction['amount']},
+        '$push': {'recent': {'$each': [transaction], '$sort': {'timestamp': 1, '_id': 1}, '$slice': -SUMMARY_RECENT_TRANSACTIONS}},
+    }
+
+def transaction_page_query(user_id, cursor=None):
+    '''
+    Returns the query for the user's transactions older than cursor, if specified.
+    '''
+    query = {'userid': user_id}
+    if cursor:
+        timestamp, _, object_id = cursor.partition(':')
+        assert ObjectId.is_valid(object_id), 'cursor is invalid'
+        try:
+            timestamp = float(timestamp)
+        except ValueError:
+            raise AssertionError('cursor is invalid')
+        query['$or'] = [{'timestamp': {'$lt': timestamp}}, {'timestamp': timestamp, '_id': {'$lt': ObjectId(object_id)}}]
+    return query
+
+def transaction_page(transactions, limit, more):
+    '''
+    Returns the first limit transactions, newest first, without their ids,
+    and the cursor of the page after them, or None if there are no more.
+    '''
+    page = transactions[:limit]
+    cursor = '{!r}:{}'.format(page[-1]['timestamp'], page[-1]['_id']) if more and page else None
+    return [{field: value for field, value in transaction.items() if field != '_id'} for transaction in page], cursor
 
 class DB():
     '''
     The following collections are being used for this application:
         accounts (w/ userid as key)
         logs
+        log_buckets (w/ server and time bucket as key)
         pending_transactions (w/ userid as key)
+        transactions (w/ userid and timestamp as key)
+        summaries (w/ userid as key)
+
+    Every DB of a process shares the connection pool of get_client().
     '''
 
-    def __init__(self):
-        self.client = MongoClient(host=HOST, port=DB_PORT)
-        self.db = self.client.day_trading
+    @property
+    def client(self):
+        return get_client()
+
+    @property
+    def db(self):
+        return get_client().day_trading
+
+    def create_indexes(self):
+        '''
+        Creates the indexes the application's queries rely on. Safe to call on
+        every startup, existing indexes are left as they are.
+        '''
+        self.db.accounts.create_index([('userid', ASCENDING)], unique=True)
+        self.db.logs.create_index([('timestamp', ASCENDING)])
+        self.db.logs.create_index([('username', ASCENDING), ('timestamp', ASCENDING)])
+        self.db.logs.create_index([('server', ASCENDING), ('timestamp', ASCENDING)])
+        self.db.log_buckets.create_index([('s', ASCENDING), ('b', ASCENDING)])
+        self.db.log_buckets.create_index([('e.{}'.format(LOG_EVENT_USERNAME), ASCENDING)])
+        self.db.transactions.create_index([('userid', ASCENDING), ('timestamp', ASCENDING), ('_id', ASCENDING)])
+        self.db.summaries.create_index([('userid', ASCENDING)], unique=True)
 
     def does_account_exist(self, user_id):
         '''
@@ -37,7 +149,7 @@ class DB():
         '''
         assert type(user_id) == str
 
-        insert_one_result = self.db.accounts.insert_one({'userid': user_id, 'balance': 0.0, 'stocks': {}, 'reserve_buy': {}, 'reserve_sell': {}, 'buy_triggers': {}, 'sell_triggers': {}})
+        insert_one_result = self.db.accounts.insert_one(dict(NEW_ACCOUNT_FIELDS, userid=user_id, balance=0.0))
         return insert_one_result.inserted_id
 
     def add_money_to_account(self, user_id, amount):
@@ -88,12 +200,101 @@ class DB():
 
         update_result = self.db.accounts.update_one({'userid': user_id}, {'$inc': {'stocks.{}'.format(stock_symbol): -amount}})
 
-        # If remaining balance 0, unset field.
-        if self.db.accounts.find_one({'userid': user_id})['stocks'][stock_symbol] == 0:
-            self.db.accounts.update_one({'userid': user_id}, {'$unset': {'stocks.{}'.format(stock_symbol): ''}})
+        # If remaining balance 0, unset field. The filter makes this a no-op otherwise.
+        self.db.accounts.update_one({'userid': user_id, 'stocks.{}'.format(stock_symbol): 0}, {'$unset': {'stocks.{}'.format(stock_symbol): ''}})
 
         return update_result.matched_count, update_result.modified_count
 
+    def deposit(self, user_id, amount, create=False):
+        '''
+        Adds the specified amount of money to user_id's account and returns the
+        updated balance, in a single round-trip. If create is True, the account
+        is created first if it does not exist. Returns None if the account does
+        not exist and was not created.
+        '''
+        assert type(user_id) == str
+        assert type(amount) == float
+        assert amount >= 0
+
+        update = {'$inc': {'balance': amount}}
+        if create:
+            update['$setOnInsert'] = NEW_ACCOUNT_FIELDS
+
+        try:
+            account = self.db.accounts.find_one_and_update({'userid': user_id}, update, projection={'_id': False, 'balance': True}, upsert=create, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # A concurrent deposit created the account first, update it instead.
+            account = self.db.accounts.find_one_and_update({'userid': user_id}, update, projection={'_id': False, 'balance': True}, return_document=ReturnDocument.AFTER)
+        return account['balance'] if account else None
+
+    def withdraw(self, user_id, amount):
+        '''
+        Removes the specified amount of money from user_id's account, only if
+        the balance covers it, and returns the updated balance in a single
+        round-trip. Returns None if the account does not exist or the balance
+        is insufficient, in which case the account is left unchanged.
+        '''
+        assert type(user_id) == str
+        assert type(amount) == float
+        assert amount >= 0
+
+        account = self.db.accounts.find_one_and_update({'userid': user_id, 'balance': {'$gte': amount}}, {'$inc': {'balance': -amount}}, projection={'_id': False, 'balance': True}, return_document=ReturnDocument.AFTER)
+        return account['balance'] if account else None
+
+    def add_stock(self, user_id, stock_symbol, amount):
+        '''
+        Increases the amount of stock of specified symbol in user_id's account
+        and returns the updated amount held, in a single round-trip. Returns
+        None if the account does not exist.
+        '''
+        assert type(user_id) == str
+        assert type(stock_symbol) == str
+        assert type(amount) == float
+        assert amount >= 0
+
+        stock_field = 'stocks.{}'.format(stock_symbol)
+        account = self.db.accounts.find_one_and_update({'userid': user_id}, {'$inc': {stock_field: amount}}, projection={'_id': False, stock_field: True}, return_document=ReturnDocument.AFTER)
+        return account['stocks'][stock_symbol] if account else None
+
+    def remove_stock(self, user_id, stock_symbol, amount):
+        '''
+        Decreases the amount of stock of specified symbol in user_id's account,
+        only if the user holds at least that amount, and returns the updated
+        amount held. Returns None if the account does not exist or does not
+        hold enough of the stock, in which case it is left unchanged. A holding
+        that reaches 0 is unset, which is the only case needing a second write.
+        '''
+        assert type(user_id) == str
+        assert type(stock_symbol) == str
+        assert type(amount) == float
+        assert amount >= 0
+
+        stock_field = 'stocks.{}'.format(stock_symbol)
+        account = self.db.accounts.find_one_and_update({'userid': user_id, stock_field: {'$gte': amount}}, {'$inc': {stock_field: -amount}}, projection={'_id': False, stock_field: True}, return_document=ReturnDocument.AFTER)
+        if account is None:
+            return None
+
+        remaining = account['stocks'][stock_symbol]
+        if remaining == 0:
+            self.db.accounts.update_one({'userid': user_id, stock_field: 0}, {'$unset': {stock_field: ''}})
+        return remaining
+
+    def reserve_buy_amount(self, user_id, stock_symbol, amount):
+        '''
+        Moves the specified amount of money from user_id's balance into the
+        BUY reserve for the stock symbol, only if the balance covers it, and
+        returns the updated balance in a single atomic round-trip. Returns None
+        if the account does not exist or the balance is insufficient.
+        '''
+        assert type(user_id) == str
+        assert type(stock_symbol) == str
+        assert type(amount) == float
+        assert amount > 0
+
+        update = {'$inc': {'balance': -amount, 'reserve_buy.{}'.format(stock_symbol): amount}}
+        account = self.db.accounts.find_one_and_update({'userid': user_id, 'balance': {'$gte': amount}}, update, projection={'_id': False, 'balance': True}, return_document=ReturnDocument.AFTER)
+        return account['balance'] if account else None
+
     def get_account(self, user_id):
         '''
         Get details for the account specified by the user_id. Returns dict if account found,
@@ -104,6 +305,19 @@ class DB():
         result = self.db.accounts.find_one({'userid': user_id})
         return result
 
+    def get_account_fields(self, user_id, fields):
+        '''
+        Get the specified top-level fields of the account specified by the
+        user_id. Returns dict with userid and those fields if account found,
+        otherwise None.
+        '''
+        assert type(user_id) == str
+        assert type(fields) == list
+
+        projection = {'_id': False, 'userid': True}
+        projection.update({field: True for field in fields})
+        return self.db.accounts.find_one({'userid': user_id}, projection)
+
     def add_log(self, log):
         '''
         Appends transaction log to the logs collection. This method does not
@@ -114,6 +328,25 @@ class DB():
         insert_one_result = self.db.logs.insert_one(log)
         return insert_one_result.inserted_id
 
+    def add_logs(self, logs):
+        '''
+        Appends several transaction logs to the logs collection in a single
+        round-trip. Each log is given its _id before it is sent, so that
+        retrying the same logs after a partial failure only inserts those
+        that are missing.
+        '''
+        assert type(logs) == list
+
+        for log in logs:
+            log.setdefault('_id', ObjectId())
+        try:
+            self.db.logs.insert_many(logs, ordered=False)
+        except BulkWriteError as err:
+            # Logs inserted by an earlier attempt are already there.
+            if any(error['code'] != DUPLICATE_KEY_ERROR for error in err.details['writeErrors']) or err.details.get('writeConcernErrors'):
+                raise
+        return [log['_id'] for log in logs]
+
     def get_logs(self, user_id=None):
         '''
         Returns the application's logs. If user_id is specified, returns the logs for
@@ -124,6 +357,135 @@ class DB():
             return list(self.db.logs.find({}, {'_id': False}).sort('timestamp', 1))
         return list(self.db.logs.find({'username': user_id}, {'_id': False}).sort('timestamp', 1))
 
+    def iter_logs(self, user_id=None, since=None, until=None):
+        '''
+        Same as get_logs, but returns a cursor that fetches the logs from the
+        database in batches as it is iterated, instead of a list. If since or
+        until are specified, only returns logs with timestamps (in ms) from
+        since and before until.
+        '''
+        query = log_query(user_id, since, until)
+        return self.db.logs.find(query, {'_id': False}, batch_size=LOG_CURSOR_BATCH_SIZE).sort('timestamp', 1)
+
+    def iter_logs_merged(self, user_id=None, since=None, until=None):
+        '''
+        Same as iter_logs, but reads one stream per transaction server, each
+        already sorted by the (server, timestamp) index, and merges them. The
+        database never has to sort the full log in memory, and the time to
+        produce the logs grows with their number rather than with a global sort.
+        '''
+        query = log_query(user_id, since, until)
+        streams = []
+        for server in self.db.logs.distinct('server', query):
+            server_query = dict(query, server=server)
+            streams.append(self.db.logs.find(server_query, {'_id': False}, batch_size=LOG_CURSOR_BATCH_SIZE).sort('timestamp', 1))
+        return heapq.merge(*streams, key=itemgetter('timestamp'))
+
+    def count_logs(self, until):
+        '''
+        Returns the number of logs with timestamps (in ms) before until.
+        '''
+        return self.db.logs.count_documents(log_query(until=until))
+
+    def add_log_events(self, server, events):
+        '''
+        Appends compact log events recorded by server to the log_buckets
+        collection, in a single round-trip. Events are grouped into one document
+        per server and LOG_BUCKET_SECONDS time window, s (server), b (window
+        start, in ms) and n (event count) with the events in the e array. A
+        window's document is only appended to while it holds fewer than
+        LOG_BUCKET_SIZE events, after which another is started.
+
+        Each event is given its id before it is sent. If only some windows are
+        written, their events are removed from events before the error is
+        raised, and events of the same list found already written when it is
+        retried, such as after a lost reply, are not appended again.
+        '''
+        assert type(server) == str
+        assert type(events) == list
+
+        bucket_ms = LOG_BUCKET_SECONDS * 1000
+        if events and LOG_EVENT_ID in events[0]:
+            # Retried: the previous attempt may have written any of the windows.
+            windows = list({event[LOG_EVENT_TIMESTAMP] // bucket_ms * bucket_ms for event in events})
+            written = set(self.db.log_buckets.distinct('e.{}'.format(LOG_EVENT_ID), {
+                's': server, 'b': {'$in': windows}, 'e.{}'.format(LOG_EVENT_ID): {'$in': [event[LOG_EVENT_ID] for event in events]}
+            }))
+            events[:] = [event for event in events if event[LOG_EVENT_ID] not in written]
+        for event in events:
+            event.setdefault(LOG_EVENT_ID, ObjectId())
+
+        buckets = {}
+        for event in events:
+            buckets.setdefault(event[LOG_EVENT_TIMESTAMP] // bucket_ms * bucket_ms, []).append(event)
+
+        operations = [UpdateOne(
+            {'s': server, 'b': bucket, 'n': {'$lt': LOG_BUCKET_SIZE}},
+            {'$push': {'e': {'$each': bucket_events}}, '$inc': {'n': len(bucket_events)}},
+            upsert=True
+        ) for bucket, bucket_events in buckets.items()]
+        if not operations:
+            return 0
+
+        try:
+            self.db.log_buckets.bulk_write(operations, ordered=True)
+        except BulkWriteError as err:
+            # Ordered writes stop at the first error, every window before it was written.
+            write_errors = err.details['writeErrors']
+            written = set(list(buckets)[:write_errors[0]['index'] if write_errors else len(operations)])
+            events[:] = [event for event in events if event[LOG_EVENT_TIMESTAMP] // bucket_ms * bucket_ms not in written]
+            raise
+        return len(events)
+
+    def iter_log_events(self, user_id=None, since=None, until=None):
+        '''
+        Returns an iterator over (server, event) for every compact log event,
+        or those of user_id if specified, in chronological order. If since or
+        until are specified, only returns events with timestamps (in ms) from
+        since and before until. Each server's
+        buckets are read in order with the (s, b) index and merged. Events of a
+        window can be out of order when several processes of a server wrote it,
+        so each window is sorted, which only holds one window in memory.
+        '''
+        bucket_ms = LOG_BUCKET_SECONDS * 1000
+        query = {'e.{}'.format(LOG_EVENT_USERNAME): user_id} if user_id else {}
+        if since is not None or until is not None:
+            query['b'] = {}
+            if since is not None:
+                query['b']['$gte'] = since // bucket_ms * bucket_ms
+            if until is not None:
+                query['b']['$lt'] = until
+        timestamp = itemgetter(LOG_EVENT_TIMESTAMP)
+
+        def selected(event):
+            if user_id and event.get(LOG_EVENT_USERNAME) != user_id:
+                return False
+            return (since is None or event[LOG_EVENT_TIMESTAMP] >= since) and (until is None or event[LOG_EVENT_TIMESTAMP] < until)
+
+        def server_events(server):
+            window, window_events = None, []
+            for bucket in self.db.log_buckets.find(dict(query, s=server), {'_id': False, 'b': True, 'e': True}, batch_size=LOG_CURSOR_BATCH_SIZE).sort('b', 1):
+                if bucket['b'] != window:
+                    for event in sorted(window_events, key=timestamp):
+                        yield server, event
+                    window, window_events = bucket['b'], []
+                window_events.extend(event for event in bucket['e'] if selected(event))
+            for event in sorted(window_events, key=timestamp):
+                yield server, event
+
+        streams = [server_events(server) for server in self.db.log_buckets.distinct('s', query)]
+        return heapq.merge(*streams, key=lambda server_event: server_event[1][LOG_EVENT_TIMESTAMP])
+
+    def count_log_events(self, until):
+        '''
+        Returns the number of compact log events with timestamps (in ms)
+        before until, which must be the start of a LOG_BUCKET_SECONDS window.
+        '''
+        assert until % (LOG_BUCKET_SECONDS * 1000) == 0, 'until must be the start of a log bucket window'
+
+        counts = list(self.db.log_buckets.aggregate([{'$match': {'b': {'$lt': until}}}, {'$group': {'_id': None, 'n': {'$sum': '$n'}}}]))
+        return counts[0]['n'] if counts else 0
+
     def add_pending_transaction(self, user_id, tx_type, stock_symbol, amount, unix_timestamp):
         '''
         Adds the provided transaction as a pending transaction the user
@@ -203,20 +565,24 @@ class DB():
         update_result = self.db.accounts.update_one({'userid': user_id}, {'$unset': {'reserve_sell.{}'.format(stock_symbol): ''}})
         return update_result.matched_count, update_result.modified_count
 
-    def set_trigger(self, trigger_type, user_id, stock_symbol, price):
+    def set_trigger(self, trigger_type, user_id, stock_symbol, price, tx_num=None):
         '''
         Adds trigger for user_id of a specific stock to be executed at specified price.
-        Trigger type is one of BUY or SELL.
+        Trigger type is one of BUY or SELL. The transaction number of the command that
+        set the trigger is kept so that its execution can be logged against it.
         '''
         assert trigger_type in ['BUY', 'SELL']
         assert type(user_id) == str
         assert type(stock_symbol) == str
         # assert type(price) == float price can be None
 
+        update = {'trigger_tx_nums.{}.{}'.format(trigger_type, stock_symbol): tx_num}
         if trigger_type == 'BUY':
-            update_result = self.db.accounts.update_one({'userid': user_id}, {'$set': {'buy_triggers.{}'.format(stock_symbol) : price}})
+            update['buy_triggers.{}'.format(stock_symbol)] = price
         else:
-            update_result = self.db.accounts.update_one({'userid': user_id}, {'$set': {'sell_triggers.{}'.format(stock_symbol) : price}})
+            update['sell_triggers.{}'.format(stock_symbol)] = price
+
+        update_result = self.db.accounts.update_one({'userid': user_id}, {'$set': update})
         return update_result.matched_count, update_result.modified_count
 
     def unset_trigger(self, trigger_type, user_id, stock_symbol):
@@ -227,12 +593,88 @@ class DB():
         assert type(user_id) == str
         assert type(stock_symbol) == str
 
+        update = {'trigger_tx_nums.{}.{}'.format(trigger_type, stock_symbol): ''}
         if trigger_type == 'BUY':
-            update_result = self.db.accounts.update_one({'userid': user_id}, {'$unset': {'buy_triggers.{}'.format(stock_symbol) : ''}})
+            update['buy_triggers.{}'.format(stock_symbol)] = ''
         else:
-            update_result = self.db.accounts.update_one({'userid': user_id}, {'$unset': {'sell_triggers.{}'.format(stock_symbol) : ''}})
+            update['sell_triggers.{}'.format(stock_symbol)] = ''
+
+        update_result = self.db.accounts.update_one({'userid': user_id}, {'$unset': update})
         return update_result.matched_count, update_result.modified_count
 
+    def get_armed_triggers(self):
+        '''
+        Returns a cursor over every account that has at least one BUY or SELL
+        trigger set, projected to the trigger fields.
+        '''
+        return self.db.accounts.find(
+            {'$or': [{'buy_triggers': {'$gt': {}}}, {'sell_triggers': {'$gt': {}}}]},
+            {'_id': False, 'userid': True, 'buy_triggers': True, 'sell_triggers': True, 'trigger_tx_nums': True}
+        )
+
+    def get_trigger_reserves(self, user_ids, stock_symbol):
+        '''
+        Returns the BUY and SELL reserves and triggers held for stock_symbol by
+        each of the specified users, as a dict keyed by user_id, in a single query.
+        '''
+        assert type(user_ids) == list
+        assert type(stock_symbol) == str
+
+        projection = {'_id': False, 'userid': True}
+        projection.update({'{}.{}'.format(field, stock_symbol): True for field in ['reserve_buy', 'reserve_sell', 'buy_triggers', 'sell_triggers']})
+        return {account['userid']: account for account in self.db.accounts.find({'userid': {'$in': user_ids}}, projection)}
+
+    def execute_triggers(self, stock_symbol, buy_fills, sell_fills):
+        '''
+        Executes crossed triggers for stock_symbol in a single bulk write. Fills
+        are lists of (user_id, trigger_price, reserve_amount). A BUY fill moves
+        the reserved money into the stock holding, a SELL fill moves the reserved
+        stock value into the balance; both release the reserve and the trigger.
+        Each update only applies if the trigger and reserve are unchanged, so
+        triggers cancelled or modified concurrently are left untouched.
+        Returns the number of triggers executed.
+        '''
+        assert type(stock_symbol) == str
+
+        operations = []
+        for trigger_type, fills, reserve_field, trigger_field in [('BUY', buy_fills, 'reserve_buy', 'buy_triggers'), ('SELL', sell_fills, 'reserve_sell', 'sell_triggers')]:
+            reserve_key = '{}.{}'.format(reserve_field, stock_symbol)
+            trigger_key = '{}.{}'.format(trigger_field, stock_symbol)
+            for user_id, price, amount in fills:
+                increment = {'stocks.{}'.format(stock_symbol): amount} if trigger_type == 'BUY' else {'balance': amount}
+                operations.append(UpdateOne(
+                    {'userid': user_id, trigger_key: price, reserve_key: amount},
+                    {'$inc': increment, '$unset': {reserve_key: '', trigger_key: '', 'trigger_tx_nums.{}.{}'.format(trigger_type, stock_symbol): ''}}
+                ))
+
+        if not operations:
+            return 0
+
+        bulk_result = self.db.accounts.bulk_write(operations, ordered=False)
+        return bulk_result.modified_count
+
+    def get_balances(self, user_ids):
+        '''
+        Returns the balance of each of the specified users, as a dict keyed by user_id.
+        '''
+        assert type(user_ids) == list
+
+        return {account['userid']: account['balance'] for account in self.db.accounts.find({'userid': {'$in': user_ids}}, {'_id': False, 'userid': True, 'balance': True})}
+
+    def checkpoint_accounts(self, accounts):
+        '''
+        Writes the state of several accounts, held elsewhere, to the accounts
+        collection in a single bulk write. Accounts are created if missing.
+        '''
+        assert type(accounts) == list
+
+        operations = [UpdateOne({'userid': account['userid']}, {'$set': {field: value for field, value in account.items() if field != 'userid'}}, upsert=True) for account in accounts]
+        if not operations:
+            return 0
+
+        bulk_result = self.db.accounts.bulk_write(operations, ordered=False)
+        return bulk_result.modified_count + bulk_result.upserted_count
+
     def log_transaction(self, user_id, tx_type, stock_symbol, amount, unix_timestamp):
         '''
         gets transaction log
@@ -245,6 +687,12 @@ class DB():
 
         document_to_insert = {'userid': user_id, 'tx_type': tx_type, 'stock_symbol': stock_symbol, 'amount': amount, 'timestamp': unix_timestamp}
         insert_one_result = self.db.transactions.insert_one(document_to_insert)
+
+        try:
+            self.db.summaries.update_one({'userid': user_id}, summary_update(document_to_insert), upsert=True)
+        except DuplicateKeyError:
+            # A concurrent transaction created the summary first, update it instead.
+            self.db.summaries.update_one({'userid': user_id}, summary_update(document_to_insert))
         return insert_one_result.inserted_id
 
     def get_user_transactions(self, user_id):
@@ -255,5 +703,170 @@ class DB():
 
         return list(self.db.transactions.find({'userid': user_id}))
 
+    def get_summary(self, user_id):
+        '''
+        Returns the user's summary: transaction totals (count and amount) per
+        type, and their SUMMARY_RECENT_TRANSACTIONS most recent transactions,
+        oldest first. Created and kept up to date by log_transaction, in the
+        same update as each transaction is counted, so that none is missed.
+        '''
+        assert type(user_id) == str
+
+        summary = self.db.summaries.find_one({'userid': user_id}, {'_id': False, 'userid': False})
+        return summary if summary is not None else {'totals': {}, 'recent': []}
+
+    def get_transaction_summary(self, user_id, cursor=None, limit=SUMMARY_PAGE_SIZE):
+        '''
+        Returns the user's transaction totals per type, up to limit of their
+        transactions, newest first and older than cursor if specified, and the
+        cursor of the next page, or None if there are no more. A first page no
+        larger than the summary's recent transactions is read from the summary
+        alone; other pages are read from the (userid, timestamp) index.
+        '''
+        assert type(user_id) == str
+        assert 0 < limit <= SUMMARY_MAX_PAGE_SIZE, 'limit must be between 1 and {}'.format(SUMMARY_MAX_PAGE_SIZE)
+
+        summary = self.get_summary(user_id)
+        count = sum(totals['count'] for totals in summary['totals'].values())
+        recent = summary['recent'][::-1]
+        if not cursor and (limit <= len(recent) or count == len(recent)):
+            return (summary['totals'],) + transaction_page(recent, limit, count > limit)
+
+        transactions = list(self.db.transactions.find(transaction_page_query(user_id, cursor)).sort(TRANSACTION_ORDER).limit(limit + 1))
+        return (summary['totals'],) + transaction_page(transactions, limit, len(transactions) > limit)
+
     def close_connection(self):
-        self.client.close()
+        global _client_pid
+        with _client_lock:
+            if _client_pid == os.getpid():
+                _client.close()
+                _client_pid = None
+
+instrument_class(DB, 'mongo')
+
+
+class AccountLoader():
+    '''
+    Request-scoped view of accounts, so that a command reads each account from
+    the database at most once. Accounts are fetched with a projection of the
+    top-level fields asked for; a later request for other fields only fetches
+    those. Writes made through the loader update the view from their results,
+    and fields changed by other writes must be invalidated by the caller.
+    The loader reads from and writes to any account store with the same
+    account methods as DB.
+    '''
+
+    def __init__(self, db):
+        self.db = db
+        self._accounts = {} # user_id -> (set of loaded fields, account dict or None)
+
+    def get(self, user_id, fields=None):
+        '''
+        Returns user_id's account with at least the specified top-level fields,
+        or None if the account does not exist. All fields are loaded if fields
+        is None; an empty list only checks that the account exists.
+        '''
+        assert type(user_id) == str
+
+        loaded_fields, account = self._accounts.get(user_id, (set(), None))
+        if user_id in self._accounts and (account is None or ALL_FIELDS in loaded_fields):
+            return account
+
+        if fields is None:
+            account = self.db.get_account(user_id)
+            self._accounts[user_id] = ({ALL_FIELDS}, account)
+            return account
+
+        missing_fields = [field for field in fields if field not in loaded_fields]
+        if user_id in self._accounts and not missing_fields:
+            return account
+
+        fetched = self.db.get_account_fields(user_id, missing_fields)
+        if fetched is None:
+            self._accounts[user_id] = ({ALL_FIELDS}, None)
+            return None
+
+        account = dict(account or {}, **fetched)
+        self._accounts[user_id] = (loaded_fields | set(missing_fields), account)
+        return account
+
+    def exists(self, user_id):
+        '''
+        Returns True if user_id's account exists, False otherwise.
+        '''
+        return self.get(user_id, []) is not None
+
+    def invalidate(self, user_id, *fields):
+        '''
+        Drops the specified top-level fields of user_id's account from the
+        view, or the whole account if no fields are given, so that they are
+        read again on next use.
+        '''
+        if not fields or user_id not in self._accounts:
+            self._accounts.pop(user_id, None)
+            return
+
+        loaded_fields, account = self._accounts[user_id]
+        if ALL_FIELDS in loaded_fields:
+            self._accounts.pop(user_id)
+            return
+        self._accounts[user_id] = (loaded_fields - set(fields), account)
+
+    def deposit(self, user_id, amount, create=False):
+        balance = self.db.deposit(user_id, amount, create)
+        if balance is not None and self._accounts.get(user_id, (None, None))[1] is None:
+            # Account may have just been created, only its balance is known.
+            self._accounts[user_id] = ({'balance'}, {'userid': user_id, 'balance': balance})
+        elif balance is not None:
+            self._set(user_id, 'balance', balance)
+        return balance
+
+    def withdraw(self, user_id, amount):
+        balance = self.db.withdraw(user_id, amount)
+        if balance is not None:
+            self._set(user_id, 'balance', balance)
+        return balance
+
+    def add_stock(self, user_id, stock_symbol, amount):
+        holding = self.db.add_stock(user_id, stock_symbol, amount)
+        if holding is not None:
+            self._set(user_id, 'stocks', holding, stock_symbol)
+        return holding
+
+    def remove_stock(self, user_id, stock_symbol, amount):
+        holding = self.db.remove_stock(user_id, stock_symbol, amount)
+        if holding == 0:
+            # A holding that reached 0 was unset.
+            self._unset(user_id, 'stocks', stock_symbol)
+        elif holding is not None:
+            self._set(user_id, 'stocks', holding, stock_symbol)
+        return holding
+
+    def reserve_buy_amount(self, user_id, stock_symbol, amount):
+        balance = self.db.reserve_buy_amount(user_id, stock_symbol, amount)
+        if balance is not None:
+            self._set(user_id, 'balance', balance)
+            self.invalidate(user_id, 'reserve_buy')
+        return balance
+
+    def _loaded_account(self, user_id, field):
+        # Returns the account if the field is part of the view, None otherwise.
+        loaded_fields, account = self._accounts.get(user_id, (set(), None))
+        if account is None or (field not in loaded_fields and ALL_FIELDS not in loaded_fields):
+            return None
+        return account
+
+    def _set(self, user_id, field, value, key=None):
+        account = self._loaded_account(user_id, field)
+        if account is None:
+            return
+
+        if key is None:
+            account[field] = value
+        else:
+            account.setdefault(field, {})[key] = value
+
+    def _unset(self, user_id, field, key):
+        account = self._loaded_account(user_id, field)
+        if account is not None:
+            account.get(field, {}).pop(key, None)
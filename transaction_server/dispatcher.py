@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+'''
+Runs each user's commands one at a time, in the order they arrive, on a pool
+of worker threads. Users with queued commands take turns on the workers, so a
+user whose command is slow only holds up their own later commands, not those
+of other users.
+
+Across processes and transaction servers, a user's commands are serialized by
+a Redis lock on the user, held while each command runs, so that two requests
+for the same user arriving at different workers (such as a retry and the
+original) never run concurrently. nginx already sends each user's requests to
+the same server, so the lock is only contended between the processes of one
+server. A user whose lock is held elsewhere is put back on the ready queue
+after DISPATCH_LOCK_RETRY_INTERVAL seconds, leaving the worker to other users
+meanwhile. The lock is renewed every DISPATCH_LOCK_TTL / 3 seconds while the
+command runs, so that a slow command does not lose it, and only expires if its
+process dies. Commands arriving at different processes run in the order they
+take the lock; clients that need them in order send a user's next command once
+the previous one has completed, as driver.py does.
+'''
+from collections import deque
+from concurrent.futures import Future
+import functools
+import heapq
+import os
+import queue
+import threading
+import time
+import traceback
+from flask import copy_current_request_context, request
+from transaction_server.cache import cache as redis_client, lock_token, release_lock, renew_lock
+
+DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', 16))
+DISPATCH_USER_LOCK = os.environ.get('DISPATCH_USER_LOCK', '1') == '1' # serialize a user's commands across processes
+DISPATCH_LOCK_TTL = float(os.environ.get('DISPATCH_LOCK_TTL', 10)) # seconds, if the process running a command dies
+DISPATCH_LOCK_RETRY_INTERVAL = 0.005 # seconds
+USER_LOCK_KEY = 'user_lock:{}' # user_id
+
+
+class UserLocks():
+    '''
+    Renews the user locks held by the commands running in this process, and
+    puts back on the ready queue the users waiting for a lock held elsewhere
+    once their retry is due, from a single background thread.
+    '''
+
+    def __init__(self, ttl=DISPATCH_LOCK_TTL, retry_interval=DISPATCH_LOCK_RETRY_INTERVAL):
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self._condition = threading.Condition()
+        self._held = {} # token -> user_id
+        self._retries = [] # heap of (due, user_id, ready queue)
+        self._pid = None
+
+    def acquire(self, user_id):
+        '''
+        Takes the user's lock and renews it until released. Returns its token,
+        or None if the lock is held elsewhere.
+        '''
+        token = lock_token()
+        if not redis_client.set(USER_LOCK_KEY.format(user_id), token, nx=True, px=int(self.ttl * 1000)):
+            return None
+
+        with self._condition:
+            self._ensure_started()
+            self._held[token] = user_id
+        return token
+
+    def release(self, user_id, token):
+        with self._condition:
+            self._held.pop(token, None)
+        release_lock(keys=[USER_LOCK_KEY.format(user_id)], args=[token])
+
+    def retry_later(self, user_id, ready):
+        '''
+        Puts the user back on ready after retry_interval seconds.
+        '''
+        with self._condition:
+            self._ensure_started()
+            heapq.heappush(self._retries, (time.time() + self.retry_interval, user_id, ready))
+            self._condition.notify()
+
+    def _ensure_started(self):
+        # The thread does not survive a fork, start one per process.
+        if self._pid != os.getpid():
+            self._held, self._retries = {}, []
+            threading.Thread(target=self._run, name='dispatch-locks', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        renew_at = time.time() + self.ttl / 3
+        while True:
+            with self._condition:
+                now = time.time()
+                while self._retries and self._retries[0][0] <= now:
+                    _, user_id, ready = heapq.heappop(self._retries)
+                    ready.put(user_id)
+                if now < renew_at:
+                    self._condition.wait(min(renew_at, self._retries[0][0] if self._retries else renew_at) - now)
+                    continue
+                held = list(self._held.items())
+
+            renew_at = time.time() + self.ttl / 3
+            for token, user_id in held:
+                try:
+                    renew_lock(keys=[USER_LOCK_KEY.format(user_id)], args=[token, int(self.ttl * 1000)])
+                except Exception:
+                    traceback.print_exc()
+
+
+class Dispatcher():
+    '''
+    A fixed set of worker threads and a queue of commands per user. A user
+    with queued commands is put on the ready queue, from which any worker
+    takes them to run their oldest command, putting them back behind the
+    other ready users if they have more. A user is never on the ready queue
+    while one of their commands runs or waits for their lock, so their
+    commands never run concurrently. Workers are started on first use in
+    each process, as threads do not survive a fork.
+    '''
+
+    def __init__(self, workers=DISPATCH_WORKERS, user_lock=DISPATCH_USER_LOCK):
+        self.workers = workers
+        self.user_lock = user_lock
+        self.user_locks = UserLocks()
+        self._lock = threading.Lock()
+        self._ready = None
+        self._pending = {} # user_id -> deque of commands, while queued or running
+        self._pid = None
+        self._local = threading.local()
+
+    def submit(self, user_id, fn, *args, **kwargs):
+        '''
+        Queues fn(*args, **kwargs) behind user_id's other commands, and
+        returns a Future for its result.
+        '''
+        assert type(user_id) == str
+
+        future = Future()
+        ready = self._ensure_started()
+        with self._lock:
+            commands = self._pending.get(user_id)
+            if commands is None:
+                self._pending[user_id] = deque([(future, fn, args, kwargs)])
+                ready.put(user_id)
+            else:
+                commands.append((future, fn, args, kwargs))
+        return future
+
+    def run(self, user_id, fn, *args, **kwargs):
+        '''
+        Runs fn(*args, **kwargs) behind user_id's other commands and returns
+        its result. Called while running one of the user's commands, e.g. by a
+        command run by another command, fn is run directly instead of waiting
+        behind itself.
+        '''
+        if getattr(self._local, 'user_id', None) == user_id and self._pid == os.getpid():
+            return fn(*args, **kwargs)
+        return self.submit(user_id, fn, *args, **kwargs).result()
+
+    def in_worker(self):
+        '''
+        Returns True when called from one of this process's workers.
+        '''
+        return getattr(self._local, 'user_id', None) is not None and self._pid == os.getpid()
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return self._ready
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._ready = queue.Queue()
+                self._pending = {}
+                for worker in range(self.workers):
+                    threading.Thread(target=self._run, args=(self._ready,), name='dispatch-{}'.format(worker), daemon=True).start()
+                self._pid = os.getpid()
+        return self._ready
+
+    def _run(self, ready):
+        while True:
+            user_id = ready.get()
+            with self._lock:
+                future, fn, args, kwargs = self._pending[user_id][0]
+
+            token, error = None, None
+            if self.user_lock and not future.cancelled():
+                try:
+                    token = self.user_locks.acquire(user_id)
+                except Exception as err:
+                    error = err
+                else:
+                    if token is None:
+                        # Held by one of the user's commands in another process.
+                        self.user_locks.retry_later(user_id, ready)
+                        continue
+
+            with self._lock:
+                self._pending[user_id].popleft()
+            self._local.user_id = user_id
+            try:
+                self._execute(future, fn, args, kwargs, error)
+            finally:
+                self._local.user_id = None
+                if token is not None:
+                    try:
+                        self.user_locks.release(user_id, token)
+                    except Exception:
+                        # The lock expires on its own.
+                        traceback.print_exc()
+
+            with self._lock:
+                if self._pending[user_id]:
+                    ready.put(user_id)
+                else:
+                    del self._pending[user_id]
+
+    def _execute(self, future, fn, args, kwargs, error=None):
+        if not future.set_running_or_notify_cancel():
+            return
+        if error is not None:
+            future.set_exception(error)
+            return
+
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as err:
+            future.set_exception(err)
+
+
+dispatcher = Dispatcher()
+
+def dispatched(view):
+    '''
+    Decorates a command route so that it runs on the worker of the request's
+    userid. Requests without a userid run directly, and fail validation as
+    before if the route requires one.
+    '''
+    @functools.wraps(view)
+    def dispatch_view(*args, **kwargs):
+        user_id = request.args.get('userid')
+        if user_id is None:
+            return view(*args, **kwargs)
+        return dispatcher.run(user_id, copy_current_request_context(view), *args, **kwargs)
+    return dispatch_view
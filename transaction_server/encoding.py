@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+'''
+Encoding of command responses. Responses are serialized in a single pass
+straight from the documents read from Mongo: ObjectIds are written as
+{"$oid": ...} as bson.json_util did, without first dumping and reloading the
+documents through it.
+
+JSON is encoded with orjson, which writes directly to a bytes object, when it
+is installed, and with a shared, preconfigured json encoder otherwise. Clients
+that send Accept: application/msgpack receive MessagePack instead, when msgpack
+is installed.
+'''
+from bson import ObjectId
+from flask import Response, request
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+
+def encode_default(value):
+    '''
+    Returns a serializable form of the BSON types found in Mongo documents.
+    '''
+    if isinstance(value, ObjectId):
+        return {'$oid': str(value)}
+    raise TypeError('Object of type {} is not serializable'.format(type(value).__name__))
+
+_json_encoder = json.JSONEncoder(separators=(',', ':'), default=encode_default)
+
+def encode_json(data):
+    if orjson is not None:
+        return orjson.dumps(data, default=encode_default, option=orjson.OPT_NON_STR_KEYS)
+    return _json_encoder.encode(data).encode('utf-8')
+
+def encode_msgpack(data):
+    return msgpack.packb(data, default=encode_default, use_bin_type=True)
+
+def encode(data, accept=None):
+    '''
+    Returns data encoded as MessagePack if accept, the request's Accept
+    header, asks for it and msgpack is installed, and as JSON otherwise, along
+    with its mimetype.
+    '''
+    if msgpack is not None and accept and MSGPACK_MIMETYPE in accept:
+        return encode_msgpack(data), MSGPACK_MIMETYPE
+    return encode_json(data), JSON_MIMETYPE
+
+def respond(data):
+    '''
+    Returns a response with data encoded for the current request, in place of
+    jsonify.
+    '''
+    body, mimetype = encode(data, request.headers.get('Accept'))
+    return Response(body, mimetype=mimetype)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+'''
+Production serving mode: pre-forked gunicorn workers, one per core by default.
+
+    gunicorn -c transaction_server/gunicorn.conf.py transaction_server:app
+
+The app is imported by each worker after it is forked, so every worker opens
+its own Mongo client and Redis pool and starts its own log writer and
+background threads, none of which survive a fork. Only the worker holding the
+leader lease polls triggers, renders log segments and checkpoints accounts.
+Sending SIGHUP to the master reloads the configuration and code and replaces
+the workers gracefully: workers finish their in-flight requests, within
+graceful_timeout, before they exit.
+'''
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+# With admission control, commands must reach the app to wait in its lanes
+# rather than in gunicorn, so there are threads for the running and waiting
+# commands (ADMISSION_MAX_CONCURRENT and ADMISSION_MAX_QUEUE per lane).
+if os.environ.get('ADMISSION_ENABLED', '0') == '1':
+    threads = int(os.environ.get('GUNICORN_THREADS', int(os.environ.get('ADMISSION_MAX_CONCURRENT', 8)) + 2 * int(os.environ.get('ADMISSION_MAX_QUEUE', 64))))
+else:
+    threads = int(os.environ.get('GUNICORN_THREADS', 4)) # per worker, to overlap database and quote server waits
+backlog = int(os.environ.get('GUNICORN_BACKLOG', 2048)) # pending connections queued by the kernel
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5)) # seconds, for connections from nginx
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60)) # seconds, DUMPLOG can take a while
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30)) # seconds
+preload_app = False # each worker creates its own connections and threads
+
+def worker_exit(server, worker):
+    # Stop polling triggers and write out the worker's buffered logs before it exits.
+    from transaction_server.leader import leader
+    from transaction_server.log_segments import log_segmenter
+    from transaction_server.logging import log_sink
+    from transaction_server.triggers import trigger_engine
+    from transaction_server.db import DB
+
+    trigger_engine.stop()
+    log_segmenter.stop()
+    leader.stop() # hand the lease over at once
+    log_sink.close()
+    DB().close_connection()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+'''
+Idempotent execution of commands, so that clients and nginx can retry a
+command whose response was lost without applying it twice. The first request
+for a command and tx_num (and userid) claims it in Redis and runs the command;
+its response is then stored for COMMAND_RESULT_TTL seconds. Any other request
+for the same command returns the stored response, marked with an
+X-Idempotent-Replay header, without running the command again, after waiting
+for it if it is still running.
+
+Workload files number their commands from 1 on every run, so results are kept
+per run of a client, identified by its X-Run-Id header. Requests without one
+share the DEFAULT_RUN_ID run: a client replaying a workload must send a new
+run id each time, or flush the result:* keys from Redis in between, to not be
+answered with the results of the previous run. A request without a tx_num,
+such as a batch, is identified by a digest of its body instead.
+
+The claim is held with a token and renewed every COMMAND_CLAIM_TTL / 3 seconds
+while the command runs, so that a slow command is not taken over by a retry.
+Only the holder of the claim can replace it with a result or release it.
+'''
+import functools
+import hashlib
+import os
+import threading
+import time
+import traceback
+from flask import Response, request
+from transaction_server.cache import Cache, COMMAND_CLAIM_TTL, COMMAND_RUNNING
+from transaction_server.encoding import respond
+
+IDEMPOTENCY_ENABLED = os.environ.get('IDEMPOTENCY_ENABLED', '1') == '1'
+IDEMPOTENCY_POLL_INTERVAL = 0.01 # seconds
+RUN_ID_HEADER = 'X-Run-Id'
+DEFAULT_RUN_ID = 'default' # run of the requests without an X-Run-Id header
+cache = Cache()
+
+
+class ClaimRenewer():
+    '''
+    Renews the claims of the commands running in this process from a single
+    background thread.
+    '''
+
+    def __init__(self, interval=COMMAND_CLAIM_TTL / 3):
+        self.interval = interval
+        self._claims = {} # token -> (run_id, command, user_id, tx_num)
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def add(self, token, claim):
+        with self._lock:
+            # The renewing thread does not survive a fork, start one per process.
+            if self._pid != os.getpid():
+                self._claims = {}
+                threading.Thread(target=self._run, name='claim-renewer', daemon=True).start()
+                self._pid = os.getpid()
+            self._claims[token] = claim
+
+    def remove(self, token):
+        with self._lock:
+            self._claims.pop(token, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                claims = list(self._claims.items())
+            for token, claim in claims:
+                try:
+                    cache.renew_command(*claim, token)
+                except Exception:
+                    traceback.print_exc()
+
+
+claim_renewer = ClaimRenewer()
+
+
+def idempotent(view):
+    '''
+    Decorates a command route to run at most once per run, tx_num and userid.
+    Returns the route unchanged unless IDEMPOTENCY_ENABLED.
+    '''
+    if not IDEMPOTENCY_ENABLED:
+        return view
+
+    @functools.wraps(view)
+    def idempotent_view(*args, **kwargs):
+        tx_num = request.args.get('tx_num')
+        if tx_num is None:
+            body = request.get_data()
+            if not body:
+                return view(*args, **kwargs)
+            tx_num = 'sha1-' + hashlib.sha1(body).hexdigest()
+        claim = (request.headers.get(RUN_ID_HEADER, DEFAULT_RUN_ID), view.__name__, request.args.get('userid', ''), tx_num)
+
+        # Wait for another request running the command, taking over if its claim expires.
+        deadline = time.time() + COMMAND_CLAIM_TTL
+        token = cache.claim_command(*claim)
+        while token is None:
+            result = cache.get_command_result(*claim)
+            if result is not None and not result.startswith(COMMAND_RUNNING):
+                mimetype, _, body = result.partition(b'\n')
+                response = Response(body, mimetype=mimetype.decode('utf-8'))
+                response.headers['X-Idempotent-Replay'] = '1'
+                return response
+            if time.time() > deadline:
+                return respond({'status': 'failure', 'message': 'Command {} is still running.'.format(tx_num)})
+            time.sleep(IDEMPOTENCY_POLL_INTERVAL)
+            token = cache.claim_command(*claim)
+
+        claim_renewer.add(token, claim)
+        try:
+            response = view(*args, **kwargs)
+        except Exception:
+            cache.release_command(*claim, token)
+            raise
+        finally:
+            claim_renewer.remove(token)
+
+        # A server error is not a result, the command may succeed when retried.
+        if response.status_code >= 500:
+            cache.release_command(*claim, token)
+            return response
+
+        cache.set_command_result(*claim, token, response.mimetype.encode('utf-8') + b'\n' + response.get_data())
+        return response
+    return idempotent_view
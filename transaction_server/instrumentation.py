@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+'''
+Per-command timing of the transaction server's dependencies, enabled with
+METRICS_ENABLED=1. While a command runs, time spent in Mongo, Redis, the quote
+server and audit logging is added up per dependency. The breakdown is returned
+in the command's Server-Timing response header, and aggregated into histograms
+per command type that /metrics exposes in the Prometheus text format.
+
+Times are exclusive: a quote lookup that reads the Redis quote cache counts
+the Redis round-trip under redis, and only the rest under quote_server.
+When disabled, nothing is wrapped, so there is no overhead at all.
+'''
+import functools
+import os
+import threading
+import time
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '0') == '1'
+HISTOGRAM_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0] # seconds
+
+_state = threading.local()
+
+
+class Histogram():
+    '''
+    Cumulative bucket counts, sum and count of observed durations.
+    '''
+
+    def __init__(self):
+        self.buckets = [0] * len(HISTOGRAM_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+class Metrics():
+    '''
+    Histograms of command durations and of the time each command spent in each
+    dependency, keyed by command type, for this process.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.commands = {} # command -> Histogram
+        self.dependencies = {} # (command, dependency) -> Histogram
+        self.calls = {} # (command, dependency) -> number of calls
+
+    def record(self, command, seconds, timings):
+        with self._lock:
+            self.commands.setdefault(command, Histogram()).observe(seconds)
+            for dependency, (dependency_seconds, calls) in timings.items():
+                self.dependencies.setdefault((command, dependency), Histogram()).observe(dependency_seconds)
+                self.calls[(command, dependency)] = self.calls.get((command, dependency), 0) + calls
+
+    def render(self):
+        '''
+        Returns the metrics in the Prometheus text exposition format.
+        '''
+        lines = []
+        with self._lock:
+            lines.append('# HELP transaction_server_command_seconds Time to execute a command.')
+            lines.append('# TYPE transaction_server_command_seconds histogram')
+            for command, histogram in sorted(self.commands.items()):
+                lines.extend(render_histogram('transaction_server_command_seconds', 'command="{}"'.format(command), histogram))
+
+            lines.append('# HELP transaction_server_dependency_seconds Time a command spent in a dependency.')
+            lines.append('# TYPE transaction_server_dependency_seconds histogram')
+            for (command, dependency), histogram in sorted(self.dependencies.items()):
+                lines.extend(render_histogram('transaction_server_dependency_seconds', 'command="{}",dependency="{}"'.format(command, dependency), histogram))
+
+            lines.append('# HELP transaction_server_dependency_calls_total Calls a command made to a dependency.')
+            lines.append('# TYPE transaction_server_dependency_calls_total counter')
+            for (command, dependency), calls in sorted(self.calls.items()):
+                lines.append('transaction_server_dependency_calls_total{{command="{}",dependency="{}"}} {}'.format(command, dependency, calls))
+        return '\n'.join(lines) + '\n'
+
+
+def render_histogram(name, labels, histogram):
+    lines = ['{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, count) for bound, count in zip(HISTOGRAM_BUCKETS, histogram.buckets)]
+    lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, labels, histogram.count))
+    lines.append('{}_sum{{{}}} {}'.format(name, labels, histogram.sum))
+    lines.append('{}_count{{{}}} {}'.format(name, labels, histogram.count))
+    return lines
+
+
+metrics = Metrics()
+
+def timed(dependency, fn):
+    '''
+    Returns fn wrapped to add its exclusive running time to the dependency's
+    timing of the command running on this thread, if any.
+    '''
+    @functools.wraps(fn)
+    def timed_fn(*args, **kwargs):
+        timings = getattr(_state, 'timings', None)
+        if timings is None:
+            return fn(*args, **kwargs)
+
+        # Time spent in nested instrumented calls is subtracted from this one.
+        _state.children.append(0.0)
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            exclusive = elapsed - _state.children.pop()
+            if _state.children:
+                _state.children[-1] += elapsed
+            dependency_seconds, calls = timings.get(dependency, (0.0, 0))
+            timings[dependency] = (dependency_seconds + exclusive, calls + 1)
+    return timed_fn
+
+def instrument_class(cls, dependency, names=None):
+    '''
+    Wraps the public methods of cls, or only those named, to be timed as calls
+    to the dependency. Does nothing unless METRICS_ENABLED.
+    '''
+    if not METRICS_ENABLED:
+        return cls
+
+    for name in names or [name for name in vars(cls) if not name.startswith('_')]:
+        attribute = vars(cls)[name]
+        if isinstance(attribute, staticmethod):
+            setattr(cls, name, staticmethod(timed(dependency, attribute.__func__)))
+        elif callable(attribute):
+            setattr(cls, name, timed(dependency, attribute))
+    return cls
+
+def instrumented(command_type):
+    '''
+    Decorates a command route to time its dependencies, report them in the
+    Server-Timing header and record them under command_type. Returns the
+    route unchanged unless METRICS_ENABLED.
+    '''
+    def decorator(view):
+        if not METRICS_ENABLED:
+            return view
+
+        @functools.wraps(view)
+        def instrumented_view(*args, **kwargs):
+            # A command run by another command is timed as part of it.
+            if getattr(_state, 'timings', None) is not None:
+                return view(*args, **kwargs)
+
+            _state.timings, _state.children = {}, []
+            start = time.perf_counter()
+            try:
+                response = view(*args, **kwargs)
+            finally:
+                timings, _state.timings = _state.timings, None
+                metrics.record(command_type.value, time.perf_counter() - start, timings)
+
+            response.headers['Server-Timing'] = ', '.join(
+                '{};dur={:.3f};desc="{} calls"'.format(dependency, seconds * 1000, calls) for dependency, (seconds, calls) in sorted(timings.items())
+            )
+            return response
+        return instrumented_view
+    return decorator
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+'''
+Election of the one process that runs the background work shared by both
+transaction servers: the trigger engine, the log segmenter and the account
+checkpointer. Every gunicorn worker of every server imports the app and
+campaigns, but only the holder of the lease runs that work, so the quote
+server is polled once per trigger symbol however many workers there are.
+
+The lease is a Redis key set with NX to a token of its holder and a TTL of
+LEADER_LEASE_TTL seconds. The holder renews it every LEADER_RENEW_INTERVAL
+seconds, only while the key still holds its token. If the holder exits or
+hangs, the lease expires and another process takes over.
+'''
+import os
+import threading
+import time
+import traceback
+from transaction_server.cache import cache as redis_client, lock_token, release_lock, renew_lock
+
+LEADER_KEY = 'leader:{}' # role
+LEADER_LEASE_TTL = float(os.environ.get('LEADER_LEASE_TTL', 10)) # seconds
+LEADER_RENEW_INTERVAL = LEADER_LEASE_TTL / 3 # seconds
+
+
+class Leader():
+    '''
+    Campaigns for the lease on a role from a background thread. A process
+    only trusts its lease until it would have expired since it was last
+    acquired or renewed, so it stops leading before another process can
+    take over, even if Redis becomes unreachable.
+    '''
+
+    def __init__(self, role, ttl=LEADER_LEASE_TTL, renew_interval=LEADER_RENEW_INTERVAL):
+        self.key = LEADER_KEY.format(role)
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        self._token = None
+        self._expires = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def is_leader(self):
+        '''
+        Returns True while this process holds the lease.
+        '''
+        return self._token is not None and time.time() < self._expires
+
+    def start(self):
+        '''
+        Starts campaigning, if not already.
+        '''
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._run, name='leader', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stops campaigning and gives up the lease, so that another process
+        takes over without waiting for it to expire.
+        '''
+        self._stop.set()
+        token, self._token = self._token, None
+        if token is not None:
+            release_lock(keys=[self.key], args=[token])
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.campaign()
+            except Exception:
+                # The lease is no longer trusted once it would have expired.
+                traceback.print_exc()
+            self._stop.wait(self.renew_interval)
+
+    def campaign(self):
+        '''
+        Renews the lease if held, or attempts to acquire it otherwise.
+        Returns True if this process holds it.
+        '''
+        started = time.time()
+        ttl_ms = int(self.ttl * 1000)
+        if self._token is not None and renew_lock(keys=[self.key], args=[self._token, ttl_ms]):
+            self._expires = started + self.ttl
+            return True
+
+        token = lock_token()
+        if redis_client.set(self.key, token, nx=True, px=ttl_ms):
+            self._token, self._expires = token, started + self.ttl
+            return True
+
+        self._token = None
+        return False
+
+
+leader = Leader('background')
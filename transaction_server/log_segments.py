@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+'''
+Pre-rendered XML of the audit log, so that a full DUMPLOG copies bytes instead
+of querying and rendering every log. Logs are append-only: once every server
+has written the logs of a LOG_SEGMENT_SECONDS window, which is assumed after
+LOG_SEGMENT_GRACE more seconds, its XML never changes. A background thread
+renders such sealed windows into segment files under LOG_SEGMENT_DIR, and a
+full DUMPLOG writes the segments followed by the few logs recorded since the
+last one, rendered as usual.
+
+Segments are contiguous, each starting where the previous one ends, so windows
+without logs are folded into the next segment that has some. They are named
+<start>-<end>-<count>.xml, with timestamps in ms. Before using them, a dump
+checks that their counts add up to the logs in the database before the last
+segment's end. If they do not, because a log was written after its window was
+sealed or the logs were cleared, the segments are discarded and rebuilt.
+
+LOG_SEGMENT_DIR may be shared by several processes and transaction servers.
+Only the process holding the leader lease (see leader.py) renders segments.
+A lock file in the directory still lets only one process render at a time,
+should two briefly both believe they lead, and keeps segments from being
+discarded while they are being copied.
+'''
+import fcntl
+import os
+import re
+import shutil
+import threading
+import time
+import traceback
+from transaction_server.db import LOG_BUCKET_SECONDS
+from transaction_server.leader import leader
+from transaction_server.logging import Logging, LOG_STORAGE, XML_WRITE_BUFFER_SIZE
+
+LOG_SEGMENTS = os.environ.get('LOG_SEGMENTS', '1') == '1'
+LOG_SEGMENT_DIR = os.environ.get('LOG_SEGMENT_DIR', 'logs/segments')
+LOG_SEGMENT_SECONDS = int(os.environ.get('LOG_SEGMENT_SECONDS', 60)) # time window of a segment
+LOG_SEGMENT_GRACE = float(os.environ.get('LOG_SEGMENT_GRACE', 30)) # seconds for every server to write a window's logs
+SEGMENT_FILENAME = re.compile(r'^(\d+)-(\d+)-(\d+)\.xml$')
+
+
+class LogSegmenter():
+    '''
+    Renders sealed windows of logs into segment files every LOG_SEGMENT_SECONDS,
+    and writes full log files from them.
+    '''
+
+    def __init__(self, directory=LOG_SEGMENT_DIR, seconds=LOG_SEGMENT_SECONDS, grace=LOG_SEGMENT_GRACE):
+        # Compact logs are counted a whole bucket at a time.
+        assert LOG_STORAGE != 'compact' or seconds % LOG_BUCKET_SECONDS == 0, 'LOG_SEGMENT_SECONDS must be a multiple of LOG_BUCKET_SECONDS'
+
+        self.directory = directory
+        self.seconds = seconds
+        self.grace = grace
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        '''
+        Starts campaigning for the leader lease and the rendering thread, if
+        not already running.
+        '''
+        if self._thread is not None:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        leader.start()
+        self._thread = threading.Thread(target=self._run, name='log-segmenter', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.seconds):
+            if not leader.is_leader():
+                continue
+            try:
+                self.render_sealed()
+            except Exception:
+                # Retried on the next period, from the end of the last segment.
+                traceback.print_exc()
+
+    def segments(self):
+        '''
+        Returns (start, end, count, path) of every segment, in order.
+        '''
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+
+        segments = []
+        for name in names:
+            match = SEGMENT_FILENAME.match(name)
+            if match:
+                start, end, count = [int(group) for group in match.groups()]
+                segments.append((start, end, count, os.path.join(self.directory, name)))
+        return sorted(segments)
+
+    def lock(self):
+        '''
+        Returns the open lock file, to be locked with fcntl.flock and closed to unlock.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        return open(os.path.join(self.directory, '.lock'), 'w')
+
+    def render_sealed(self):
+        '''
+        Renders the logs from the end of the last segment to the end of the
+        last sealed window into a new segment. Returns the new segment, or None
+        if there were no such logs or another process is rendering.
+        '''
+        with self.lock() as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+
+            segments = self.segments()
+            start = segments[-1][1] if segments else 0
+            window_ms = self.seconds * 1000
+            end = int((time.time() - self.grace) * 1000) // window_ms * window_ms
+            if end <= start:
+                return None
+
+            # Rendered under a name segments() ignores until it is complete.
+            temp_path = os.path.join(self.directory, '.{}-{}.xml.tmp'.format(start, end))
+            count = 0
+            with open(temp_path, 'w', encoding='utf-8', buffering=XML_WRITE_BUFFER_SIZE) as f:
+                for log_entry in Logging.iter_logs(since=start, until=end):
+                    f.write(Logging.render_log_xml(log_entry))
+                    count += 1
+
+            if count == 0:
+                os.remove(temp_path)
+                return None
+
+            path = os.path.join(self.directory, '{}-{}-{}.xml'.format(start, end, count))
+            os.replace(temp_path, path)
+            return start, end, count, path
+
+    def complete(self, segments):
+        '''
+        Returns True if the counts of the segments add up to the logs in the
+        database before the last segment's end.
+        '''
+        return not segments or sum(segment[2] for segment in segments) == Logging.count_logs(segments[-1][1])
+
+    def write_logs_xml(self, path, merge=True):
+        '''
+        Writes every log to an XML log file, in the same format as
+        Logging.write_logs_xml: the segments are copied as they are, and only
+        the logs recorded since the last one are queried and rendered, from
+        per-server streams if merge.
+        '''
+        with self.lock() as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+
+            segments = self.segments()
+            if not self.complete(segments):
+                # Converting a shared lock to an exclusive one releases it
+                # first, so the segments are checked again once it is held.
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                segments = self.segments()
+                if not self.complete(segments):
+                    for segment in segments:
+                        os.remove(segment[3])
+                    segments = []
+
+            with open(path, 'w', encoding='utf-8', buffering=XML_WRITE_BUFFER_SIZE) as f:
+                f.write('<log>\n')
+                for _, _, _, segment_path in segments:
+                    with open(segment_path, 'r', encoding='utf-8') as segment:
+                        shutil.copyfileobj(segment, f, XML_WRITE_BUFFER_SIZE)
+                for log_entry in Logging.iter_logs(merge=merge, since=segments[-1][1] if segments else None):
+                    f.write(Logging.render_log_xml(log_entry))
+                f.write('</log>')
+
+
+log_segmenter = LogSegmenter()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+'''
+Background writer for audit logs. Logs are buffered in a bounded queue and
+written in batches by a single thread, so request handlers no longer wait on a
+Mongo round-trip for every log they record.
+'''
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 100000))
+LOG_BATCH_SIZE = int(os.environ.get('LOG_BATCH_SIZE', 1000))
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', 0.05)) # seconds
+LOG_CLOSE_TIMEOUT = float(os.environ.get('LOG_CLOSE_TIMEOUT', 10)) # seconds to write out queued logs on exit
+LOG_RETRY_INTERVAL = 1.0 # seconds
+
+
+class FlushMarker():
+    '''
+    Queued behind the logs a flush waits for, and set once they are written.
+    '''
+
+    def __init__(self):
+        self.written = threading.Event()
+
+
+class LogSink():
+    '''
+    Buffers logs and passes them to write_batch, in the order they were put,
+    once LOG_BATCH_SIZE logs are queued or LOG_FLUSH_INTERVAL seconds after the
+    oldest buffered log, whichever comes first. When the queue is full, put()
+    blocks until the writer catches up, unless block is False: then logs that
+    do not fit are handed to a thread that waits for room, in order, so that
+    an event loop recording logs is never blocked. Failed batches are retried
+    until they are written, so no log is dropped; write_batch must therefore
+    not write a log twice when the same batch is passed to it again.
+    '''
+
+    def __init__(self, write_batch, max_size=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL, block=True):
+        self.write_batch = write_batch
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block = block
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._closed = False
+        self._overflow = None
+        self._overflowing = 0 # items handed to the overflow thread and not queued yet
+
+    def put(self, log):
+        '''
+        Queues the log to be written.
+        '''
+        assert type(log) == dict
+
+        log_queue = self._ensure_started()
+        if self.block:
+            log_queue.put(log)
+        else:
+            self._put_nowait(log_queue, log)
+
+    def flush(self, timeout=None):
+        '''
+        Blocks until every log queued so far has been written, or for at most
+        timeout seconds. Logs queued meanwhile are not waited for. Returns
+        True if they were written.
+        '''
+        if self._queue is None or self._pid != os.getpid():
+            return True
+
+        marker = FlushMarker()
+        deadline = None if timeout is None else time.time() + timeout
+        if self.block:
+            try:
+                self._queue.put(marker, timeout=timeout)
+            except queue.Full:
+                return False
+        else:
+            self._put_nowait(self._queue, marker)
+        return marker.written.wait(None if deadline is None else max(0, deadline - time.time()))
+
+    def close(self, timeout=LOG_CLOSE_TIMEOUT):
+        '''
+        Writes out every queued log and stops the writer thread, waiting at
+        most timeout seconds so that an unreachable database cannot block the
+        process from exiting. Logs not written by then are lost.
+        '''
+        with self._lock:
+            if self._thread is None or self._closed or self._pid != os.getpid():
+                return
+            self._closed = True
+
+        deadline = time.time() + timeout
+        if self.block:
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+        else:
+            self._put_nowait(self._queue, None)
+        self._thread.join(max(0, deadline - time.time()))
+        if self._thread.is_alive():
+            print('Log sink closed before every queued log was written', file=sys.stderr)
+
+    def _put_nowait(self, log_queue, item):
+        # Once an item is handed to the overflow thread, the items after it
+        # are as well until it is queued, to keep them in order.
+        with self._lock:
+            if not self._overflowing:
+                try:
+                    log_queue.put_nowait(item)
+                    return
+                except queue.Full:
+                    pass
+            if self._overflow is None:
+                self._overflow = queue.SimpleQueue()
+                threading.Thread(target=self._run_overflow, args=(log_queue, self._overflow), name='log-sink-overflow', daemon=True).start()
+            self._overflowing += 1
+            self._overflow.put(item)
+
+    def _run_overflow(self, log_queue, overflow):
+        while True:
+            log_queue.put(overflow.get())
+            with self._lock:
+                self._overflowing -= 1
+
+    def _ensure_started(self):
+        # The writer thread does not survive a fork, start one per process.
+        if self._pid == os.getpid():
+            return self._queue
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.max_size)
+                self._overflow = None
+                self._overflowing = 0
+                self._thread = threading.Thread(target=self._run, name='log-sink', daemon=True)
+                self._closed = False
+                self._thread.start()
+                self._pid = os.getpid()
+        return self._queue
+
+    def _run(self):
+        log_queue = self._queue
+        stopping = False
+        while not stopping:
+            batch = [log_queue.get()]
+            deadline = time.time() + self.flush_interval
+
+            # Gather more logs until the batch is full or the interval has
+            # passed, or at once for a flush or close waiting on the batch.
+            while len(batch) < self.batch_size and type(batch[-1]) == dict:
+                timeout = deadline - time.time()
+                try:
+                    batch.append(log_queue.get(timeout=timeout) if timeout > 0 else log_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                stopping = True
+
+            logs = [log for log in batch if type(log) == dict]
+            while logs:
+                try:
+                    self.write_batch(logs)
+                    break
+                except Exception:
+                    traceback.print_exc()
+                    time.sleep(LOG_RETRY_INTERVAL)
+
+            for item in batch:
+                if isinstance(item, FlushMarker):
+                    item.written.set()
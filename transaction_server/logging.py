@@ -1,14 +1,94 @@
 #!/usr/bin/env python3
+import atexit
 from enum import Enum
+import functools
+import os
 import socket
+import threading
 import time
-from transaction_server.db import DB
+import traceback
+import uuid
+from transaction_server.cache import cache as redis_client
+from transaction_server.db import DB, LOG_EVENT_ID, LOG_EVENT_TIMESTAMP, LOG_EVENT_USERNAME
+from transaction_server.instrumentation import instrument_class
+from transaction_server.log_sink import LogSink
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
 
 MIN_TIMESTAMP_LIMIT = 1641024000000
 MAX_TIMESTAMP_LIMIT = 1651388400000
+XML_WRITE_BUFFER_SIZE = 1 << 20 # bytes
 SERVER_NAME = socket.gethostname()
+LOG_STORAGE = os.environ.get('LOG_STORAGE', 'documents') # documents (one per log) or compact (time buckets)
+LOG_FLUSH_CHANNEL = 'logs:flush'
+LOG_FLUSH_ACKS_KEY = 'logs:flush_acks:{}' # flush request id
+LOG_FLUSH_TIMEOUT = float(os.environ.get('LOG_FLUSH_TIMEOUT', 10)) # seconds to wait for every process to write its logs
+LOG_FLUSH_RETRY_INTERVAL = 1.0 # seconds
 db = DB()
+log_sink = LogSink(functools.partial(db.add_log_events, SERVER_NAME) if LOG_STORAGE == 'compact' else db.add_logs)
+
+# Write out buffered logs before the process exits.
+atexit.register(log_sink.close)
+
+
+class FlushListener():
+    '''
+    Listens, in every process that records logs, for requests from any process
+    of either transaction server to write out every log, published on
+    LOG_FLUSH_CHANNEL. Each request is acknowledged by pushing to its acks
+    list once the logs this process queued before it are written.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        '''
+        Subscribes to flush requests and starts the listening thread, if not
+        already running in this process.
+        '''
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # Subscribed before the process queues its first log, so no
+                # flush request can miss a log it queued.
+                pubsub = self._subscribe()
+                threading.Thread(target=self._run, args=(pubsub,), name='log-flush-listener', daemon=True).start()
+                self._pid = os.getpid()
+
+    def _subscribe(self):
+        pubsub = redis_client.pubsub()
+        pubsub.subscribe(LOG_FLUSH_CHANNEL)
+        # Wait for the subscription to be confirmed.
+        while pubsub.get_message(timeout=LOG_FLUSH_TIMEOUT) is None:
+            pass
+        return pubsub
+
+    def _run(self, pubsub):
+        while True:
+            try:
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    if log_sink.flush(LOG_FLUSH_TIMEOUT):
+                        acks_key = LOG_FLUSH_ACKS_KEY.format(message['data'].decode('utf-8'))
+                        pipeline = redis_client.pipeline(transaction=False)
+                        pipeline.rpush(acks_key, SERVER_NAME)
+                        pipeline.expire(acks_key, int(LOG_FLUSH_TIMEOUT) + 1)
+                        pipeline.execute()
+            except Exception:
+                # Resubscribe; requests published meanwhile time out.
+                traceback.print_exc()
+                time.sleep(LOG_FLUSH_RETRY_INTERVAL)
+                try:
+                    pubsub = self._subscribe()
+                except Exception:
+                    pass
+
+flush_listener = FlushListener()
 
 # Logging functionality for transaction server. Validation is performed
 # according to the following:
@@ -41,6 +121,68 @@ class CommandType(Enum):
     DUMPLOG = 'DUMPLOG'
     DISPLAY_SUMMARY = 'DISPLAY_SUMMARY'
 
+# Compact logs store logtype and command as their position in these enums, so
+# new members must only ever be added at the end. The server and timestamp
+# are stored separately, other fields under the codes below.
+LOG_TYPES = [log_type.value for log_type in LogType]
+COMMANDS = [command.value for command in CommandType]
+LOG_TYPE_CODES = {log_type: code for code, log_type in enumerate(LOG_TYPES)}
+COMMAND_CODES = {command: code for code, command in enumerate(COMMANDS)}
+FIELD_CODES = {
+    'transactionNum': 'x',
+    'command': 'c',
+    'username': LOG_EVENT_USERNAME,
+    'price': 'p',
+    'stockSymbol': 's',
+    'quoteServerTime': 'q',
+    'cryptokey': 'k',
+    'action': 'a',
+    'funds': 'f',
+    'errorMessage': 'e',
+    'debugMessage': 'd',
+    'filename': 'n',
+}
+FIELD_NAMES = {code: field for field, code in FIELD_CODES.items()}
+
+def compact_log(log):
+    '''
+    Returns the log as a compact event: fields under their short codes in the
+    same order, logtype and command as integers, and without the server,
+    which is stored once per bucket of events.
+    '''
+    event = {}
+    for field, value in log.items():
+        if field == 'logtype':
+            event['l'] = LOG_TYPE_CODES[value]
+        elif field == 'timestamp':
+            event[LOG_EVENT_TIMESTAMP] = value
+        elif field == 'command':
+            event[FIELD_CODES['command']] = COMMAND_CODES[value]
+        elif field != 'server':
+            event[FIELD_CODES.get(field, field)] = value
+    return event
+
+def expand_log(server, event):
+    '''
+    Returns the log a compact event was made from, as recorded by server,
+    with its fields in the order they were recorded, without its id.
+    '''
+    log = {}
+    for code, value in event.items():
+        if code == LOG_EVENT_ID:
+            continue
+        elif code == 'l':
+            log['logtype'] = LOG_TYPES[value]
+        elif code == LOG_EVENT_TIMESTAMP:
+            # Logs are recorded with logtype, server and timestamp last.
+            log['server'] = server
+            log['timestamp'] = value
+        elif code == FIELD_CODES['command']:
+            log['command'] = COMMANDS[value]
+        else:
+            log[FIELD_NAMES.get(code, code)] = value
+    return log
+
 def is_unix_timestamp_in_range(unix_timestamp_sec):
     assert type(unix_timestamp_sec) == int
     return (unix_timestamp_sec > MIN_TIMESTAMP_LIMIT) and (unix_timestamp_sec < MAX_TIMESTAMP_LIMIT)
@@ -52,7 +194,8 @@ def is_stock_symbol(symbol):
 class Logging():
     '''
     Every log has a timestamp and server name that this
-    class fetches every time.
+    class fetches every time. Logs are written to the database in the
+    background by log_sink; call flush() before reading them back.
     '''
 
     @staticmethod
@@ -62,8 +205,52 @@ class Logging():
         log_params['server'] = SERVER_NAME
         log_params['timestamp'] = int(time.time() * 1000) # ms
 
-        inserted_id = db.add_log(log_params)
-        return inserted_id
+        flush_listener.start()
+        log_sink.put(compact_log(log_params) if LOG_STORAGE == 'compact' else log_params)
+
+    @staticmethod
+    def flush(timeout=LOG_FLUSH_TIMEOUT):
+        '''
+        Blocks until every log recorded so far, by any process of either
+        transaction server, is written to the database. A flush request is
+        published to every process that has recorded logs, and each of them
+        acknowledges it once its queued logs are written. Returns False if
+        they did not all acknowledge it within timeout seconds.
+        '''
+        deadline = time.time() + timeout
+        request_id = uuid.uuid4().hex
+        receivers = redis_client.publish(LOG_FLUSH_CHANNEL, request_id)
+        for _ in range(receivers):
+            remaining = deadline - time.time()
+            if remaining <= 0 or redis_client.blpop(LOG_FLUSH_ACKS_KEY.format(request_id), timeout=remaining) is None:
+                return False
+        return True
+
+    @staticmethod
+    def iter_logs(user_id=None, merge=True, since=None, until=None):
+        '''
+        Returns an iterator over the logs, or those of user_id if specified, in
+        chronological order and in the logfile schema, whichever way they are
+        stored. If since or until are specified, only logs with timestamps (in
+        ms) from since and before until are returned. With one document per
+        log, merge selects whether per-server sorted streams are merged or a
+        single sorted query is used; compact logs are always read per server
+        and merged.
+        '''
+        if LOG_STORAGE == 'compact':
+            return (expand_log(server, event) for server, event in db.iter_log_events(user_id, since, until))
+        if merge:
+            return db.iter_logs_merged(user_id, since, until)
+        return db.iter_logs(user_id, since, until)
+
+    @staticmethod
+    def count_logs(until):
+        '''
+        Returns the number of logs with timestamps (in ms) before until.
+        '''
+        if LOG_STORAGE == 'compact':
+            return db.count_log_events(until)
+        return db.count_logs(until)
 
     @staticmethod
     def log_user_command(**log_params):
@@ -170,3 +357,30 @@ class Logging():
         tree = ET.ElementTree(xml_root)
         ET.indent(tree, space='\t', level=0)
         return tree
+
+    @staticmethod
+    def render_log_xml(log_entry):
+        '''
+        Renders a single log as an indented XML element of the log file, in
+        the same format convert_dicts_to_xml produces.
+        '''
+        parts = ['\t<{}>\n'.format(log_entry['logtype'])]
+        for log_field, value in log_entry.items():
+            if log_field == 'logtype': continue
+            parts.append('\t\t<{0}>{1}</{0}>\n'.format(log_field, escape(str(value))))
+        parts.append('\t</{}>\n'.format(log_entry['logtype']))
+        return ''.join(parts)
+
+    @staticmethod
+    def write_logs_xml(logs, path):
+        '''
+        Writes the logs to an XML log file one element at a time, so memory
+        use stays constant however many logs the iterable yields.
+        '''
+        with open(path, 'w', encoding='utf-8', buffering=XML_WRITE_BUFFER_SIZE) as f:
+            f.write('<log>\n')
+            for log_entry in logs:
+                f.write(Logging.render_log_xml(log_entry))
+            f.write('</log>')
+
+instrument_class(Logging, 'logging', ['_Logging__log_transaction', 'flush'])
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+'''
+Statistical profiling of the live transaction server. A sampler thread reads
+the stack of each profiled thread every PROFILE_INTERVAL seconds and counts
+identical stacks. Results are written under PROFILE_DIR in the collapsed stack
+format ("root;caller;callee count" per line) read by flamegraph.pl and
+speedscope.
+
+A single command is profiled when its request has profile=1 in the query
+string or an X-Profile: 1 header; the response's X-Profile-File header names
+its output. Every process of both transaction servers is profiled for a
+number of seconds with /profile?seconds=N: the request is published on
+PROFILE_CHANNEL and each process writes its own profile, named after the
+profile id, its host and its pid.
+'''
+import functools
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+import uuid
+from flask import request
+from transaction_server.cache import cache as redis_client
+
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.001)) # seconds between samples
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'logs')
+PROFILE_MAX_SECONDS = 300
+PROFILE_CHANNEL = 'profile:start'
+PROFILE_RETRY_INTERVAL = 1.0 # seconds
+
+
+class Sampler():
+    '''
+    Samples the stacks of one thread, or of every thread but its own if
+    thread_id is None, from start() until stop().
+    '''
+
+    def __init__(self, thread_id=None, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stops sampling and returns the number of times each stack was seen.
+        '''
+        self._stop.set()
+        self._thread.join()
+        return self.counts
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()} if self.thread_id is None else {}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or (self.thread_id is not None and thread_id != self.thread_id):
+                    continue
+
+                stack = []
+                while frame is not None:
+                    stack.append('{}:{}'.format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                    frame = frame.f_back
+                if self.thread_id is None:
+                    stack.append(thread_names.get(thread_id, str(thread_id)))
+
+                key = ';'.join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+            self.samples += 1
+
+
+def profile_path(name):
+    '''
+    Returns PROFILE_DIR/profile-<name>-<date>-<time>.folded, for a profile started now.
+    '''
+    return os.path.join(PROFILE_DIR, 'profile-{}-{}.folded'.format(name, time.strftime('%Y%m%d-%H%M%S')))
+
+def write_folded(counts, path):
+    '''
+    Writes stack counts to path in the collapsed stack format, and returns the path.
+    '''
+    with open(path, 'w') as f:
+        for stack, count in sorted(counts.items()):
+            f.write('{} {}\n'.format(stack, count))
+    return path
+
+
+class GlobalProfile():
+    '''
+    At most one process-wide profile at a time, stopped and written out by a
+    timer after the requested number of seconds.
+    '''
+    _lock = threading.Lock()
+    _running = False
+
+    @staticmethod
+    def start(seconds, interval=PROFILE_INTERVAL, profile_id=None):
+        '''
+        Starts profiling every thread of this process for seconds, and returns
+        the path its output will be written to, or None if a profile is
+        already running.
+        '''
+        assert 0 < seconds <= PROFILE_MAX_SECONDS, 'seconds must be between 0 and {}'.format(PROFILE_MAX_SECONDS)
+
+        with GlobalProfile._lock:
+            if GlobalProfile._running:
+                return None
+            GlobalProfile._running = True
+
+        sampler = Sampler(interval=interval).start()
+        path = profile_path('global-{}-{}-{}'.format(profile_id or uuid.uuid4().hex[:8], socket.gethostname(), os.getpid()))
+
+        def finish():
+            try:
+                write_folded(sampler.stop(), path)
+            finally:
+                with GlobalProfile._lock:
+                    GlobalProfile._running = False
+
+        timer = threading.Timer(seconds, finish)
+        timer.daemon = True
+        timer.start()
+        return path
+
+    @staticmethod
+    def start_all(seconds, interval=PROFILE_INTERVAL):
+        '''
+        Asks every process listening on PROFILE_CHANNEL, this one included, to
+        profile itself for seconds. Returns the profile id and the number of
+        processes that received the request.
+        '''
+        assert 0 < seconds <= PROFILE_MAX_SECONDS, 'seconds must be between 0 and {}'.format(PROFILE_MAX_SECONDS)
+
+        profile_id = uuid.uuid4().hex[:8]
+        return profile_id, redis_client.publish(PROFILE_CHANNEL, json.dumps({'id': profile_id, 'seconds': seconds, 'interval': interval}))
+
+
+class ProfileListener():
+    '''
+    Starts a GlobalProfile in this process for each request published on
+    PROFILE_CHANNEL. A process already being profiled ignores the request.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        '''
+        Starts the listening thread, if not already running in this process.
+        '''
+        with self._lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._run, name='profile-listener', daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            try:
+                pubsub = redis_client.pubsub()
+                pubsub.subscribe(PROFILE_CHANNEL)
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    profile = json.loads(message['data'])
+                    GlobalProfile.start(profile['seconds'], profile['interval'], profile['id'])
+            except Exception:
+                # Resubscribe; requests published meanwhile are missed.
+                traceback.print_exc()
+                time.sleep(PROFILE_RETRY_INTERVAL)
+
+profile_listener = ProfileListener()
+
+
+def profiled(view):
+    '''
+    Decorates a command route so that it is profiled when its request asks
+    for it. Requests that do not only pay for the check.
+    '''
+    @functools.wraps(view)
+    def profiled_view(*args, **kwargs):
+        if request.args.get('profile') != '1' and request.headers.get('X-Profile') != '1':
+            return view(*args, **kwargs)
+
+        sampler = Sampler(thread_id=threading.get_ident()).start()
+        try:
+            response = view(*args, **kwargs)
+        finally:
+            counts = sampler.stop()
+
+        response.headers['X-Profile-File'] = write_folded(counts, profile_path('{}-{}'.format(view.__name__, request.args.get('tx_num', 'none'))))
+        return response
+    return profiled_view
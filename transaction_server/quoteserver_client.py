@@ -1,20 +1,74 @@
 #!/usr/bin/env python3
-import socket
+import os
+import threading
+import time
+from transaction_server.cache import Cache, QUOTE_CACHE_TTL, QUOTE_LOCK_TTL
+from transaction_server.instrumentation import instrument_class
 from transaction_server.logging import Logging
+from transaction_server.quoteserver_pool import CircuitBreaker, QuoteServerPool
+
+HOST = os.environ.get('QUOTE_SERVER_HOST', '192.168.4.2')
+PORT = int(os.environ.get('QUOTE_SERVER_PORT', 4444))
+QUOTE_POOL_SIZE = int(os.environ.get('QUOTE_POOL_SIZE', 8))
+QUOTE_SERVER_KEEPALIVE = os.environ.get('QUOTE_SERVER_KEEPALIVE', '1') == '1'
+QUOTE_KEEPALIVE_BACKOFF = float(os.environ.get('QUOTE_KEEPALIVE_BACKOFF', 30.0)) # seconds without keep-alive after a kept-alive connection is dropped
+QUOTE_SERVER_PIPELINING = os.environ.get('QUOTE_SERVER_PIPELINING', '0') == '1'
+QUOTE_LOCK_POLL_INTERVAL = 0.005 # seconds
+QUOTE_CONNECT_TIMEOUT = float(os.environ.get('QUOTE_CONNECT_TIMEOUT', 1.0)) # seconds
+QUOTE_READ_TIMEOUT = float(os.environ.get('QUOTE_READ_TIMEOUT', 2.0)) # seconds
+QUOTE_HEDGE_PERCENTILE = float(os.environ.get('QUOTE_HEDGE_PERCENTILE', 0.95)) # of recent latencies, 0 disables hedging
+QUOTE_BREAKER_FAILURES = int(os.environ.get('QUOTE_BREAKER_FAILURES', 5)) # consecutive failures that open the circuit
+QUOTE_BREAKER_RESET = float(os.environ.get('QUOTE_BREAKER_RESET', 10.0)) # seconds before a trial request
+QUOTE_STALE_TTL = float(os.environ.get('QUOTE_STALE_TTL', 300)) # seconds a quote can be served to QUOTE when the quote server is down
+cache = Cache()
+pool = QuoteServerPool(
+    HOST, PORT, max_idle=QUOTE_POOL_SIZE, keepalive=QUOTE_SERVER_KEEPALIVE, pipelining=QUOTE_SERVER_PIPELINING,
+    connect_timeout=QUOTE_CONNECT_TIMEOUT, read_timeout=QUOTE_READ_TIMEOUT, hedge_percentile=QUOTE_HEDGE_PERCENTILE or None,
+    breaker=CircuitBreaker(QUOTE_BREAKER_FAILURES, QUOTE_BREAKER_RESET), keepalive_backoff=QUOTE_KEEPALIVE_BACKOFF
+)
+
+
+class QuoteFlight():
+    '''
+    A quote server request in progress, shared by every concurrent caller
+    asking for the same symbol.
+    '''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.quote = None
+        self.error = None
 
-HOST = '192.168.4.2'
-PORT = 4444
 
 class QuoteServerClient():
+    '''
+    Quotes are cached in Redis for QUOTE_CACHE_TTL seconds so that both
+    transaction servers share them. Concurrent requests for the same symbol
+    are collapsed into a single quote server request: within a process the
+    callers wait on the same QuoteFlight, across processes the Redis quote
+    lock lets only one server query the quote server at a time.
+
+    Quotes fetched by this process are also kept for QUOTE_STALE_TTL seconds,
+    so that QUOTE can still answer, with a stale price, while the quote server
+    is unavailable. BUY and SELL never use them.
+    '''
+    _flights = {}
+    _recent_quotes = {} # symbol -> (quote, time fetched)
+    _flights_lock = threading.Lock()
+    _stats_lock = threading.Lock()
+    _hits = 0
+    _misses = 0
 
     @staticmethod
-    def get_quote(symbol, username, tx_num):
+    def get_quote(symbol, username, tx_num, allow_stale=False):
         '''
         Get price of stock by specified symbol.
 
         Parameter:
             symbol (str): The stock's symbol
             username (str): Username associated with originating request
+            allow_stale (bool): Whether a quote up to QUOTE_STALE_TTL old may be
+                returned if the quote server is unavailable
         Returns
             price (float): Stock price
             symbol (str): Symbol returned.
@@ -26,15 +80,148 @@ class QuoteServerClient():
         assert type(username) == str
         assert type(tx_num) == int
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((HOST, PORT))
-            s.sendall(str.encode('{:3s} {}\n'.format(symbol, username)))
-            data = s.recv(1024)
+        try:
+            return QuoteServerClient.__get_quote(symbol, username, tx_num)
+        except OSError:
+            recent = QuoteServerClient._recent_quotes.get(symbol)
+            if not allow_stale or recent is None or time.time() - recent[1] > QUOTE_STALE_TTL:
+                raise
+            return QuoteServerClient.__as_tuple(recent[0], username)
+
+    @staticmethod
+    def __get_quote(symbol, username, tx_num):
+        if QUOTE_CACHE_TTL <= 0:
+            return QuoteServerClient.__as_tuple(QuoteServerClient.__fetch_quote(symbol, username, tx_num), username)
+
+        quote = cache.get_quote(symbol)
+        if quote:
+            QuoteServerClient.__record_lookup(hit=True)
+            return QuoteServerClient.__as_tuple(quote, username)
+
+        # Join the request already in flight for this symbol, if any.
+        with QuoteServerClient._flights_lock:
+            flight = QuoteServerClient._flights.get(symbol)
+            is_leader = flight is None
+            if is_leader:
+                flight = QuoteFlight()
+                QuoteServerClient._flights[symbol] = flight
+
+        if not is_leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            QuoteServerClient.__record_lookup(hit=True)
+            return QuoteServerClient.__as_tuple(flight.quote, username)
+
+        QuoteServerClient.__record_lookup(hit=False)
+        try:
+            flight.quote = QuoteServerClient.__fetch_shared_quote(symbol, username, tx_num)
+            return QuoteServerClient.__as_tuple(flight.quote, username)
+        except Exception as err:
+            flight.error = err
+            raise
+        finally:
+            with QuoteServerClient._flights_lock:
+                del QuoteServerClient._flights[symbol]
+            flight.done.set()
+
+    @staticmethod
+    def get_quotes(quote_requests):
+        '''
+        Get prices for several stocks at once. Cached quotes are returned
+        directly, the rest are requested from the quote server on a single
+        pooled connection, pipelined if the quote server permits it.
+
+        Parameter:
+            quote_requests (list): (symbol, username, tx_num) for each stock
+        Returns
+            quotes (dict): (price, symbol, username, timestamp, cryptokey) keyed by symbol
+        '''
+        assert type(quote_requests) == list
+
+        quotes = {}
+        cached = cache.get_quotes([symbol for symbol, _, _ in quote_requests]) if QUOTE_CACHE_TTL > 0 else {}
+        misses = []
+        for symbol, username, tx_num in quote_requests:
+            if cached.get(symbol):
+                QuoteServerClient.__record_lookup(hit=True)
+                quotes[symbol] = QuoteServerClient.__as_tuple(cached[symbol], username)
+            else:
+                QuoteServerClient.__record_lookup(hit=False)
+                misses.append((symbol, username, tx_num))
 
-        data_str_trimmed = data.decode('utf-8')[:-1]
-        price, symbol, username, timestamp, cryptokey = data_str_trimmed.split(',')
+        if not misses:
+            return quotes
 
-        # Log as QuoteServerType
+        responses = pool.quote_many([(symbol, username) for symbol, username, _ in misses])
+        fetched = {}
+        for (symbol, username, tx_num), response in zip(misses, responses):
+            fetched[symbol] = QuoteServerClient.__parse_quote(response, tx_num)
+            quotes[symbol] = QuoteServerClient.__as_tuple(fetched[symbol], username)
+
+        if QUOTE_CACHE_TTL > 0:
+            cache.set_quotes(fetched)
+        return quotes
+
+    @staticmethod
+    def get_cache_stats():
+        '''
+        Returns the quote cache hits, misses and hit ratio of this process.
+        '''
+        with QuoteServerClient._stats_lock:
+            hits, misses = QuoteServerClient._hits, QuoteServerClient._misses
+
+        lookups = hits + misses
+        return {'hits': hits, 'misses': misses, 'hit_ratio': float(hits) / lookups if lookups else 0.0}
+
+    @staticmethod
+    def __record_lookup(hit):
+        with QuoteServerClient._stats_lock:
+            if hit:
+                QuoteServerClient._hits += 1
+            else:
+                QuoteServerClient._misses += 1
+
+    @staticmethod
+    def __fetch_shared_quote(symbol, username, tx_num):
+        # Wait for the other transaction server if it is already fetching the
+        # symbol, falling back to fetching it ourselves if its lock expires.
+        deadline = time.time() + QUOTE_LOCK_TTL
+        token = cache.acquire_quote_lock(symbol)
+        while token is None:
+            quote = cache.get_quote(symbol)
+            if quote:
+                return quote
+            if time.time() > deadline:
+                return QuoteServerClient.__fetch_quote(symbol, username, tx_num)
+            time.sleep(QUOTE_LOCK_POLL_INTERVAL)
+            token = cache.acquire_quote_lock(symbol)
+
+        try:
+            quote = QuoteServerClient.__fetch_quote(symbol, username, tx_num)
+            cache.set_quote(symbol, quote)
+        finally:
+            cache.release_quote_lock(symbol, token)
+        return quote
+
+    @staticmethod
+    def __fetch_quote(symbol, username, tx_num):
+        return QuoteServerClient.__parse_quote(pool.quote(symbol, username), tx_num)
+
+    @staticmethod
+    def __parse_quote(response, tx_num):
+        price, symbol, username, timestamp, cryptokey = response.split(',')
+
+        # Log as QuoteServerType, only for quotes actually served by the quote server.
         Logging.log_quote_server_hit(transactionNum=tx_num, price=float(price), stockSymbol=symbol, username=username, quoteServerTime=int(timestamp), cryptokey=cryptokey)
 
-        return float(price), symbol, username, int(timestamp), cryptokey
+        quote = {'price': float(price), 'symbol': symbol, 'username': username, 'timestamp': int(timestamp), 'cryptokey': cryptokey}
+        QuoteServerClient._recent_quotes[symbol] = (quote, time.time())
+        return quote
+
+    @staticmethod
+    def __as_tuple(quote, username):
+        # Cached quotes were requested on behalf of another user.
+        return quote['price'], quote['symbol'], username, quote['timestamp'], quote['cryptokey']
+
+instrument_class(QuoteServerClient, 'quote_server', ['get_quote', 'get_quotes'])
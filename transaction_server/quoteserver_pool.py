@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+'''
+Connection pooling for the legacy quote server protocol: a request is the
+line "SYM username\n" and the response the line
+"price,SYM,username,timestamp,cryptokey\n".
+
+Requests are bounded by connect and read timeouts. A single quote slower than
+a recent latency percentile is hedged: the request is sent again on another
+connection and whichever response comes first is used. A circuit breaker stops
+sending requests for a while after consecutive failures, so that callers fail
+fast instead of each waiting out a timeout while the quote server is down.
+
+This module only depends on the standard library so it can be benchmarked
+against the stand-in quote server in benchmarks/ without the rest of the
+transaction server.
+'''
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+import os
+import socket
+import threading
+import time
+
+
+class QuoteServerConnectionClosed(ConnectionError):
+    '''
+    The quote server closed the connection before sending a full response.
+    '''
+
+
+class QuoteServerUnavailable(ConnectionError):
+    '''
+    The circuit breaker is open: the quote server failed recently and is not
+    being sent requests.
+    '''
+
+
+class QuoteServerConnection():
+    '''
+    A single connection to the quote server. Responses are framed on newlines
+    through a buffered reader, so a response split over several TCP segments
+    or several pipelined responses arriving together are both read correctly.
+    '''
+
+    def __init__(self, host, port, connect_timeout=None, read_timeout=None):
+        self.sock = socket.create_connection((host, port), timeout=connect_timeout)
+        self.sock.settimeout(read_timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+        self.requests_served = 0
+
+    def request(self, lines):
+        '''
+        Sends every request line in one write, then reads one response line
+        for each of them, in order.
+        '''
+        self.sock.sendall(b''.join(lines))
+
+        responses = []
+        for _ in lines:
+            response = self.reader.readline()
+            if not response.endswith(b'\n'):
+                raise QuoteServerConnectionClosed('Quote server closed the connection after {} responses'.format(self.requests_served))
+            responses.append(response.decode('utf-8').rstrip('\r\n'))
+            self.requests_served += 1
+        return responses
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+class LatencyTracker():
+    '''
+    The latencies of the last window requests, for percentiles. They are
+    sorted again once a tenth of the window has changed.
+    '''
+
+    def __init__(self, window=1000):
+        self._latencies = deque(maxlen=window)
+        self._sorted = []
+        self._changed = 0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+            self._changed += 1
+
+    def percentile(self, fraction):
+        '''
+        Returns the latency at the given fraction (e.g. 0.95), or None if
+        there are none yet.
+        '''
+        with self._lock:
+            if self._changed * 10 >= self._latencies.maxlen or len(self._sorted) < len(self._latencies) // 2:
+                self._sorted = sorted(self._latencies)
+                self._changed = 0
+            latencies = self._sorted
+
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+    def __len__(self):
+        return len(self._latencies)
+
+
+class CircuitBreaker():
+    '''
+    Opens after failure_threshold consecutive failures, rejecting requests for
+    reset_timeout seconds. Then a single trial request is let through (half
+    open): its success closes the circuit, its failure opens it again.
+    '''
+    CLOSED = 'closed'
+    HALF_OPEN = 'half_open'
+    OPEN = 'open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        '''
+        Returns True if a request may be sent.
+        '''
+        with self._lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN and time.time() >= self._opened_at + self.reset_timeout:
+                self.state = CircuitBreaker.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != CircuitBreaker.OPEN:
+                    self.opened += 1
+                self.state = CircuitBreaker.OPEN
+                self._opened_at = time.time()
+
+
+class QuoteServerPool():
+    '''
+    Keeps up to max_idle warm connections to the quote server for reuse by the
+    worker threads of this process.
+
+    If a reused connection turns out to have been closed by the quote server,
+    the request is retried once on a fresh connection and keep-alive is turned
+    off for keepalive_backoff seconds, since the server may close connections
+    after replying. Keep-alive is tried again after that, in case the
+    connection was only dropped once.
+    Pipelining several requests on one connection is only attempted when
+    enabled, as the legacy server may not support it.
+
+    Single quotes are hedged after the hedge_percentile of recent latencies,
+    once hedge_min_samples are known, unless hedge_percentile is None. Every
+    request goes through the circuit breaker.
+    '''
+
+    def __init__(self, host, port, max_idle=8, keepalive=True, pipelining=False, connect_timeout=None, read_timeout=None,
+                 hedge_percentile=None, hedge_min_samples=20, hedge_workers=32, breaker=None, keepalive_backoff=30.0):
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self.keepalive = keepalive
+        self.keepalive_backoff = keepalive_backoff
+        self.keepalive_resumes = 0.0 # time keep-alive is turned back on after a connection was dropped
+        self.pipelining = pipelining
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_workers = hedge_workers
+        self.breaker = breaker or CircuitBreaker()
+        self.latencies = LatencyTracker()
+        self.counts = {'requests': 0, 'failures': 0, 'timeouts': 0, 'rejected': 0, 'hedges': 0, 'hedges_won': 0}
+        self._idle = []
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def quote(self, symbol, username):
+        '''
+        Returns the raw response line for a single quote request, hedged if it
+        is slower than usual.
+        '''
+        delay = self.hedge_delay()
+        if delay is None:
+            return self.request([(symbol, username)])[0]
+
+        executor = self._hedge_executor()
+        primary = executor.submit(self.request, [(symbol, username)])
+        if wait([primary], timeout=delay).done:
+            return primary.result()[0]
+
+        hedge = executor.submit(self.request, [(symbol, username)])
+        self._count('hedges')
+        error = None
+        for future in as_completed([primary, hedge]):
+            try:
+                responses = future.result()
+            except Exception as err:
+                error = error or err
+                continue
+            if future is hedge:
+                self._count('hedges_won')
+            return responses[0]
+        raise error
+
+    def hedge_delay(self):
+        '''
+        Returns the seconds after which a quote is hedged, or None if quotes
+        are not hedged (yet).
+        '''
+        if self.hedge_percentile is None or len(self.latencies) < self.hedge_min_samples:
+            return None
+        return self.latencies.percentile(self.hedge_percentile)
+
+    def quote_many(self, requests):
+        '''
+        Returns the raw response lines for a list of (symbol, username)
+        requests, in order. Requests are pipelined on one connection when
+        pipelining is enabled, and sent one after another otherwise.
+        '''
+        if self.pipelining:
+            return self.request(requests)
+        return [self.request([request])[0] for request in requests]
+
+    def request(self, requests):
+        '''
+        Returns the raw response lines for a list of (symbol, username)
+        requests, sent on one connection, unless the circuit breaker is open.
+        '''
+        if not self.breaker.allow():
+            self._count('rejected')
+            raise QuoteServerUnavailable('Quote server is unavailable, not retrying for up to {} seconds'.format(self.breaker.reset_timeout))
+
+        self._count('requests')
+        start = time.perf_counter()
+        try:
+            responses = self._request(requests)
+        except Exception as err:
+            self._count('timeouts' if isinstance(err, socket.timeout) else 'failures')
+            self.breaker.record_failure()
+            raise
+
+        self.breaker.record_success()
+        if len(requests) == 1:
+            self.latencies.add(time.perf_counter() - start)
+        return responses
+
+    def stats(self):
+        '''
+        Returns the circuit breaker state, request counts and recent latency
+        percentiles (in ms) of this process.
+        '''
+        with self._lock:
+            counts = dict(self.counts)
+        percentiles = {'p{}_ms'.format(int(fraction * 100)): (self.latencies.percentile(fraction) or 0.0) * 1000 for fraction in [0.5, 0.95, 0.99]}
+        return dict(counts, breaker=self.breaker.state, breaker_opened=self.breaker.opened, hedge_delay_ms=(self.hedge_delay() or 0.0) * 1000, **percentiles)
+
+    def render(self):
+        '''
+        Returns the stats in the Prometheus text exposition format.
+        '''
+        stats = self.stats()
+        lines = [
+            '# HELP transaction_server_quote_server_breaker_state Circuit breaker state (0 closed, 1 half open, 2 open).',
+            '# TYPE transaction_server_quote_server_breaker_state gauge',
+            'transaction_server_quote_server_breaker_state {}'.format([CircuitBreaker.CLOSED, CircuitBreaker.HALF_OPEN, CircuitBreaker.OPEN].index(stats['breaker'])),
+            '# HELP transaction_server_quote_server_seconds Latency of recent quote server requests.',
+            '# TYPE transaction_server_quote_server_seconds summary',
+        ]
+        for quantile in ['0.5', '0.95', '0.99']:
+            lines.append('transaction_server_quote_server_seconds{{quantile="{}"}} {}'.format(quantile, stats['p{}_ms'.format(int(float(quantile) * 100))] / 1000))
+        for name in ['requests', 'failures', 'timeouts', 'rejected', 'hedges', 'hedges_won', 'breaker_opened']:
+            lines.append('# TYPE transaction_server_quote_server_{}_total counter'.format(name))
+            lines.append('transaction_server_quote_server_{}_total {}'.format(name, stats[name]))
+        return '\n'.join(lines) + '\n'
+
+    def _request(self, requests):
+        lines = [str.encode('{:3s} {}\n'.format(symbol, username)) for symbol, username in requests]
+
+        connection, reused = self._acquire()
+        try:
+            responses = connection.request(lines)
+        except socket.timeout:
+            # The quote server is slow, not gone: don't retry or stop keeping alive.
+            connection.close()
+            raise
+        except (OSError, QuoteServerConnectionClosed):
+            connection.close()
+            if not reused:
+                raise
+
+            # The idle connection was closed by the quote server, retry once
+            # on a fresh connection and stop keeping connections alive for a while.
+            self.keepalive_resumes = time.time() + self.keepalive_backoff
+            self.clear()
+            connection = self._connect()
+            try:
+                responses = connection.request(lines)
+            except Exception:
+                connection.close()
+                raise
+        except Exception:
+            connection.close()
+            raise
+
+        self._release(connection)
+        return responses
+
+    def clear(self):
+        '''
+        Closes every idle connection.
+        '''
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def _connect(self):
+        return QuoteServerConnection(self.host, self.port, connect_timeout=self.connect_timeout, read_timeout=self.read_timeout)
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def _hedge_executor(self):
+        with self._lock:
+            # Threads do not survive a fork.
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.hedge_workers, thread_name_prefix='quote-hedge')
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _acquire(self):
+        with self._lock:
+            # Connections inherited from a parent process must not be shared.
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._idle = []
+            if self._idle:
+                return self._idle.pop(), True
+        return self._connect(), False
+
+    def _release(self, connection):
+        with self._lock:
+            if self.keepalive and time.time() >= self.keepalive_resumes and self._pid == os.getpid() and len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+'''
+Background execution of BUY and SELL triggers set through SET_BUY_TRIGGER and
+SET_SELL_TRIGGER.
+
+Armed triggers are held in memory, indexed by stock symbol and sorted by
+trigger price, so the engine only quotes each distinct symbol once per quote
+period and can find every crossing trigger with a binary search. The account
+documents remain the source of truth: every fire is guarded on the trigger and
+reserve still being present, so a trigger cancelled or changed through the
+other transaction server is never executed from a stale index entry.
+
+Only the process holding the leader lease (see leader.py) polls the quote
+server. Every process records the triggers it arms and disarms in a Redis
+list, which the leader applies to its index before each poll.
+'''
+from bisect import bisect_left, insort
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import os
+import threading
+import traceback
+from transaction_server.account_state import account_store
+from transaction_server.cache import cache as redis_client
+from transaction_server.leader import leader
+from transaction_server.logging import Logging, CommandType
+from transaction_server.quoteserver_client import QuoteServerClient
+
+TRIGGER_POLL_PERIOD = float(os.environ.get('TRIGGER_POLL_PERIOD', 60)) # seconds
+TRIGGER_QUOTE_WORKERS = int(os.environ.get('TRIGGER_QUOTE_WORKERS', 8))
+TRIGGER_QUOTE_BATCH = int(os.environ.get('TRIGGER_QUOTE_BATCH', 32)) # symbols per quote server connection
+TRIGGER_CHANGES_KEY = 'triggers:changes'
+
+
+class TriggerIndex():
+    '''
+    In-memory index of armed triggers. For each stock symbol, BUY and SELL
+    triggers are kept in separate lists of (price, user_id) sorted by price.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._books = {'BUY': {}, 'SELL': {}}
+        self._entries = {} # (trigger_type, user_id, stock_symbol) -> (price, tx_num)
+
+    def arm(self, trigger_type, user_id, stock_symbol, price, tx_num):
+        '''
+        Adds the trigger to the index, replacing any trigger the user already
+        had for that stock.
+        '''
+        assert trigger_type in ['BUY', 'SELL']
+        assert type(price) == float
+
+        with self._lock:
+            self._remove(trigger_type, user_id, stock_symbol)
+            insort(self._books[trigger_type].setdefault(stock_symbol, []), (price, user_id))
+            self._entries[(trigger_type, user_id, stock_symbol)] = (price, tx_num)
+
+    def disarm(self, trigger_type, user_id, stock_symbol):
+        '''
+        Removes the user's trigger for that stock, if one is indexed.
+        '''
+        assert trigger_type in ['BUY', 'SELL']
+
+        with self._lock:
+            self._remove(trigger_type, user_id, stock_symbol)
+
+    def symbols(self):
+        '''
+        Returns the symbols that have at least one armed trigger.
+        '''
+        with self._lock:
+            return set(self._books['BUY']) | set(self._books['SELL'])
+
+    def any_entry(self, stock_symbol):
+        '''
+        Returns (user_id, tx_num) of one trigger armed on the symbol, used to
+        attribute the quote server request, or None if none are armed.
+        '''
+        with self._lock:
+            for trigger_type in ['BUY', 'SELL']:
+                book = self._books[trigger_type].get(stock_symbol)
+                if book:
+                    user_id = book[0][1]
+                    return user_id, self._entries[(trigger_type, user_id, stock_symbol)][1]
+        return None
+
+    def pop_crossing(self, stock_symbol, price):
+        '''
+        Removes and returns every trigger crossed by the price. BUY triggers
+        cross when the price is at or below the trigger price, SELL triggers
+        when it is at or above. Returns two lists of (user_id, trigger_price, tx_num).
+        '''
+        with self._lock:
+            buys = self._pop_slice('BUY', stock_symbol, bisect_left(self._books['BUY'].get(stock_symbol, []), (price,)), None)
+            sells = self._pop_slice('SELL', stock_symbol, 0, bisect_left(self._books['SELL'].get(stock_symbol, []), (math.nextafter(price, math.inf),)))
+        return buys, sells
+
+    def _pop_slice(self, trigger_type, stock_symbol, start, end):
+        book = self._books[trigger_type].get(stock_symbol)
+        if not book:
+            return []
+
+        crossed = book[start:end]
+        del book[start:end]
+        if not book:
+            del self._books[trigger_type][stock_symbol]
+
+        return [(user_id, price, self._entries.pop((trigger_type, user_id, stock_symbol))[1]) for price, user_id in crossed]
+
+    def _remove(self, trigger_type, user_id, stock_symbol):
+        entry = self._entries.pop((trigger_type, user_id, stock_symbol), None)
+        if entry is None:
+            return
+
+        book = self._books[trigger_type][stock_symbol]
+        book.remove((entry[0], user_id))
+        if not book:
+            del self._books[trigger_type][stock_symbol]
+
+
+class TriggerEngine():
+    '''
+    Polls the quote server once per symbol every TRIGGER_POLL_PERIOD seconds,
+    TRIGGER_QUOTE_BATCH symbols per request batch, and fires all triggers
+    crossed by each returned price in a single batch, while it is the leader.
+    The index is rebuilt from the accounts whenever it becomes the leader, as
+    changes were not applied to it meanwhile.
+    '''
+
+    def __init__(self, poll_period=TRIGGER_POLL_PERIOD, leader=leader):
+        self.index = TriggerIndex()
+        self.poll_period = poll_period
+        self.leader = leader
+        self._loaded = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def arm(self, trigger_type, user_id, stock_symbol, price, tx_num):
+        assert trigger_type in ['BUY', 'SELL']
+        assert type(price) == float
+
+        redis_client.rpush(TRIGGER_CHANGES_KEY, json.dumps(['arm', trigger_type, user_id, stock_symbol, price, tx_num]))
+
+    def disarm(self, trigger_type, user_id, stock_symbol):
+        assert trigger_type in ['BUY', 'SELL']
+
+        redis_client.rpush(TRIGGER_CHANGES_KEY, json.dumps(['disarm', trigger_type, user_id, stock_symbol]))
+
+    def apply_changes(self):
+        '''
+        Applies the triggers armed and disarmed since the last call to the
+        index, in the order they were made.
+        '''
+        pipeline = redis_client.pipeline()
+        pipeline.lrange(TRIGGER_CHANGES_KEY, 0, -1)
+        pipeline.delete(TRIGGER_CHANGES_KEY)
+        changes, _ = pipeline.execute()
+
+        for change in changes:
+            action, *args = json.loads(change)
+            if action == 'arm':
+                self.index.arm(*args)
+            else:
+                self.index.disarm(*args)
+
+    def load(self):
+        '''
+        Rebuilds the index from the triggers persisted in the accounts collection.
+        '''
+        # Changes made from here on are applied on top of what is loaded;
+        # those already loaded are applied again, which leaves them as they are.
+        redis_client.delete(TRIGGER_CHANGES_KEY)
+        self.index = TriggerIndex()
+        for account in account_store.get_armed_triggers():
+            tx_nums = account.get('trigger_tx_nums', {})
+            for trigger_type, field in [('BUY', 'buy_triggers'), ('SELL', 'sell_triggers')]:
+                for stock_symbol, price in account.get(field, {}).items():
+                    # SELL triggers are created without a price by SET_SELL_AMOUNT.
+                    if price is None:
+                        continue
+                    tx_num = tx_nums.get(trigger_type, {}).get(stock_symbol, 1)
+                    self.index.arm(trigger_type, account['userid'], stock_symbol, float(price), tx_num)
+
+    def start(self):
+        '''
+        Starts campaigning for the leader lease and the polling thread, if
+        not already running.
+        '''
+        if self._thread is not None:
+            return
+
+        self.leader.start()
+        self._thread = threading.Thread(target=self._run, name='trigger-engine', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.leader.stop()
+
+    def _run(self):
+        with ThreadPoolExecutor(max_workers=TRIGGER_QUOTE_WORKERS) as executor:
+            while not self._stop.wait(self.poll_period):
+                if not self.leader.is_leader():
+                    self._loaded = False
+                    continue
+
+                try:
+                    if not self._loaded:
+                        self.load()
+                        self._loaded = True
+                    self.apply_changes()
+                except Exception:
+                    traceback.print_exc()
+                    continue
+
+                symbols = sorted(self.index.symbols())
+                batches = [symbols[i:i + TRIGGER_QUOTE_BATCH] for i in range(0, len(symbols), TRIGGER_QUOTE_BATCH)]
+                futures = [executor.submit(self.poll_symbols, batch) for batch in batches]
+                for future in futures:
+                    # A failing batch must not stop the engine; its triggers
+                    # are re-armed and retried on the next period.
+                    future.exception()
+
+    def poll_symbols(self, stock_symbols):
+        '''
+        Quotes each symbol once, in a single batch to the quote server, and
+        fires every trigger crossed by the returned prices.
+        '''
+        quote_requests = []
+        for stock_symbol in stock_symbols:
+            entry = self.index.any_entry(stock_symbol)
+            if entry is not None:
+                quote_requests.append((stock_symbol, entry[0], entry[1]))
+
+        try:
+            quotes = QuoteServerClient.get_quotes(quote_requests)
+        except OSError:
+            # Quote server unavailable, retry on the next period.
+            return
+
+        for stock_symbol, quote in quotes.items():
+            buys, sells = self.index.pop_crossing(stock_symbol, quote[0])
+            if buys or sells:
+                self.fire(stock_symbol, buys, sells)
+
+    def fire(self, stock_symbol, buys, sells):
+        '''
+        Executes the crossed triggers against the reserves held for them.
+        Triggers still set on their account but without a reserve, such as
+        those of an account not loaded yet, are put back to fire later.
+        '''
+        try:
+            accounts = account_store.get_trigger_reserves([user_id for user_id, _, _ in buys + sells], stock_symbol)
+            buy_fills, buys_unreserved = self.split_reserved('BUY', stock_symbol, buys, accounts)
+            sell_fills, sells_unreserved = self.split_reserved('SELL', stock_symbol, sells, accounts)
+            for user_id, price, tx_num in buys_unreserved:
+                self.index.arm('BUY', user_id, stock_symbol, price, tx_num)
+            for user_id, price, tx_num in sells_unreserved:
+                self.index.arm('SELL', user_id, stock_symbol, price, tx_num)
+            if not buy_fills and not sell_fills:
+                return
+
+            account_store.execute_triggers(stock_symbol, [fill[:3] for fill in buy_fills], [fill[:3] for fill in sell_fills])
+        except Exception:
+            # Put the triggers back so they are retried on the next period.
+            for user_id, price, tx_num in buys:
+                self.index.arm('BUY', user_id, stock_symbol, price, tx_num)
+            for user_id, price, tx_num in sells:
+                self.index.arm('SELL', user_id, stock_symbol, price, tx_num)
+            return
+
+        for user_id, price, amount, tx_num in buy_fills:
+            Logging.log_system_event(transactionNum=tx_num, command=CommandType.SET_BUY_TRIGGER, username=user_id, stockSymbol=stock_symbol, funds=float(amount))
+
+        balances = account_store.get_balances([user_id for user_id, _, _, _ in sell_fills]) if sell_fills else {}
+        for user_id, price, amount, tx_num in sell_fills:
+            Logging.log_system_event(transactionNum=tx_num, command=CommandType.SET_SELL_TRIGGER, username=user_id, stockSymbol=stock_symbol, funds=float(amount))
+            if user_id in balances:
+                Logging.log_account_transaction(transactionNum=tx_num, action='add', username=user_id, funds=float(balances[user_id]))
+
+    @staticmethod
+    def split_reserved(trigger_type, stock_symbol, triggers, accounts):
+        '''
+        Splits crossed (user_id, trigger_price, tx_num) triggers into fills,
+        (user_id, trigger_price, reserve_amount, tx_num), for those with a
+        reserve, and those without a reserve whose account still has the
+        trigger set at that price. Triggers in neither were cancelled or
+        changed, and are dropped.
+        '''
+        reserve_field, trigger_field = 'reserve_{}'.format(trigger_type.lower()), '{}_triggers'.format(trigger_type.lower())
+        fills, unreserved = [], []
+        for user_id, price, tx_num in triggers:
+            account = accounts.get(user_id, {})
+            if stock_symbol in account.get(reserve_field, {}):
+                fills.append((user_id, price, account[reserve_field][stock_symbol], tx_num))
+            elif account.get(trigger_field, {}).get(stock_symbol) == price:
+                unreserved.append((user_id, price, tx_num))
+        return fills, unreserved
+
+
+trigger_engine = TriggerEngine()